@@ -0,0 +1,164 @@
+'''Measure the accuracy of the fast multipole method against its expansion order, and the number of
+particles at which it becomes faster than the direct sum and Barnes-Hut.
+
+accuracy -- For each expansion order and opening angle, the median, 99th percentile and largest
+  relative force error |F - F_direct|/|F_direct| on a Plummer sphere, and the time taken
+crossover -- The time per force calculation for each backend over a range of N, and the smallest N
+  at which the FMM beats each of the others. The approximate backends' median and largest force
+  errors, on a sample of particles, are recorded alongside, so the crossover can be read at matched
+  accuracy.
+
+Usage:
+python benchmarks/fmm.py accuracy [--n 5000] [--orders 1 2 3 4 5 6] [--thetas 0.3 0.5 0.7]
+python benchmarks/fmm.py crossover [--n 1000 3000 10000 30000] [--backends direct_numpy direct_numba tree]
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import n_body_fmm
+import n_body_numba
+import n_body_physics
+import n_body_setup
+
+from force_backends import BACKENDS, best_time
+
+ORDERS = [1, 2, 3, 4, 5, 6]
+
+THETAS = [0.3, 0.5, 0.7]
+
+PARTICLE_NUMBERS = [1000, 3000, 10000, 30000, 100000]
+
+# The backends whose forces are approximate
+APPROXIMATE_BACKENDS = ['fmm', 'tree']
+
+# Number of particles the force errors are measured on
+N_ERROR_SAMPLES = 200
+
+########################################################################
+
+def measure_accuracy(n_particles, orders, thetas, seed=0):
+  '''The FMM's force errors on a Plummer sphere for every order and opening angle.'''
+
+  particles = n_body_setup.sample_plummer_sphere(n_particles, np.random.default_rng(seed))
+
+  expected = n_body_physics.calculate_direct_forces(particles, {'G' : 1.})
+  magnitudes = np.sqrt((expected**2.).sum(axis=1))
+
+  results = []
+  for theta in thetas:
+    for order in orders:
+
+      parameters = {'G' : 1., 'force_method' : 'fmm', 'fmm_order' : order, 'fmm_theta' : theta}
+
+      start = time.perf_counter()
+      forces = n_body_physics.calculate_net_force_on_all_particles(particles, parameters)
+      seconds = time.perf_counter() - start
+
+      errors = np.sqrt(((forces - expected)**2.).sum(axis=1))/magnitudes
+
+      results.append({'theta' : theta, 'order' : order, 'median' : float(np.median(errors)),
+                      '99th_percentile' : float(np.percentile(errors, 99.)), 'max' : float(errors.max()), 'seconds' : seconds})
+
+      print('{:>7}{:>7}{:>12.2e}{:>12.2e}{:>12.2e}{:>10.3f}'.format(
+        theta, order, results[-1]['median'], results[-1]['99th_percentile'], results[-1]['max'], seconds))
+
+  return results
+
+########################################################################
+
+def measure_crossover(particle_numbers, backends, max_seconds):
+  '''Time the FMM and the other backends over a range of N, and find where the FMM overtakes each.'''
+
+  results = []
+  skipped = set()
+
+  for n_particles in sorted(particle_numbers):
+
+    particles = n_body_setup.sample_plummer_sphere(n_particles, np.random.default_rng(0))
+
+    row = {'n_particles' : n_particles, 'errors' : {}}
+    for backend in ['fmm'] + backends:
+
+      if backend in skipped:
+        continue
+
+      parameters = dict(BACKENDS[backend], G=1.)
+      seconds, spread = best_time(lambda: n_body_physics.calculate_net_force_on_all_particles(particles, parameters))
+      row[backend] = seconds
+
+      if backend in APPROXIMATE_BACKENDS:
+        errors = n_body_physics.estimate_force_error(particles, parameters, N_ERROR_SAMPLES, seed=0)
+        row['errors'][backend] = {'median' : float(errors['median']), 'max' : float(errors['max'])}
+
+      # The direct sums grow as N^2, so stop timing them once they get slow.
+      if seconds > max_seconds:
+        skipped.add(backend)
+
+    results.append(row)
+    print('{:>8}'.format(n_particles) + ''.join('{:>16.3e}'.format(row[backend]) if backend in row else '{:>16}'.format('-')
+                                                for backend in ['fmm'] + backends))
+    print('{:>8}'.format('') + ''.join('  {} errors: median {:.1e}, max {:.1e}'.format(backend, errors['median'], errors['max'])
+                                       for backend, errors in row['errors'].items()))
+
+  crossovers = {}
+  for backend in backends:
+    faster = [row['n_particles'] for row in results if backend in row and row['fmm'] < row[backend]]
+    crossovers[backend] = min(faster) if faster else None
+
+  return results, crossovers
+
+########################################################################
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('mode', choices=['accuracy', 'crossover'])
+  parser.add_argument('--n', nargs='+', type=int, help='Numbers of particles')
+  parser.add_argument('--orders', nargs='+', type=int, default=ORDERS)
+  parser.add_argument('--thetas', nargs='+', type=float, default=THETAS)
+  # The particle-mesh backends need a periodic box, which the Plummer sphere isn't in.
+  parser.add_argument('--backends', nargs='+', choices=sorted(set(BACKENDS) - {'fmm', 'pm', 'p3m'}), default=None)
+  parser.add_argument('--max-seconds', type=float, default=20., help='Stop timing a backend once a call takes this long')
+  parser.add_argument('--output', default='fmm_benchmark.json')
+  arguments = parser.parse_args()
+
+  if arguments.mode == 'accuracy':
+
+    n_particles = arguments.n[0] if arguments.n else 5000
+    print('Plummer sphere, N = {}'.format(n_particles))
+    print('{:>7}{:>7}{:>12}{:>12}{:>12}{:>10}'.format('theta', 'order', 'median', '99%', 'max', 'seconds'))
+    output = {'n_particles' : n_particles, 'results' : measure_accuracy(n_particles, arguments.orders, arguments.thetas)}
+
+  else:
+
+    backends = arguments.backends
+    if backends is None:
+      backends = ['direct_numpy', 'tree'] + (['direct_numba'] if n_body_numba.NUMBA_AVAILABLE else [])
+
+    print('Seconds per force calculation, Plummer sphere, FMM order {} and theta {}'.format(n_body_fmm.DEFAULT_ORDER, n_body_fmm.DEFAULT_THETA))
+    print('{:>8}'.format('N') + ''.join('{:>16}'.format(backend) for backend in ['fmm'] + backends))
+    results, crossovers = measure_crossover(arguments.n or PARTICLE_NUMBERS, backends, arguments.max_seconds)
+
+    for backend, n_particles in crossovers.items():
+      if n_particles is None:
+        print('FMM never beat {}'.format(backend))
+        continue
+
+      print('FMM beats {} from N = {}'.format(backend, n_particles))
+      if backend in APPROXIMATE_BACKENDS:
+        errors = next(row['errors'] for row in results if row['n_particles'] == n_particles)
+        print('  with largest force errors there of {:.1e} for the FMM and {:.1e} for {}'.format(
+          errors['fmm']['max'], errors[backend]['max'], backend))
+
+    output = {'results' : results, 'crossovers' : crossovers}
+
+  with open(arguments.output, 'w') as f:
+    json.dump(output, f, indent=2)
@@ -0,0 +1,399 @@
+'''Time the force backends, and a full update_system() step with each integrator, over a range of
+particle numbers.
+
+For each backend, number of particles N and number of dimensions D this records
+  forces -- calculate_net_force_on_all_particles(): seconds per call, and pair interactions per
+    second, counting the N*(N - 1)/2 pairs of the direct sum (as n_body_profiling does) so
+    approximate methods compare with it
+  integrators -- For each integrator in n_body_integrators.INTEGRATORS that can use the backend,
+    seconds per update_system() step and steps per second
+  peak memory -- The largest amount of memory allocated during one force calculation, from
+    tracemalloc. tracemalloc only sees memory allocated through Python in this process, so this is
+    left out (None) for the backends in UNTRACED_BACKENDS, whose memory is allocated by Numba or in
+    worker processes.
+and writes them to a JSON file. Each timing is the best of several repeats, recorded with its
+spread: how much slower the median repeat was. The particle-mesh backends run in a periodic unit box,
+and only in 3D.
+
+Runs that would take longer than --max-seconds, judging by how the backend scaled over the smaller
+N, are skipped, so the direct sum isn't run at N = 100000 by accident.
+
+Given a baseline (a results file from an earlier run, on the same machine), any run that got slower,
+or used more memory, by more than --threshold is reported as a regression and the script exits with
+status 1. A slowdown also has to be bigger than the spreads of the two timings, and timings shorter
+than MIN_COMPARABLE_SECONDS aren't compared at all, so timer noise isn't reported.
+
+Usage:
+python benchmarks/force_backends.py [--output results.json] [--baseline baseline.json]
+python benchmarks/force_backends.py --quick --backends direct_numpy tree
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import n_body_integrators
+import n_body_numba
+import n_body_physics
+
+# The parameters that choose each backend
+BACKENDS = {
+  'direct_numpy' : {'force_method' : 'direct', 'use_numba' : False},
+  'direct_tiled' : {'force_method' : 'direct', 'use_numba' : False, 'tile_size' : 512},
+  'direct_numba' : {'force_method' : 'direct', 'use_numba' : True},
+  'direct_mixed' : {'force_method' : 'direct', 'mixed_precision' : True},
+  'tree' : {'force_method' : 'tree'},
+  'fmm' : {'force_method' : 'fmm'},
+  'parallel' : {'force_method' : 'parallel', 'deterministic' : True},
+  'pm' : {'force_method' : 'pm', 'box_size' : 1.},
+  'p3m' : {'force_method' : 'p3m', 'box_size' : 1.},
+}
+
+# Backends whose memory tracemalloc can't see
+UNTRACED_BACKENDS = ('direct_numba', 'parallel')
+
+# How each backend's cost grows with N, for guessing how long the next N will take. The tree and
+# FMM exponents were measured from 2500 to 40000 particles in a 3D cube; their ideal N log N and N
+# would predict too little. In a fixed box and grid, the PM cost grows like N, and the number of
+# P3M short-range pairs like N^2.
+SCALING = {
+  'direct_numpy' : lambda n: n**2.,
+  'direct_tiled' : lambda n: n**2.,
+  'direct_numba' : lambda n: n**2.,
+  'direct_mixed' : lambda n: n**2.,
+  'tree' : lambda n: n**1.4,
+  'fmm' : lambda n: n**1.3,
+  'parallel' : lambda n: n**2.,
+  'pm' : lambda n: n,
+  'p3m' : lambda n: n**2.,
+}
+
+PARTICLE_NUMBERS = [10, 100, 1000, 10000, 100000]
+
+DIMENSIONS = [2, 3]
+
+# Keep repeating a measurement until this much time has been spent on it...
+MIN_SECONDS = 0.2
+
+# ...or it has been repeated this many times.
+MAX_REPEATS = 20
+
+# Timings shorter than this are too noisy to call a regression. Millisecond timings routinely vary
+# by tens of percent from run to run.
+MIN_COMPARABLE_SECONDS = 1.e-2
+
+########################################################################
+
+def make_particles(n_particles, n_dimensions, seed=0):
+  '''Particles spread uniformly through a unit cube, with small random velocities.'''
+
+  rng = np.random.default_rng(seed)
+
+  particles = {}
+  particles['masses'] = rng.uniform(1., 2., n_particles)
+  particles['positions'] = rng.uniform(0., 1., (n_particles, n_dimensions))
+  particles['velocities'] = rng.normal(0., 0.1, (n_particles, n_dimensions))
+
+  return particles
+
+########################################################################
+
+def best_time(function):
+  '''Time function() over several calls, after one warm-up call.
+
+  Returns:
+  best -- The shortest time taken
+  spread -- How much longer the median call took than the shortest
+  '''
+
+  function()
+
+  times = []
+  start = time.perf_counter()
+  while len(times) < MAX_REPEATS and (len(times) < 3 or time.perf_counter() - start < MIN_SECONDS):
+    call_start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - call_start)
+
+  return min(times), np.median(times) - min(times)
+
+########################################################################
+
+def peak_memory(function):
+  '''The most memory allocated at once during function(), in bytes.'''
+
+  tracemalloc.start()
+  try:
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+  return peak
+
+########################################################################
+
+def measure(backend, n_particles, n_dimensions, integrators=None):
+  '''Time one backend at one size, and a step of each integrator that can use it.
+
+  Args:
+  backend -- The name of the backend in BACKENDS
+  n_particles -- Number of particles
+  n_dimensions -- Number of dimensions
+  integrators -- Names of the integrators to time steps of. Defaults to every one in
+    n_body_integrators.INTEGRATORS, leaving out other names for the same integrator.
+  '''
+
+  if integrators is None:
+    integrators = default_integrators()
+
+  particles = make_particles(n_particles, n_dimensions)
+
+  parameters = {'G' : 1., 'dt' : 1.e-5}
+  parameters.update(BACKENDS[backend])
+
+  try:
+    force_seconds, force_spread = best_time(lambda: n_body_physics.calculate_net_force_on_all_particles(particles, parameters))
+
+    memory = None
+    if backend not in UNTRACED_BACKENDS:
+      memory = peak_memory(lambda: n_body_physics.calculate_net_force_on_all_particles(particles, parameters))
+
+  finally:
+    if parameters.get('parallel_state') is not None:
+      parameters['parallel_state'].close()
+
+  steps = {}
+  for integrator in integrators:
+    step = measure_steps(backend, integrator, particles, parameters)
+    if step is not None:
+      steps[integrator] = step
+
+  return {
+    'backend' : backend,
+    'n_particles' : n_particles,
+    'n_dimensions' : n_dimensions,
+    'force_seconds' : force_seconds,
+    'force_spread_seconds' : force_spread,
+    'pair_interactions_per_second' : n_particles*(n_particles - 1)/2./force_seconds,
+    'peak_memory_bytes' : memory,
+    'integrators' : steps,
+  }
+
+########################################################################
+
+def measure_steps(backend, integrator, particles, parameters):
+  '''Time update_system() steps with one integrator, or return None if it can't use the backend.'''
+
+  particles = dict((key, value.copy()) for key, value in particles.items())
+  parameters = dict(parameters, integrator=integrator, integrator_state=None, parallel_state=None)
+
+  # The Hermite integrators only sum their own forces directly.
+  integrator_state = n_body_integrators.make_integrator(parameters)
+  if hasattr(integrator_state, 'check_parameters'):
+    try:
+      integrator_state.check_parameters(parameters)
+    except ValueError:
+      return None
+
+  try:
+    # Forces are reused between steps where the integrator allows, so this is the cost of a step
+    # once the simulation is running.
+    step_seconds, step_spread = best_time(lambda: n_body_physics.update_system(particles, parameters))
+
+  finally:
+    if parameters.get('parallel_state') is not None:
+      parameters['parallel_state'].close()
+
+  return {
+    'step_seconds' : step_seconds,
+    'step_spread_seconds' : step_spread,
+    'steps_per_second' : 1./step_seconds,
+  }
+
+########################################################################
+
+def default_integrators():
+  '''The names in n_body_integrators.INTEGRATORS, leaving out other names for the same integrator.'''
+
+  names = []
+  for name, integrator_class in n_body_integrators.INTEGRATORS.items():
+    if integrator_class not in [n_body_integrators.INTEGRATORS[other] for other in names]:
+      names.append(name)
+
+  return names
+
+########################################################################
+
+def run(backends, particle_numbers, dimensions, max_seconds, integrators=None):
+  '''Measure every backend, size and dimension, skipping the runs that would take too long.'''
+
+  results = []
+
+  for backend in backends:
+    for n_dimensions in dimensions:
+
+      previous = None
+      for n_particles in sorted(particle_numbers):
+
+        if previous is not None:
+          predicted = previous['force_seconds']*SCALING[backend](n_particles)/SCALING[backend](previous['n_particles'])
+          if predicted*(MAX_REPEATS + 2) > max_seconds and predicted > max_seconds/10.:
+            print('{:>14} N={:<7} D={}  skipped, predicted {:.1f} s per call'.format(backend, n_particles, n_dimensions, predicted))
+            continue
+
+        try:
+          result = measure(backend, n_particles, n_dimensions, integrators)
+        except ValueError as error:
+          print('{:>14} N={:<7} D={}  skipped, {}'.format(backend, n_particles, n_dimensions, error))
+          break
+
+        results.append(result)
+        previous = result
+
+        memory = result['peak_memory_bytes']
+        print('{:>14} N={:<7} D={}  {:10.3e} s/forces {:10.3e} pairs/s {:>8} MB'.format(
+          backend, n_particles, n_dimensions, result['force_seconds'], result['pair_interactions_per_second'],
+          '-' if memory is None else '{:.1f}'.format(memory/2.**20)))
+
+        for integrator, step in result['integrators'].items():
+          print('{:>40}  {:10.3f} steps/s'.format(integrator, step['steps_per_second']))
+
+  return results
+
+########################################################################
+
+def find_regressions(results, baseline, threshold):
+  '''Compare results with a baseline run.
+
+  Args:
+  results -- List of results from run()
+  baseline -- List of results from an earlier run
+  threshold -- The fractional slowdown, or memory increase, that counts as a regression. A slowdown
+    also has to be bigger than the spreads of both timings.
+
+  Returns:
+  regressions -- List of descriptions of each regression
+  '''
+
+  def key(result):
+    return result['backend'], result['n_particles'], result['n_dimensions']
+
+  baseline = dict((key(result), result) for result in baseline)
+
+  regressions = []
+  for result in results:
+
+    old = baseline.get(key(result))
+    if old is None:
+      continue
+
+    # The forces, then each integrator's steps
+    comparisons = [('force_seconds', result, old), ('peak_memory_bytes', result, old)]
+    old_steps = _integrator_steps(old)
+    for integrator, step in _integrator_steps(result).items():
+      if integrator in old_steps:
+        comparisons.append(('{} step_seconds'.format(integrator), step, old_steps[integrator]))
+
+    for name, new_values, old_values in comparisons:
+
+      quantity = name.split()[-1]
+
+      # Memory isn't measured for every backend.
+      if new_values.get(quantity) is None or old_values.get(quantity) is None:
+        continue
+
+      allowed = (1. + threshold)*old_values[quantity]
+
+      if quantity.endswith('seconds'):
+        if new_values[quantity] < MIN_COMPARABLE_SECONDS:
+          continue
+
+        # Older results files have no spreads.
+        spread = quantity.replace('seconds', 'spread_seconds')
+        allowed += old_values.get(spread, 0.) + new_values.get(spread, 0.)
+
+      if new_values[quantity] > allowed:
+        regressions.append('{} N={} D={}: {} went from {:.4g} to {:.4g} ({:+.0%})'.format(
+          result['backend'], result['n_particles'], result['n_dimensions'], name,
+          old_values[quantity], new_values[quantity], new_values[quantity]/old_values[quantity] - 1.))
+
+  return regressions
+
+########################################################################
+
+def _integrator_steps(result):
+  '''The step timings of each integrator in a result. Older results files only timed the leapfrog.'''
+
+  if 'integrators' in result:
+    return result['integrators']
+
+  if 'step_seconds' in result:
+    return {'leapfrog' : result}
+
+  return {}
+
+########################################################################
+
+def describe_machine():
+  '''Enough about where the benchmark ran to tell whether two results files are comparable.'''
+
+  return {
+    'platform' : platform.platform(),
+    'processor' : platform.processor(),
+    'cpu_count' : os.cpu_count(),
+    'python' : platform.python_version(),
+    'numpy' : np.__version__,
+    'numba' : n_body_numba.numba.__version__ if n_body_numba.NUMBA_AVAILABLE else None,
+  }
+
+########################################################################
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--backends', nargs='+', choices=sorted(BACKENDS), default=None)
+  parser.add_argument('--n', nargs='+', type=int, default=PARTICLE_NUMBERS, help='Numbers of particles')
+  parser.add_argument('--dimensions', nargs='+', type=int, default=DIMENSIONS)
+  parser.add_argument('--integrators', nargs='+', choices=sorted(n_body_integrators.INTEGRATORS), default=None)
+  parser.add_argument('--quick', action='store_true', help='Only go up to N = 1000')
+  parser.add_argument('--max-seconds', type=float, default=60., help='Skip runs predicted to take longer than this')
+  parser.add_argument('--output', default='benchmark_results.json')
+  parser.add_argument('--baseline', help='Results file to check for regressions against')
+  parser.add_argument('--threshold', type=float, default=0.2, help='Fractional slowdown that counts as a regression')
+  arguments = parser.parse_args()
+
+  backends = arguments.backends
+  if backends is None:
+    backends = [backend for backend in BACKENDS if n_body_numba.NUMBA_AVAILABLE or backend != 'direct_numba']
+
+  particle_numbers = arguments.n
+  if arguments.quick:
+    particle_numbers = [n for n in particle_numbers if n <= 1000]
+
+  results = run(backends, particle_numbers, arguments.dimensions, arguments.max_seconds, arguments.integrators)
+
+  with open(arguments.output, 'w') as f:
+    json.dump({'machine' : describe_machine(), 'results' : results}, f, indent=2)
+
+  if arguments.baseline:
+    with open(arguments.baseline) as f:
+      baseline = json.load(f)
+
+    if baseline['machine'] != describe_machine():
+      print('Warning: the baseline was run on a different machine or software versions.')
+
+    regressions = find_regressions(results, baseline['results'], arguments.threshold)
+    for regression in regressions:
+      print('REGRESSION: ' + regression)
+
+    if regressions:
+      sys.exit(1)
@@ -0,0 +1,144 @@
+'''Compare the integrators by how many force evaluations they need to reach a given energy error.
+
+Each integrator is run on the same small planetary system over a range of timesteps (or, for the
+adaptive integrator, a range of tolerances). For each run the worst relative energy error seen and
+the number of force evaluations are recorded, and the number of evaluations needed to reach each
+target error is interpolated from them.
+
+Usage:
+python benchmarks/integrator_accuracy.py [results.json]
+'''
+
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import n_body_physics
+
+# How many steps to split the run into
+STEP_COUNTS = [25, 50, 100, 200, 400, 800]
+
+# The runs for each integrator, as (number of steps, extra parameters)
+SWEEPS = {
+  'leapfrog' : [(n_steps, {}) for n_steps in STEP_COUNTS],
+  'hermite' : [(n_steps, {}) for n_steps in STEP_COUNTS],
+  'forest_ruth' : [(n_steps, {}) for n_steps in STEP_COUNTS],
+  'yoshida6' : [(n_steps, {}) for n_steps in STEP_COUNTS],
+  'dormand_prince' : [(25, {'tolerance' : tolerance}) for tolerance in [1.e-5, 1.e-6, 1.e-7, 1.e-8, 1.e-9, 1.e-10, 1.e-11]],
+}
+
+# Energy errors to report the cost of reaching
+TARGET_ERRORS = [1.e-4, 1.e-6, 1.e-8, 1.e-10]
+
+########################################################################
+
+def make_planetary_system():
+  '''A star with three planets on mildly eccentric orbits, in units where G = 1.'''
+
+  semi_major_axes = np.array([1., 1.6, 2.5])
+  eccentricities = np.array([0.1, 0.05, 0.2])
+
+  particles = {}
+  particles['masses'] = np.array([1., 1.e-3, 3.e-4, 5.e-4])
+  particles['positions'] = np.zeros((4, 2))
+  particles['velocities'] = np.zeros((4, 2))
+
+  # Start each planet at pericenter.
+  pericenters = semi_major_axes*(1. - eccentricities)
+  particles['positions'][1:, 0] = pericenters
+  particles['velocities'][1:, 1] = np.sqrt((1. + eccentricities)/pericenters)
+
+  # Move to the center of mass frame.
+  for key in ['positions', 'velocities']:
+    particles[key] -= (particles['masses'][:, np.newaxis]*particles[key]).sum(axis=0)/particles['masses'].sum()
+
+  return particles
+
+########################################################################
+
+def measure(name, extra_parameters, n_steps, duration=20.):
+  '''Run one integrator, returning the worst relative energy error and the force evaluations used.'''
+
+  particles = make_planetary_system()
+
+  parameters = {'G' : 1.,
+                'dt' : duration/n_steps,
+                'integrator' : name,
+               }
+  parameters.update(extra_parameters)
+
+  initial_energy = n_body_physics.calculate_total_energy(particles, parameters)
+
+  worst_error = 0.
+  for step in range(n_steps):
+    n_body_physics.update_system(particles, parameters)
+
+    energy = n_body_physics.calculate_total_energy(particles, parameters)
+    worst_error = max(worst_error, abs((energy - initial_energy)/initial_energy))
+
+  return worst_error, parameters['integrator_state'].n_force_evaluations
+
+########################################################################
+
+def evaluations_needed(errors, evaluations, target_error):
+  '''Interpolate, in log space, how many force evaluations reach target_error. None if no run did.'''
+
+  errors = np.asarray(errors)
+  evaluations = np.asarray(evaluations, dtype=float)
+
+  if not (errors <= target_error).any():
+    return None
+
+  if errors[0] <= target_error:
+    return float(evaluations[0])
+
+  # The first run to get below the target, and the one before it
+  i = np.flatnonzero(errors <= target_error)[0]
+  fraction = np.log(target_error/errors[i - 1])/np.log(errors[i]/errors[i - 1])
+
+  return float(np.exp(np.log(evaluations[i - 1]) + fraction*np.log(evaluations[i]/evaluations[i - 1])))
+
+########################################################################
+
+def run():
+  '''Measure every integrator and print a table.'''
+
+  results = {}
+
+  for name, sweep in SWEEPS.items():
+    runs = [measure(name, extra_parameters, n_steps) for n_steps, extra_parameters in sweep]
+    runs.sort(key=lambda run: run[1])
+    errors = [run[0] for run in runs]
+    evaluations = [run[1] for run in runs]
+
+    results[name] = {
+      'energy_errors' : errors,
+      'force_evaluations' : evaluations,
+      'evaluations_needed' : dict((str(target), evaluations_needed(errors, evaluations, target)) for target in TARGET_ERRORS),
+    }
+
+  header = '{:>16}'.format('integrator') + ''.join('{:>14}'.format('dE/E={:.0e}'.format(target)) for target in TARGET_ERRORS)
+  print('Force evaluations needed to keep the energy error below each target')
+  print(header)
+  for name, result in results.items():
+    cells = []
+    for target in TARGET_ERRORS:
+      needed = result['evaluations_needed'][str(target)]
+      cells.append('{:>14}'.format('-' if needed is None else '{:.0f}'.format(needed)))
+    print('{:>16}'.format(name) + ''.join(cells))
+
+  return results
+
+########################################################################
+
+if __name__ == '__main__':
+
+  results = run()
+
+  if len(sys.argv) > 1:
+    with open(sys.argv[1], 'w') as f:
+      json.dump(results, f, indent=2)
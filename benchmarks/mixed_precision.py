@@ -0,0 +1,105 @@
+'''Measure the accuracy and speed of the mixed precision direct forces against the float64 direct sum.
+
+For each particle distribution and number of particles N this prints
+  mixed -- The median, 99th percentile and largest relative force error of n_body_precision
+  naive float32 -- The same, with the positions simply cast to float32
+  speedup -- How much faster the mixed precision forces are than the float64 tiled direct sum
+and writes the table to a JSON file.
+
+The distributions are a uniform cube, a Plummer sphere (centrally concentrated, so with many close
+pairs), and the same Plummer sphere moved 10^6 scale radii from the origin, where plain float32
+coordinates can no longer tell nearby particles apart. Pairs that float32 puts at the same position
+give no force, like a particle and itself, so their errors are large but finite.
+
+Usage:
+python benchmarks/mixed_precision.py [--n 1000 4000] [--output mixed_precision.json]
+'''
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import n_body_physics
+import n_body_precision
+import n_body_setup
+
+from force_backends import best_time
+
+PARTICLE_NUMBERS = [1000, 4000, 16000]
+
+########################################################################
+
+def make_distribution(name, n_particles, seed=0):
+  '''Particles in one of the distributions: 'uniform', 'plummer' or 'offset_plummer'.'''
+
+  rng = np.random.default_rng(seed)
+
+  if name == 'uniform':
+    return {'masses' : rng.uniform(1., 2., n_particles), 'positions' : rng.uniform(-1., 1., (n_particles, 3)),
+            'velocities' : np.zeros((n_particles, 3))}
+
+  particles = n_body_setup.sample_plummer_sphere(n_particles, rng)
+
+  if name == 'offset_plummer':
+    particles['positions'] += 1.e6
+
+  return particles
+
+DISTRIBUTIONS = ['uniform', 'plummer', 'offset_plummer']
+
+########################################################################
+
+def measure(distribution, n_particles, softening=0.):
+  '''The errors and speedup for one distribution and size.'''
+
+  particles = make_distribution(distribution, n_particles)
+  parameters = {'G' : 1., 'softening' : softening}
+
+  mixed = n_body_precision.compare_with_float64(particles, parameters)
+  naive = n_body_precision.compare_with_float64(particles, parameters, naive=True)
+
+  float64_seconds, float64_spread = best_time(lambda: n_body_physics.calculate_direct_forces(
+    particles, dict(parameters, use_numba=False, tile_size=n_body_precision.DEFAULT_CELL_SIZE)))
+  mixed_seconds, mixed_spread = best_time(lambda: n_body_physics.calculate_direct_forces(particles, dict(parameters, mixed_precision=True)))
+
+  return {
+    'distribution' : distribution,
+    'n_particles' : n_particles,
+    'softening' : softening,
+    'mixed' : mixed,
+    'naive_float32' : naive,
+    'float64_seconds' : float64_seconds,
+    'mixed_seconds' : mixed_seconds,
+  }
+
+########################################################################
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--n', nargs='+', type=int, default=PARTICLE_NUMBERS, help='Numbers of particles')
+  parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=DISTRIBUTIONS)
+  parser.add_argument('--softening', type=float, default=0.)
+  parser.add_argument('--output', default='mixed_precision.json')
+  arguments = parser.parse_args()
+
+  print('{:>15}{:>8}  {:>29}  {:>29}{:>9}'.format('', '', 'mixed: median / 99% / max', 'naive float32: median / max', 'speedup'))
+
+  results = []
+  for distribution in arguments.distributions:
+    for n_particles in arguments.n:
+
+      result = measure(distribution, n_particles, arguments.softening)
+      results.append(result)
+
+      print('{:>15}{:>8}  {:>9.2e} {:>9.2e} {:>9.2e}  {:>14.2e} {:>14.2e}{:>8.2f}x'.format(
+        distribution, n_particles, result['mixed']['median'], result['mixed']['99th_percentile'], result['mixed']['max'],
+        result['naive_float32']['median'], result['naive_float32']['max'], result['float64_seconds']/result['mixed_seconds']))
+
+  with open(arguments.output, 'w') as f:
+    json.dump(results, f, indent=2)
@@ -22,7 +22,9 @@ Doc strings
 '''
 
 import n_body_physics
+import n_body_checkpoint
 import n_body_data_handling
+import n_body_profiling
 import n_body_setup
 import n_body_wrapup
 
@@ -33,14 +35,48 @@ def run():
 
   particles, parameters = n_body_setup.load_settings()
 
-  while not parameters['finished']:
+  # Carry on from the last checkpoint, if asked to. Its output is already on disk up to its step.
+  restart = parameters.get('restart', False)
+  if restart:
+    particles, parameters = n_body_checkpoint.load_checkpoint(parameters.get('checkpoint_file', n_body_checkpoint.DEFAULT_FILENAME))
 
-    n_body_physics.update_system(particles, parameters)
+  # Does nothing unless parameters['profile'] is set.
+  profiler = n_body_profiling.get_profiler(parameters)
 
-    n_body_data_handling.save_data(particles, parameters)
- 
+  try:
+    # The initial conditions, as step 0
+    if not restart:
+      parameters.setdefault('step', 0)
+      parameters.setdefault('time', 0.)
+      n_body_data_handling.save_data(particles, parameters)
+
+    # Measures the starting diagnostics, and stops straight away if there is nothing to do.
     n_body_wrapup.check_if_finished(particles, parameters)
 
+    while not parameters['finished']:
+
+      profiler.start_step(parameters.get('step', 0) + 1)
+
+      with profiler.phase('update_system'):
+        n_body_physics.update_system(particles, parameters)
+
+      with profiler.phase('save_data'):
+        n_body_data_handling.save_data(particles, parameters)
+
+      with profiler.phase('checkpoint'):
+        n_body_checkpoint.maybe_save_checkpoint(particles, parameters)
+ 
+      with profiler.phase('check_if_finished'):
+        n_body_wrapup.check_if_finished(particles, parameters)
+
+      profiler.end_step(parameters.get('step', 0))
+
+  finally:
+    # Write out whatever output is still buffered.
+    n_body_data_handling.close_data(parameters)
+
+    profiler.close()
+
 ########################################################################
 
 # What happens when the simulation is called from the command line.
@@ -0,0 +1,271 @@
+'''
+Checkpoints, for restarting a simulation exactly where it left off.
+
+A checkpoint is a single binary file:
+  8 bytes -- b'NBODYCKP'
+  8 bytes -- The length of the header, as a little-endian unsigned integer
+  header -- JSON holding the parameters, the random number generator state, and where each array is
+  arrays -- The raw array data, each array starting on a 64 byte boundary
+
+so the arrays can be memory-mapped straight out of the file when it is loaded.
+
+Buffered snapshots are written out before each checkpoint, so the output on disk always covers every
+step up to the checkpoint and a restarted simulation carries on from it without a gap.
+'''
+
+import json
+import os
+import struct
+
+import numpy as np
+
+import n_body_data_handling
+import n_body_integrators
+import n_body_particles
+import n_body_profiling
+
+MAGIC = b'NBODYCKP'
+
+# Arrays start on multiples of this many bytes.
+ALIGNMENT = 64
+
+DEFAULT_FILENAME = 'checkpoint.nbody'
+
+########################################################################
+
+def maybe_save_checkpoint(particles, parameters):
+  '''Save a checkpoint every parameters['checkpoint_every'] steps, if it is set.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  '''
+
+  checkpoint_every = parameters.get('checkpoint_every')
+
+  if checkpoint_every and parameters.get('step', 0) % checkpoint_every == 0:
+    n_bytes = save_checkpoint(particles, parameters)
+    n_body_profiling.get_profiler(parameters).count('bytes_written', n_bytes)
+
+########################################################################
+
+def save_checkpoint(particles, parameters, filename=None):
+  '''Save everything needed to restart the simulation: the particles, the parameters (including the
+  step and time), the integrator's cached accelerations and the random number generator states.
+
+  The checkpoint is written to a temporary file that then replaces the old checkpoint, so there is
+  always a complete checkpoint on disk even if the simulation is killed part way through. Any
+  buffered snapshots are written first.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  filename -- Where to save the checkpoint. Defaults to parameters['checkpoint_file'], or
+    checkpoint.nbody.
+
+  Returns:
+  n_bytes -- The size of the checkpoint
+  '''
+
+  if filename is None:
+    filename = parameters.get('checkpoint_file', DEFAULT_FILENAME)
+
+  n_body_data_handling.flush_data(parameters)
+
+  header = {
+    'version' : 1,
+    'particle_set' : isinstance(particles, n_body_particles.ParticleSet),
+    'parameters' : _saveable_parameters(parameters),
+  }
+
+  arrays = {}
+  for key in particles:
+    arrays['particles/' + key] = particles[key]
+
+  integrator = parameters.get('integrator_state')
+  if integrator is not None:
+    header['integrator'] = {'class' : type(integrator).__name__, 'values' : {}}
+    for key, value in integrator.get_state(particles, parameters).items():
+      if isinstance(value, np.ndarray):
+        arrays['integrator/' + key] = value
+      else:
+        header['integrator']['values'][key] = value
+
+  # Both the simulation's own generator and NumPy's global one
+  if isinstance(parameters.get('rng'), np.random.Generator):
+    header['rng'] = _json_safe(parameters['rng'].bit_generator.state)
+  name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+  header['global_rng'] = [name, int(position), int(has_gauss), float(cached_gaussian)]
+  arrays['global_rng/keys'] = keys
+
+  return write_arrays(filename, header, arrays)
+
+########################################################################
+
+def load_checkpoint(filename=DEFAULT_FILENAME):
+  '''Load a checkpoint saved by save_checkpoint().
+
+  Args:
+  filename -- The checkpoint to load
+
+  Returns:
+  particles -- The particle information
+  parameters -- The simulation parameter information, including a restored 'integrator_state'
+  '''
+
+  header, arrays = read_arrays(filename)
+
+  particle_arrays = _arrays_under(arrays, 'particles/')
+  if header['particle_set']:
+    particles = n_body_particles.ParticleSet.from_dict(particle_arrays)
+  else:
+    particles = dict((key, np.array(value)) for key, value in particle_arrays.items())
+
+  parameters = header['parameters']
+
+  if 'integrator' in header:
+    integrator = getattr(n_body_integrators, header['integrator']['class'])()
+
+    state = _arrays_under(arrays, 'integrator/')
+    state.update(header['integrator']['values'])
+    integrator.set_state(state, particles, parameters)
+
+    parameters['integrator_state'] = integrator
+
+  if 'rng' in header:
+    bit_generator = getattr(np.random, header['rng']['bit_generator'])()
+    bit_generator.state = header['rng']
+    parameters['rng'] = np.random.Generator(bit_generator)
+
+  name, position, has_gauss, cached_gaussian = header['global_rng']
+  np.random.set_state((name, np.array(arrays['global_rng/keys']), position, has_gauss, cached_gaussian))
+
+  return particles, parameters
+
+########################################################################
+
+def write_arrays(filename, header, arrays):
+  '''Write a header and some named arrays in the checkpoint format. The file is written to a
+  temporary file that then replaces filename, so filename is never left half written.
+
+  Args:
+  filename -- Where to write the file
+  header -- Dictionary of anything that can be saved as JSON. Gets an 'arrays' entry saying where
+    each array is.
+  arrays -- Dictionary of the arrays to write
+
+  Returns:
+  n_bytes -- The size of the file
+  '''
+
+  # Lay out the arrays after the header.
+  header['arrays'] = {}
+  offset = 0
+  for key, value in arrays.items():
+    value = np.ascontiguousarray(value)
+    arrays[key] = value
+    header['arrays'][key] = {'dtype' : value.dtype.str, 'shape' : list(value.shape), 'offset' : offset}
+    offset = _align(offset + value.nbytes)
+
+  header_bytes = json.dumps(header).encode('utf-8')
+  data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+  temporary_filename = filename + '.tmp'
+  with open(temporary_filename, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header_bytes)))
+    f.write(header_bytes)
+
+    for key, value in arrays.items():
+      f.seek(data_start + header['arrays'][key]['offset'])
+      f.write(value.tobytes())
+
+    n_bytes = f.tell()
+    f.flush()
+    os.fsync(f.fileno())
+
+  os.replace(temporary_filename, filename)
+
+  return n_bytes
+
+########################################################################
+
+def read_arrays(filename):
+  '''Read a file written by write_arrays(), memory-mapping the arrays out of it.
+
+  Args:
+  filename -- The file to read
+
+  Returns:
+  header -- The header
+  arrays -- Dictionary of read-only arrays
+  '''
+
+  with open(filename, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise IOError('{} is not a checkpoint.'.format(filename))
+    header_length = struct.unpack('<Q', f.read(8))[0]
+    header = json.loads(f.read(header_length).decode('utf-8'))
+
+  data_start = _align(len(MAGIC) + 8 + header_length)
+
+  # Map each array straight out of the file.
+  arrays = {}
+  for key, layout in header['arrays'].items():
+    shape = tuple(layout['shape'])
+    if np.prod(shape) == 0:
+      arrays[key] = np.zeros(shape, dtype=layout['dtype'])
+    else:
+      arrays[key] = np.memmap(filename, dtype=layout['dtype'], mode='r', offset=data_start + layout['offset'], shape=shape)
+
+  return header, arrays
+
+########################################################################
+
+def _saveable_parameters(parameters):
+  '''The parameters that can be saved as JSON, leaving out objects such as the integrator.'''
+
+  saveable = {}
+  for key, value in parameters.items():
+
+    if key.endswith('_state') or key == 'rng':
+      continue
+
+    if isinstance(value, np.generic):
+      value = value.item()
+
+    try:
+      json.dumps(value)
+    except (TypeError, ValueError):
+      continue
+
+    saveable[key] = value
+
+  return saveable
+
+########################################################################
+
+def _json_safe(value):
+  '''Turn the arrays and NumPy scalars in value, e.g. a bit generator's state, into lists and numbers.'''
+
+  if isinstance(value, dict):
+    return dict((key, _json_safe(item)) for key, item in value.items())
+
+  if isinstance(value, (np.ndarray, np.generic)):
+    return value.tolist()
+
+  return value
+
+########################################################################
+
+def _arrays_under(arrays, prefix):
+  '''The arrays whose names start with prefix, without the prefix.'''
+
+  return dict((key[len(prefix):], value) for key, value in arrays.items() if key.startswith(prefix))
+
+########################################################################
+
+def _align(offset):
+  '''Round offset up to a multiple of ALIGNMENT.'''
+
+  return -(-offset//ALIGNMENT)*ALIGNMENT
@@ -0,0 +1,220 @@
+'''
+Collisions: bodies that touch are merged into one.
+
+Turned on by parameters['collisions'] = True, with each body's radius in particles['radii'], and
+checked at the end of every step by n_body_physics.update_system(). Two bodies collide when they are
+closer than the sum of their radii. The candidate pairs are found with the cell list in
+n_body_neighbours, with cells as wide as the largest possible overlap, and then checked against
+their own radii. Bodies that touch, directly or through a chain of others, are merged into a single
+body that keeps the lowest index of the group and has
+  mass -- the total mass
+  position -- the centre of mass
+  velocity -- the centre of mass velocity, so momentum is conserved
+  radius -- (sum of r^n_dimensions)^(1/n_dimensions), the radius of the combined volume
+Any other per-particle fields keep the surviving body's values. The merger is inelastic, so the
+kinetic energy of the bodies' relative motion is lost, and the energy drift in n_body_diagnostics
+will jump.
+
+The rest of the bodies are moved down over the merged ones, in place: a ParticleSet with
+ParticleSet.remove(), and the arrays of a plain particle dictionary by moving the rows down and
+keeping a view of the first n_particles rows, so their memory is never reallocated.
+'''
+
+import numpy as np
+
+import n_body_neighbours
+import n_body_profiling
+
+########################################################################
+
+def merge_collisions(particles, parameters):
+  '''Merge every group of bodies that are touching, if parameters['collisions'] is set.
+
+  Args:
+  particles -- The particle information, including 'radii'
+  parameters -- The simulation parameter information. Uses 'box_size' if it is given.
+
+  Returns:
+  n_merged -- How many bodies were merged away
+  '''
+
+  if not parameters.get('collisions'):
+    return 0
+
+  profiler = n_body_profiling.get_profiler(parameters)
+
+  with profiler.phase('collisions'):
+
+    if 'radii' not in particles:
+      raise ValueError("Collisions need the radius of each body in particles['radii'].")
+
+    box_size = parameters.get('box_size')
+
+    pairs = find_collisions(particles['positions'], particles['radii'], box_size)
+    if len(pairs) == 0:
+      return 0
+
+    groups = find_groups(len(particles['masses']), pairs)
+    n_merged = merge_groups(particles, groups, box_size)
+
+  # The integrator's cached forces are for the bodies before the merger.
+  if parameters.get('integrator_state') is not None:
+    parameters['integrator_state'].invalidate()
+
+  parameters['n_merged'] = parameters.get('n_merged', 0) + n_merged
+  profiler.count('merged', n_merged)
+
+  return n_merged
+
+########################################################################
+
+def find_collisions(positions, radii, box_size=None):
+  '''Find every pair of bodies that are closer than the sum of their radii.
+
+  Args:
+  positions -- Array of body positions, shape (n_particles, n_dimensions)
+  radii -- Array of body radii, shape (n_particles,)
+  box_size -- Side length of the periodic box, or None for open boundaries
+
+  Returns:
+  pairs -- Array of body indices (i, j) with i < j, shape (n_pairs, 2)
+  '''
+
+  positions = np.asarray(positions, dtype=float)
+  radii = np.asarray(radii, dtype=float)
+
+  if radii.size == 0 or radii.max() <= 0.:
+    return np.zeros((0, 2), dtype=np.int64)
+
+  # Broad phase: every pair that the two largest bodies could touch across
+  candidates = n_body_neighbours.find_pairs(positions, 2.*radii.max(), box_size)
+  i, j = candidates[:, 0], candidates[:, 1]
+
+  # Narrow phase
+  displacements = positions[j] - positions[i]
+  if box_size is not None:
+    n_body_neighbours.get_nearest_images(displacements, box_size)
+
+  touching = (displacements**2.).sum(axis=1) < (radii[i] + radii[j])**2.
+
+  return candidates[touching]
+
+########################################################################
+
+def find_groups(n_particles, pairs):
+  '''Find the groups of bodies joined by pairs, directly or through others.
+
+  Each body starts in its own group, and every pair pulls both of its bodies into the group with the
+  lower label, with the labels of labels followed until nothing changes.
+
+  Args:
+  n_particles -- Number of bodies
+  pairs -- Array of body indices, shape (n_pairs, 2)
+
+  Returns:
+  groups -- Array of the lowest index in each body's group, shape (n_particles,)
+  '''
+
+  groups = np.arange(n_particles)
+  i, j = pairs[:, 0], pairs[:, 1]
+
+  while True:
+    previous = groups.copy()
+
+    np.minimum.at(groups, i, groups[j])
+    np.minimum.at(groups, j, groups[i])
+    groups = groups[groups]
+
+    if np.array_equal(groups, previous):
+      return groups
+
+########################################################################
+
+def merge_groups(particles, groups, box_size=None):
+  '''Merge each group of bodies into its lowest indexed body, conserving mass and momentum, and
+  remove the others in place.
+
+  Args:
+  particles -- The particle information, including 'radii'
+  groups -- Array of the lowest index in each body's group, shape (n_particles,)
+  box_size -- Side length of the periodic box, or None for open boundaries
+
+  Returns:
+  n_merged -- How many bodies were removed
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+  velocities = np.asarray(particles['velocities'], dtype=float)
+  radii = np.asarray(particles['radii'], dtype=float)
+
+  n_particles, n_dimensions = positions.shape
+
+  merged = groups != np.arange(n_particles)
+  survivors = np.unique(groups[merged])
+
+  total_masses = np.bincount(groups, masses, minlength=n_particles)[survivors]
+
+  # Each body's position relative to its group's survivor, so a group is kept together across the
+  # edge of a periodic box.
+  offsets = positions - positions[groups]
+  if box_size is not None:
+    n_body_neighbours.get_nearest_images(offsets, box_size)
+
+  new_positions = positions[survivors].copy()
+  new_velocities = velocities[survivors].copy()
+
+  # Bodies with no mass don't move the centre of mass, and a group with no mass stays where the
+  # survivor is.
+  has_mass = total_masses > 0.
+  for d in range(n_dimensions):
+    shift = np.bincount(groups, masses*offsets[:, d], minlength=n_particles)[survivors]
+    new_positions[has_mass, d] += shift[has_mass]/total_masses[has_mass]
+
+    momentum = np.bincount(groups, masses*velocities[:, d], minlength=n_particles)[survivors]
+    new_velocities[has_mass, d] = momentum[has_mass]/total_masses[has_mass]
+
+  if box_size is not None:
+    np.mod(new_positions, box_size, out=new_positions)
+
+  volumes = np.bincount(groups, radii**n_dimensions, minlength=n_particles)[survivors]
+
+  # Write the merged bodies over their survivors, then remove the rest.
+  if isinstance(particles, dict):
+    particles['masses'][survivors] = total_masses
+  else:
+    new_masses = np.array(particles['masses'], copy=True)
+    new_masses[survivors] = total_masses
+    particles['masses'] = new_masses
+
+  particles['positions'][survivors] = new_positions
+  particles['velocities'][survivors] = new_velocities
+  particles['radii'][survivors] = volumes**(1./n_dimensions)
+
+  remove_particles(particles, merged)
+
+  return np.count_nonzero(merged)
+
+########################################################################
+
+def remove_particles(particles, removed):
+  '''Remove particles in place, keeping the order of the rest.
+
+  Args:
+  particles -- The particle information: a ParticleSet, or a dictionary whose per-particle arrays
+    are compacted into their own memory
+  removed -- Boolean mask of the particles to remove, shape (n_particles,)
+  '''
+
+  if not isinstance(particles, dict):
+    particles.remove(removed)
+    return
+
+  n_particles = len(removed)
+  keep = ~removed
+  n_keep = np.count_nonzero(keep)
+
+  for key, value in list(particles.items()):
+    if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == n_particles:
+      value[:n_keep] = value[keep]
+      particles[key] = value[:n_keep]
@@ -0,0 +1,527 @@
+'''
+Saving and loading the simulation output.
+
+Snapshots are buffered in memory and written in large blocks, one .npy file per field per block,
+together with an index.json describing the blocks. For example, with the default settings:
+
+  output/index.json
+  output/positions_000000.npy     (snapshots 0 to 63, shape (64, n_particles, n_dimensions))
+  output/velocities_000000.npy
+  output/steps_000000.npy
+  output/times_000000.npy
+  output/positions_000001.npy     (snapshots 64 to 127)
+  ...
+
+Saved output is read back with load_trajectory(), which memory-maps the blocks so that only the
+snapshots and particles that are asked for are read from disk.
+'''
+
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+import n_body_profiling
+
+# Default number of snapshots held in memory before they are written.
+DEFAULT_CHUNK_SIZE = 64
+
+# Default per-particle fields to save.
+DEFAULT_FIELDS = ('positions', 'velocities')
+
+# Default number of blocks of snapshots that can be in memory at once when writing in the background.
+DEFAULT_N_BUFFERS = 2
+
+########################################################################
+
+def save_data(particles, parameters):
+  '''Save a snapshot, if one is due.
+
+  The writer is kept in parameters['writer_state']. Uses these parameters if they are given:
+  'output_dir' -- Where to save the output. Defaults to 'output'.
+  'output_every' -- Save every this many steps. Defaults to 1.
+  'output_chunk_size' -- Snapshots per block written to disk. Defaults to 64.
+  'output_float32' -- If True, save positions and velocities as float32. Defaults to False.
+  'output_fields' -- Which per-particle fields to save. Defaults to positions and velocities.
+  'output_async' -- If True, write blocks from a background thread. Defaults to False.
+  'output_buffers' -- How many blocks can be in memory at once when writing in the background.
+    Defaults to 2.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  '''
+
+  writer = parameters.get('writer_state')
+  if writer is None:
+    writer = make_writer(parameters)
+    parameters['writer_state'] = writer
+
+  writer.n_calls += 1
+
+  # Counts calls if the step isn't being tracked in parameters.
+  step = parameters.get('step', writer.n_calls - 1)
+
+  if step % parameters.get('output_every', 1) == 0:
+    writer.write(particles, step, parameters.get('time', np.nan))
+
+########################################################################
+
+def flush_data(parameters):
+  '''Write any buffered snapshots and wait until they are on disk, e.g. before saving a checkpoint.
+
+  Args:
+  parameters -- The simulation parameter information
+  '''
+
+  writer = parameters.get('writer_state')
+  if writer is not None:
+    writer.sync()
+
+########################################################################
+
+def close_data(parameters):
+  '''Write any buffered snapshots. Call this once the simulation is finished.
+
+  Args:
+  parameters -- The simulation parameter information
+  '''
+
+  writer = parameters.get('writer_state')
+  if writer is not None:
+    writer.close()
+
+########################################################################
+
+def make_writer(parameters):
+  '''Make a snapshot writer from the output settings in parameters.
+
+  Args:
+  parameters -- The simulation parameter information
+  '''
+
+  dtype = np.float32 if parameters.get('output_float32', False) else np.float64
+
+  kwargs = {
+    'chunk_size' : parameters.get('output_chunk_size', DEFAULT_CHUNK_SIZE),
+    'dtype' : dtype,
+    'fields' : parameters.get('output_fields', DEFAULT_FIELDS),
+    'profiler' : n_body_profiling.get_profiler(parameters),
+  }
+
+  # Output from earlier steps is kept, so a restarted simulation carries on from it.
+  if 'step' in parameters:
+    kwargs['resume_step'] = parameters['step']
+
+  if parameters.get('output_async', False):
+    return AsyncSnapshotWriter(parameters.get('output_dir', 'output'), n_buffers=parameters.get('output_buffers', DEFAULT_N_BUFFERS), **kwargs)
+
+  return SnapshotWriter(parameters.get('output_dir', 'output'), **kwargs)
+
+########################################################################
+
+class SnapshotWriter(object):
+  '''Buffers snapshots in preallocated arrays and writes them in blocks.'''
+
+  def __init__(self, output_dir, chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64, fields=DEFAULT_FIELDS, resume_step=None,
+               profiler=n_body_profiling.NULL_PROFILER):
+    '''
+    Args:
+    output_dir -- Where to save the output
+    chunk_size -- Snapshots per block
+    dtype -- Data type the fields are saved as
+    fields -- Which per-particle fields to save
+    resume_step -- If given, keep any existing output from before this step, and add to it.
+    profiler -- Counts the 'bytes_written' as each block reaches the disk
+    '''
+
+    self.output_dir = output_dir
+    self.chunk_size = chunk_size
+    self.dtype = np.dtype(dtype)
+    self.fields = tuple(fields)
+    self.profiler = profiler
+
+    self.n_calls = 0
+    self.n_buffered = 0
+    self.buffers = None
+    self.shape = None
+    self.chunks = []
+
+    if not os.path.exists(output_dir):
+      os.makedirs(output_dir)
+
+    if resume_step is not None:
+      self.resume(resume_step)
+
+  def resume(self, step):
+    '''Pick up the existing output, dropping any snapshots from step onwards.
+
+    Args:
+    step -- The first step not to keep
+    '''
+
+    filename = os.path.join(self.output_dir, 'index.json')
+    if not os.path.exists(filename):
+      return
+
+    with open(filename) as f:
+      index = json.load(f)
+
+    for n_chunk, chunk in enumerate(index['chunks']):
+      if chunk['first_step'] >= step:
+        break
+
+      # Cut short a block that runs past step.
+      steps = np.load(self.chunk_filename('steps', n_chunk))
+      n_keep = int(np.count_nonzero(steps < step))
+      if n_keep < chunk['n_snapshots']:
+        for field in tuple(index['fields']) + ('steps', 'times'):
+          np.save(self.chunk_filename(field, n_chunk), np.load(self.chunk_filename(field, n_chunk))[:n_keep])
+        chunk['n_snapshots'] = n_keep
+
+      self.chunks.append(chunk)
+
+    self.write_index()
+
+  def write(self, particles, step, time=np.nan):
+    '''Add a snapshot to the buffer, writing the buffer once it is full.
+
+    Args:
+    particles -- The particle information
+    step -- Which step the snapshot is from
+    time -- The simulation time of the snapshot
+    '''
+
+    # A new block is started whenever the number of particles changes.
+    shape = np.shape(particles['positions'])
+    if self.buffers is not None and shape != self.shape:
+      self.flush()
+      self.buffers = None
+
+    if self.buffers is None:
+      self.buffers = self.allocate(particles)
+      self.shape = shape
+
+    for field in self.fields:
+      self.buffers[field][self.n_buffered] = particles[field]
+    self.buffers['steps'][self.n_buffered] = step
+    self.buffers['times'][self.n_buffered] = time
+
+    self.n_buffered += 1
+
+    if self.n_buffered == self.chunk_size:
+      self.flush()
+
+  def allocate(self, particles):
+    '''Make the buffers for one block of snapshots.'''
+
+    buffers = {}
+    for field in self.fields:
+      buffers[field] = np.empty((self.chunk_size,) + np.shape(particles[field]), dtype=self.dtype)
+    buffers['steps'] = np.empty(self.chunk_size, dtype=np.int64)
+    buffers['times'] = np.empty(self.chunk_size)
+
+    return buffers
+
+  def flush(self):
+    '''Write the buffered snapshots to disk as one block.'''
+
+    if self.n_buffered == 0:
+      return
+
+    chunk = {
+      'n_snapshots' : self.n_buffered,
+      'n_particles' : self.shape[0],
+      'first_step' : int(self.buffers['steps'][0]),
+    }
+    self.n_buffered = 0
+
+    self.write_block(self.buffers, chunk)
+
+  def sync(self):
+    '''Write the buffered snapshots, returning once they are on disk.'''
+
+    self.flush()
+
+  def write_block(self, buffers, chunk):
+    '''Save one block of snapshots and add it to the index.'''
+
+    n_chunk = len(self.chunks)
+    n_bytes = 0
+    for field in self.fields + ('steps', 'times'):
+      np.save(self.chunk_filename(field, n_chunk), buffers[field][:chunk['n_snapshots']])
+      n_bytes += buffers[field][:chunk['n_snapshots']].nbytes
+
+    self.chunks.append(chunk)
+    self.profiler.count('bytes_written', n_bytes)
+
+    self.write_index()
+
+  def write_index(self):
+    '''Describe the blocks written so far in index.json.'''
+
+    index = {
+      'fields' : list(self.fields),
+      'dtype' : self.dtype.name,
+      'chunks' : self.chunks,
+    }
+
+    # Write then rename, so the index is never half written.
+    filename = os.path.join(self.output_dir, 'index.json')
+    with open(filename + '.tmp', 'w') as f:
+      json.dump(index, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+  def chunk_filename(self, field, n_chunk):
+    '''The file a field of a block is saved in.'''
+
+    return os.path.join(self.output_dir, '{}_{:06d}.npy'.format(field, n_chunk))
+
+  def close(self):
+    '''Write any buffered snapshots.'''
+
+    self.flush()
+
+########################################################################
+
+class AsyncSnapshotWriter(SnapshotWriter):
+  '''A SnapshotWriter that writes full blocks from a background thread, so the simulation keeps
+  running while the disk catches up.
+
+  Only n_buffers blocks of snapshots exist at once. Once they are all full and waiting to be written,
+  the simulation waits for the writer thread to hand one back. Errors in the writer thread are raised
+  in the simulation on the next flush or on close.
+  '''
+
+  def __init__(self, output_dir, n_buffers=DEFAULT_N_BUFFERS, **kwargs):
+    '''
+    Args:
+    output_dir -- Where to save the output
+    n_buffers -- How many blocks of snapshots can be in memory at once
+    kwargs -- Passed on to SnapshotWriter
+    '''
+
+    SnapshotWriter.__init__(self, output_dir, **kwargs)
+
+    self.error = None
+
+    # Blocks waiting to be written, and buffers that are free to be filled.
+    # The free buffers start as None, and are allocated the first time they are needed.
+    self.pending = queue.Queue(maxsize=n_buffers)
+    self.free_buffers = queue.Queue()
+    for i in range(n_buffers):
+      self.free_buffers.put(None)
+
+    self.thread = threading.Thread(target=self.run_writer, name='snapshot-writer')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def allocate(self, particles):
+    '''Take a free set of buffers, waiting for the writer thread if there are none.'''
+
+    buffers = self.free_buffers.get()
+
+    # Buffers for a different number of particles are replaced.
+    field = self.fields[0]
+    if buffers is None or buffers[field].shape[1:] != np.shape(particles[field]):
+      buffers = SnapshotWriter.allocate(self, particles)
+
+    return buffers
+
+  def write_block(self, buffers, chunk):
+    '''Hand a block over to the writer thread.'''
+
+    self.check_error()
+
+    self.pending.put((buffers, chunk))
+    self.buffers = None
+
+  def run_writer(self):
+    '''Write blocks until told to stop. Runs in the writer thread.'''
+
+    while True:
+
+      item = self.pending.get()
+      if item is None:
+        self.pending.task_done()
+        return
+
+      buffers, chunk = item
+
+      # After an error, blocks are dropped rather than written, but their buffers are still
+      # handed back so the simulation isn't left waiting.
+      if self.error is None:
+        try:
+          SnapshotWriter.write_block(self, buffers, chunk)
+        except Exception as error:
+          self.error = error
+
+      self.free_buffers.put(buffers)
+      self.pending.task_done()
+
+  def sync(self):
+    '''Write the buffered snapshots, and wait for the writer thread to finish every pending block.'''
+
+    self.flush()
+    self.pending.join()
+
+    self.check_error()
+
+  def check_error(self):
+    '''Raise any error from the writer thread.'''
+
+    if self.error is not None:
+      raise IOError('Writing snapshots failed: {}'.format(self.error))
+
+  def close(self):
+    '''Write any buffered snapshots, and wait for the writer thread to finish.'''
+
+    if self.thread.is_alive():
+      try:
+        self.flush()
+      finally:
+        self.pending.put(None)
+        self.thread.join()
+
+    self.check_error()
+
+########################################################################
+# Reading the output
+########################################################################
+
+def load_trajectory(output_dir='output', field='positions'):
+  '''Open one field of saved output, without reading it into memory.
+
+  Args:
+  output_dir -- Where the output was saved
+  field -- Which per-particle field to open, e.g. 'positions' or 'velocities'
+
+  Returns:
+  trajectory -- A Trajectory, which can be sliced like an array of shape
+    (n_snapshots, n_particles, n_dimensions)
+  '''
+
+  return Trajectory(output_dir, field)
+
+########################################################################
+
+class Trajectory(object):
+  '''One field of saved output, memory-mapped block by block.
+
+  Slicing, e.g. trajectory[t0:t1, particle_ids], only reads the requested snapshots and particles.
+  Lists of snapshots and of particles select every combination of the two, like np.ix_.
+  A slice of snapshots that lies inside one block is returned as a read-only memory-mapped view,
+  without copying.
+  '''
+
+  def __init__(self, output_dir, field='positions'):
+    '''
+    Args:
+    output_dir -- Where the output was saved
+    field -- Which per-particle field to open
+    '''
+
+    with open(os.path.join(output_dir, 'index.json')) as f:
+      index = json.load(f)
+
+    if field not in index['fields']:
+      raise KeyError('{} was not saved. Saved fields are {}.'.format(field, index['fields']))
+
+    self.output_dir = output_dir
+    self.field = field
+
+    filename = os.path.join(output_dir, '{}_{:06d}.npy')
+    self.blocks = [np.load(filename.format(field, i), mmap_mode='r') for i in range(len(index['chunks']))]
+    self.steps = np.concatenate([np.load(filename.format('steps', i)) for i in range(len(index['chunks']))] + [np.zeros(0, dtype=np.int64)])
+    self.times = np.concatenate([np.load(filename.format('times', i)) for i in range(len(index['chunks']))] + [np.zeros(0)])
+
+    # Where each block starts, in snapshots
+    sizes = [block.shape[0] for block in self.blocks]
+    self.block_starts = np.cumsum([0] + sizes)
+
+    self.n_snapshots = int(self.block_starts[-1])
+
+    # The number of particles, or None if it changes during the simulation.
+    n_particles = set(chunk['n_particles'] for chunk in index['chunks'])
+    self.n_particles = n_particles.pop() if len(n_particles) == 1 else None
+
+  @property
+  def shape(self):
+
+    return (self.n_snapshots, self.n_particles) + self.blocks[0].shape[2:]
+
+  def __len__(self):
+
+    return self.n_snapshots
+
+  def __getitem__(self, key):
+
+    if not isinstance(key, tuple):
+      key = (key,)
+    snapshot_key, rest = key[0], key[1:]
+
+    # A single snapshot
+    if isinstance(snapshot_key, (int, np.integer)):
+      snapshot = np.arange(self.n_snapshots)[snapshot_key]
+      block = np.searchsorted(self.block_starts, snapshot, side='right') - 1
+      return self.blocks[block][(snapshot - self.block_starts[block],) + rest]
+
+    snapshots = np.arange(self.n_snapshots)[snapshot_key]
+    if snapshots.size == 0:
+      return self.blocks[0][(slice(0, 0),) + rest]
+
+    blocks = np.searchsorted(self.block_starts, snapshots, side='right') - 1
+
+    # Blocks are read in order, with the snapshots inside each block sorted.
+    pieces = []
+    for block in np.unique(blocks):
+      local = snapshots[blocks == block] - self.block_starts[block]
+      pieces.append(self.read_block(block, local, rest))
+
+    # Snapshots inside a single block can be returned without copying.
+    data = pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    # Put the snapshots back in the order they were asked for.
+    if (np.diff(snapshots) < 0).any():
+      data = data[np.argsort(np.argsort(snapshots, kind='stable'), kind='stable')]
+
+    return data
+
+  def read_block(self, block, local, rest):
+    '''Read some snapshots from one block. Evenly spaced snapshots are read through a slice, so
+    only the requested particles are touched.'''
+
+    local = np.sort(local)
+
+    spacings = np.unique(np.diff(local))
+    if local.size == 1 or (spacings.size == 1 and spacings[0] > 0):
+      spacing = spacings[0] if local.size > 1 else 1
+      snapshots = self.blocks[block][local[0]:local[-1] + 1:spacing]
+    else:
+      snapshots = np.take(self.blocks[block], local, axis=0)
+
+    return snapshots[(slice(None),) + rest]
+
+  def iter_chunks(self, n_snapshots=None, particles=slice(None)):
+    '''Iterate through the trajectory in time order, a few snapshots at a time.
+
+    Args:
+    n_snapshots -- Snapshots per chunk. Defaults to the size of the blocks on disk.
+    particles -- Which particles to read, e.g. a list of indices
+
+    Yields:
+    steps -- The step number of each snapshot in the chunk
+    data -- The chunk, shape (n_snapshots, n_selected_particles, ...)
+    '''
+
+    if n_snapshots is None:
+      for block in range(len(self.blocks)):
+        start, stop = self.block_starts[block], self.block_starts[block + 1]
+        yield self.steps[start:stop], self.blocks[block][:, particles]
+      return
+
+    for start in range(0, self.n_snapshots, n_snapshots):
+      stop = min(start + n_snapshots, self.n_snapshots)
+      yield self.steps[start:stop], self[start:stop, particles]
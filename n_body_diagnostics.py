@@ -0,0 +1,197 @@
+'''
+Conserved quantities, for checking the health of a simulation.
+
+Every parameters['diagnostics_every'] steps the total energy, linear momentum and angular momentum
+are measured and compared with their values at the start, and the latest measurement is kept in
+parameters['diagnostics']. The values at the start are kept in parameters['initial_diagnostics'],
+so a restarted simulation still compares against the very start.
+
+The potential energy is the expensive part, since it needs every pair. The direct force sum works
+it out in the same pass as the forces on the steps the diagnostics are due, and it is only
+recalculated from scratch when that isn't possible (e.g. with the tree or parallel force methods,
+or integrators whose last force evaluation wasn't at the final positions).
+'''
+
+import numpy as np
+
+import n_body_physics
+
+# Measure every this many steps if diagnostics_every isn't given but a drift limit is.
+DEFAULT_DIAGNOSTICS_EVERY = 100
+
+########################################################################
+
+def get_cadence(parameters):
+  '''How many steps apart the diagnostics are measured, or 0 if they aren't.
+
+  Args:
+  parameters -- The simulation parameter information
+  '''
+
+  cadence = parameters.get('diagnostics_every')
+  if cadence is None:
+    cadence = DEFAULT_DIAGNOSTICS_EVERY if parameters.get('max_energy_drift') else 0
+
+  return cadence
+
+########################################################################
+
+def is_due(parameters, step):
+  '''Whether the diagnostics are measured at the end of a step.
+
+  Args:
+  parameters -- The simulation parameter information
+  step -- The step number
+  '''
+
+  cadence = get_cadence(parameters)
+
+  return bool(cadence) and step % cadence == 0
+
+########################################################################
+
+def record_potentials(particles, parameters, potentials):
+  '''Keep the potential energy worked out by a force calculation, along with the positions it was
+  worked out at.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  potentials -- Array of the gravitational potential at each particle, shape (n_particles,)
+  '''
+
+  parameters['potential_state'] = {
+    'positions' : np.array(particles['positions'], dtype=float),
+    'potential_energy' : 0.5*np.dot(np.asarray(particles['masses'], dtype=float), potentials),
+  }
+
+########################################################################
+
+def get_potential_energy(particles, parameters):
+  '''Get the potential energy, from the last force calculation if it was at the current positions,
+  and otherwise by summing over every pair.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  '''
+
+  recorded = parameters.get('potential_state')
+
+  if recorded is not None and np.array_equal(recorded['positions'], particles['positions']):
+    return recorded['potential_energy']
+
+  return n_body_physics.calculate_potential_energy(particles, parameters)
+
+########################################################################
+
+def calculate_momentum(particles):
+  '''Calculate the total linear momentum.
+
+  Args:
+  particles -- The particle information
+
+  Returns:
+  momentum -- Array, shape (n_dimensions,)
+  '''
+
+  return np.dot(np.asarray(particles['masses'], dtype=float), np.asarray(particles['velocities'], dtype=float))
+
+########################################################################
+
+def calculate_angular_momentum(particles):
+  '''Calculate the total angular momentum about the origin.
+
+  Args:
+  particles -- The particle information
+
+  Returns:
+  angular_momentum -- The usual vector in 3D, shape (3,). In other numbers of dimensions, the
+    components L_ab = sum m (x_a v_b - x_b v_a) for a < b, e.g. shape (1,) in 2D.
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+  velocities = np.asarray(particles['velocities'], dtype=float)
+
+  moments = np.dot(positions.T*masses, velocities)
+  moments = moments - moments.T
+
+  if positions.shape[1] == 3:
+    return np.array([moments[1, 2], moments[2, 0], moments[0, 1]])
+
+  return moments[np.triu_indices(positions.shape[1], k=1)]
+
+########################################################################
+
+def measure(particles, parameters):
+  '''Measure the conserved quantities.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+
+  Returns:
+  diagnostics -- Dictionary of the step, time, kinetic, potential and total energy, momentum and
+    angular momentum, as plain numbers and lists so it can be saved with the parameters
+  '''
+
+  kinetic_energy = n_body_physics.calculate_kinetic_energy(particles)
+  potential_energy = get_potential_energy(particles, parameters)
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  speeds = np.sqrt((np.asarray(particles['velocities'], dtype=float)**2.).sum(axis=1))
+  distances = np.sqrt((np.asarray(particles['positions'], dtype=float)**2.).sum(axis=1))
+
+  return {
+    'step' : int(parameters.get('step', 0)),
+    'time' : float(parameters.get('time', 0.)),
+    'kinetic_energy' : float(kinetic_energy),
+    'potential_energy' : float(potential_energy),
+    'energy' : float(kinetic_energy + potential_energy),
+    'momentum' : calculate_momentum(particles).tolist(),
+    'angular_momentum' : calculate_angular_momentum(particles).tolist(),
+    # The sizes that the momenta can be compared with
+    'momentum_scale' : float(np.dot(masses, speeds)),
+    'angular_momentum_scale' : float(np.dot(masses, distances*speeds)),
+  }
+
+########################################################################
+
+def update_diagnostics(particles, parameters, force=False):
+  '''Measure the conserved quantities and how far they have drifted, if they are due this step.
+
+  The drifts are the change in energy relative to the initial energy, and the size of the change in
+  momentum and angular momentum relative to sum m|v| and sum m|r||v| at the start.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  force -- If True, measure them whether or not they are due
+
+  Returns:
+  diagnostics -- The measurement, with 'energy_drift', 'momentum_drift' and 'angular_momentum_drift'
+    added, or None if none was due
+  '''
+
+  if not force and not is_due(parameters, parameters.get('step', 0)):
+    return None
+
+  diagnostics = measure(particles, parameters)
+
+  initial = parameters.get('initial_diagnostics')
+  if initial is None:
+    initial = diagnostics
+    parameters['initial_diagnostics'] = initial
+
+  energy_scale = abs(initial['energy']) or initial['kinetic_energy'] - initial['potential_energy']
+  diagnostics['energy_drift'] = (diagnostics['energy'] - initial['energy'])/energy_scale if energy_scale else 0.
+
+  for key in ['momentum', 'angular_momentum']:
+    change = np.linalg.norm(np.subtract(diagnostics[key], initial[key]))
+    scale = initial[key + '_scale']
+    diagnostics[key + '_drift'] = float(change/scale) if scale else float(change)
+
+  parameters['diagnostics'] = diagnostics
+
+  return diagnostics
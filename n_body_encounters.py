@@ -0,0 +1,306 @@
+'''
+Close encounters, handled by an exact two-body Kepler solver.
+
+A tightly bound pair, e.g. a binary star, would normally force the whole simulation down to a
+timestep much shorter than the pair's orbit. Instead, when parameters['encounter_factor'] is set,
+the leapfrog integrator splits each such pair's mutual gravity out of the kicks and moves the pair
+along its exact Kepler orbit during the drift, while every other force (including the rest of the
+system pulling on the pair) is still applied by the kicks. This is an operator splitting, so the
+integrator stays second order and symplectic while the pairs don't change.
+
+A pair is handed to the Kepler solver when it is bound and its free-fall time sqrt(r^3/(G M)) is
+shorter than encounter_factor timesteps. The pairs are chosen at the start of every step, and a
+particle is only ever in one pair. The first kick can still unbind a pair that was only just
+bound, so the solver follows hyperbolic orbits too.
+
+The Kepler orbit is unsoftened, so a pair is only handed over if its orbit never comes within the
+softening (see n_body_softening.calculate_newtonian_radius()). With Plummer softening, which never
+becomes exactly Newtonian, no pairs are.
+'''
+
+import math
+
+import numpy as np
+
+import n_body_neighbours
+import n_body_physics
+import n_body_softening
+
+# Laguerre-Conway iterations for the universal Kepler equation converge in a handful of steps for
+# any orbit; this is just a backstop.
+MAX_KEPLER_ITERATIONS = 50
+
+KEPLER_TOLERANCE = 1.e-15
+
+# Below this value of z = alpha*chi^2 the Stumpff functions are summed as series.
+STUMPFF_SERIES_LIMIT = 0.1
+
+########################################################################
+
+def find_encounter_pairs(particles, parameters, dt):
+  '''Find the pairs that should be handed to the Kepler solver for a step of dt.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information. Nothing is found unless
+    'encounter_factor' is set.
+  dt -- The timestep
+
+  Returns:
+  pairs -- Array of particle indices, shape (n_pairs, 2), tightest pairs first
+  '''
+
+  encounter_factor = parameters.get('encounter_factor')
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+  newtonian_radius = n_body_softening.calculate_newtonian_radius(softening, softening_kernel)
+  if not encounter_factor or dt == 0. or newtonian_radius == np.inf:
+    return np.zeros((0, 2), dtype=int)
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+  velocities = np.asarray(particles['velocities'], dtype=float)
+
+  # No pair can be close if it is further apart than the heaviest possible pair's limit.
+  time_squared = (encounter_factor*dt)**2.
+  search_radius = (parameters['G']*2.*masses.max()*time_squared)**(1./3.)
+
+  i, j = find_pairs_within(positions, search_radius).T
+
+  displacements = positions[j] - positions[i]
+  distances = np.sqrt((displacements**2.).sum(axis=1))
+  mu = parameters['G']*(masses[i] + masses[j])
+
+  relative_velocities = velocities[j] - velocities[i]
+  speeds_squared = (relative_velocities**2.).sum(axis=1)
+  free_fall_times_squared = distances**3./mu
+
+  close = (free_fall_times_squared < time_squared) & (0.5*speeds_squared < mu/distances)
+
+  if newtonian_radius > 0.:
+    close &= calculate_pericentres(displacements, relative_velocities, mu) >= newtonian_radius
+  i, j, free_fall_times_squared = i[close], j[close], free_fall_times_squared[close]
+
+  # Take the tightest pairs first, skipping any pair with a particle that is already taken.
+  pairs = []
+  taken = set()
+  for k in np.argsort(free_fall_times_squared, kind='stable'):
+    if i[k] in taken or j[k] in taken:
+      continue
+    pairs.append((i[k], j[k]))
+    taken.update((i[k], j[k]))
+
+  return np.array(pairs, dtype=int).reshape(-1, 2)
+
+########################################################################
+
+def calculate_pericentres(positions, velocities, mu):
+  '''Calculate the closest approach of two-body orbits.
+
+  Args:
+  positions -- Array of relative positions, shape (n_orbits, n_dimensions)
+  velocities -- Array of relative velocities, shape (n_orbits, n_dimensions)
+  mu -- Array of G*(m_1 + m_2), shape (n_orbits,)
+
+  Returns:
+  pericentres -- Array of pericentre distances, shape (n_orbits,)
+  '''
+
+  distances_squared = (positions**2.).sum(axis=1)
+  speeds_squared = (velocities**2.).sum(axis=1)
+
+  # The squared specific angular momentum and the eccentricity, in any number of dimensions
+  h_squared = np.maximum(distances_squared*speeds_squared - (positions*velocities).sum(axis=1)**2., 0.)
+  energies = 0.5*speeds_squared - mu/np.sqrt(distances_squared)
+  eccentricities = np.sqrt(np.maximum(1. + 2.*energies*h_squared/mu**2., 0.))
+
+  return h_squared/(mu*(1. + eccentricities))
+
+########################################################################
+
+def find_pairs_within(positions, radius):
+  '''Find every pair of particles closer than radius, with the cell list in n_body_neighbours.
+
+  Args:
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  radius -- The largest separation to find
+
+  Returns:
+  pairs -- Array of particle indices (i, j) with i < j, shape (n_pairs, 2)
+  '''
+
+  return n_body_neighbours.find_pairs(positions, radius)
+
+########################################################################
+
+def calculate_pair_accelerations(particles, parameters, pairs):
+  '''Calculate the accelerations that the members of each pair give each other, softened in the
+  same way as the forces, so they can be taken out of the kicks.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  pairs -- Array of particle indices, shape (n_pairs, 2)
+
+  Returns:
+  accelerations -- Array of accelerations for every particle, shape (n_particles, n_dimensions),
+    zero for particles that aren't in a pair
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  accelerations = np.zeros(positions.shape)
+
+  i, j = pairs.T
+  displacements = positions[j] - positions[i]
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+  factors = parameters['G']*n_body_softening.calculate_inverse_cubes((displacements**2.).sum(axis=1), softening, softening_kernel)
+
+  accelerations[i] = (factors*masses[j])[:, np.newaxis]*displacements
+  accelerations[j] = -(factors*masses[i])[:, np.newaxis]*displacements
+
+  return accelerations
+
+########################################################################
+
+def drift(particles, parameters, pairs, dt):
+  '''Move every particle for dt: particles in a pair along the pair's Kepler orbit, and everything
+  else in a straight line.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  pairs -- Array of particle indices, shape (n_pairs, 2)
+  dt -- How long to move them for
+  '''
+
+  i, j = pairs.T
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.array(particles['positions'][pairs], dtype=float)
+  velocities = np.array(particles['velocities'][pairs], dtype=float)
+
+  n_body_physics.drift(particles, parameters, dt)
+
+  if len(pairs) == 0:
+    return
+
+  m_i = masses[i][:, np.newaxis]
+  m_j = masses[j][:, np.newaxis]
+  total_masses = m_i + m_j
+
+  # The centre of mass moves in a straight line, and the separation along the Kepler orbit.
+  centre_velocities = (m_i*velocities[:, 0] + m_j*velocities[:, 1])/total_masses
+  centre_positions = (m_i*positions[:, 0] + m_j*positions[:, 1])/total_masses + dt*centre_velocities
+
+  separations, relative_velocities = solve_kepler(positions[:, 1] - positions[:, 0], velocities[:, 1] - velocities[:, 0],
+                                                  parameters['G']*total_masses[:, 0], dt)
+
+  particles['positions'][i] = centre_positions - m_j/total_masses*separations
+  particles['positions'][j] = centre_positions + m_i/total_masses*separations
+  particles['velocities'][i] = centre_velocities - m_j/total_masses*relative_velocities
+  particles['velocities'][j] = centre_velocities + m_i/total_masses*relative_velocities
+
+########################################################################
+
+def solve_kepler(positions, velocities, mu, dt):
+  '''Advance two-body orbits, bound or not, by dt, using the universal variable formulation with
+  Laguerre-Conway iteration (Danby 1988; Conway 1986).
+
+  Args:
+  positions -- Array of relative positions, shape (n_orbits, n_dimensions)
+  velocities -- Array of relative velocities, shape (n_orbits, n_dimensions)
+  mu -- Array of G*(m_1 + m_2), shape (n_orbits,)
+  dt -- How long to advance the orbits for. May be negative.
+
+  Returns:
+  positions -- Array of relative positions after dt
+  velocities -- Array of relative velocities after dt
+  '''
+
+  positions = np.asarray(positions, dtype=float)
+  velocities = np.asarray(velocities, dtype=float)
+  mu = np.asarray(mu, dtype=float)
+
+  r0 = np.sqrt((positions**2.).sum(axis=1))
+  sqrt_mu = np.sqrt(mu)
+  sigma0 = (positions*velocities).sum(axis=1)/sqrt_mu
+
+  # The inverse of the semi-major axis, positive for bound orbits
+  alpha = 2./r0 - (velocities**2.).sum(axis=1)/mu
+  bound = alpha > 0.
+
+  # Whole orbits of bound pairs change nothing, so only solve for the remainder. Unbound pairs
+  # start from the straight-line guess instead.
+  t = np.full(alpha.shape, dt, dtype=float)
+  t[bound] = np.mod(dt, 2.*np.pi/np.sqrt(mu[bound]*alpha[bound]**3.))
+
+  chi = sqrt_mu*t/r0
+  chi[bound] = sqrt_mu[bound]*alpha[bound]*t[bound]
+  n = 5.
+  for iteration in range(MAX_KEPLER_ITERATIONS):
+
+    z = alpha*chi**2.
+    C, S = _stumpff(z)
+
+    F = sigma0*chi**2.*C + (1. - alpha*r0)*chi**3.*S + r0*chi - sqrt_mu*t
+    dF = sigma0*chi*(1. - z*S) + (1. - alpha*r0)*chi**2.*C + r0
+    ddF = sigma0*(1. - z*C) + (1. - alpha*r0)*chi*(1. - z*S)
+
+    step = n*F/(dF + np.sqrt(np.abs((n - 1.)**2.*dF**2. - n*(n - 1.)*F*ddF)))
+    chi -= step
+
+    if np.all(np.abs(step) <= KEPLER_TOLERANCE*np.maximum(np.abs(chi), np.finfo(float).tiny)):
+      break
+
+  z = alpha*chi**2.
+  C, S = _stumpff(z)
+
+  f = 1. - chi**2.*C/r0
+  g = t - chi**3.*S/sqrt_mu
+
+  new_positions = f[:, np.newaxis]*positions + g[:, np.newaxis]*velocities
+  r = np.sqrt((new_positions**2.).sum(axis=1))
+
+  f_dot = sqrt_mu/(r*r0)*chi*(z*S - 1.)
+  g_dot = 1. - chi**2.*C/r
+
+  new_velocities = f_dot[:, np.newaxis]*positions + g_dot[:, np.newaxis]*velocities
+
+  return new_positions, new_velocities
+
+########################################################################
+
+def _stumpff(z):
+  '''The Stumpff functions C(z) and S(z), which are trigonometric for z > 0 (bound orbits) and
+  hyperbolic for z < 0 (unbound ones).'''
+
+  C = np.empty(z.shape)
+  S = np.empty(z.shape)
+
+  small = np.abs(z) < STUMPFF_SERIES_LIMIT
+  positive = ~small & (z > 0.)
+  negative = ~small & (z < 0.)
+
+  # C = sum (-z)^k/(2k + 2)!, S = sum (-z)^k/(2k + 3)!
+  z_small = z[small]
+  C_small = np.zeros(z_small.shape)
+  S_small = np.zeros(z_small.shape)
+  term = np.ones(z_small.shape)
+  for k in range(8):
+    C_small += term/math.factorial(2*k + 2)
+    S_small += term/math.factorial(2*k + 3)
+    term = -term*z_small
+  C[small] = C_small
+  S[small] = S_small
+
+  root_z = np.sqrt(z[positive])
+  C[positive] = (1. - np.cos(root_z))/z[positive]
+  S[positive] = (root_z - np.sin(root_z))/root_z**3.
+
+  root_z = np.sqrt(-z[negative])
+  C[negative] = (1. - np.cosh(root_z))/z[negative]
+  S[negative] = (np.sinh(root_z) - root_z)/root_z**3.
+
+  return C, S
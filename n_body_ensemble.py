@@ -0,0 +1,250 @@
+'''
+Many small, independent systems stepped together.
+
+Parameter sweeps run thousands of systems of a few bodies each. Stepping them one at a time through
+update_system() spends most of the time in the interpreter, so an Ensemble stores a batch of B
+systems as padded arrays
+  masses -- shape (B, N)
+  positions, velocities -- shape (B, N, D)
+  mask -- shape (B, N), True for the real particles
+where N is the size of the largest system, and advances all of them with one vectorized
+kick-drift-kick leapfrog step. Padding particles have zero mass and never move.
+
+Each system has its own dt and G, and stops on its own once it has taken max_steps steps or
+reached t_end, whichever comes first. Every system uses the same softening, see n_body_softening.
+'''
+
+import numpy as np
+
+import n_body_softening
+
+# Default number of systems whose pairwise arrays are calculated at once.
+DEFAULT_BATCH_SIZE = 1024
+
+########################################################################
+
+class Ensemble(object):
+  '''A batch of independent systems, all with the same number of dimensions.'''
+
+  def __init__(self, systems, dt, G=1., max_steps=None, t_end=None, batch_size=DEFAULT_BATCH_SIZE,
+               softening=0., softening_kernel='plummer'):
+    '''
+    Args:
+    systems -- List of particle dictionaries, one per system. Velocities default to zeros.
+    dt -- The timestep, either one for every system or an array with one per system
+    G -- The gravitational constant, one for every system or one per system
+    max_steps -- How many steps each system takes, one for every system or one per system.
+      Defaults to no limit.
+    t_end -- When each system stops, one for every system or one per system. The last step is
+      shortened to finish exactly at t_end. Defaults to no limit.
+    batch_size -- How many systems to calculate the accelerations for at once, which bounds the
+      memory used by the (batch_size, N, N, D) pairwise arrays
+    softening -- The softening length
+    softening_kernel -- How the softening is done, 'plummer' or 'spline'
+    '''
+
+    if len(systems) == 0:
+      raise ValueError('An ensemble needs at least one system.')
+
+    n_dimensions = set(np.shape(system['positions'])[1] for system in systems)
+    if len(n_dimensions) != 1:
+      raise ValueError('Every system must have the same number of dimensions, got {}.'.format(sorted(n_dimensions)))
+
+    self.n_systems = len(systems)
+    self.n_dimensions = n_dimensions.pop()
+    self.n_particles = np.array([len(system['masses']) for system in systems])
+    self.batch_size = batch_size
+    self.softening, self.softening_kernel = n_body_softening.get_softening({'softening' : softening, 'softening_kernel' : softening_kernel})
+
+    max_particles = self.n_particles.max()
+
+    self.masses = np.zeros((self.n_systems, max_particles))
+    self.positions = np.zeros((self.n_systems, max_particles, self.n_dimensions))
+    self.velocities = np.zeros((self.n_systems, max_particles, self.n_dimensions))
+    self.mask = np.arange(max_particles) < self.n_particles[:, np.newaxis]
+
+    for b, system in enumerate(systems):
+      n = self.n_particles[b]
+      self.masses[b, :n] = system['masses']
+      self.positions[b, :n] = system['positions']
+      if system.get('velocities') is not None:
+        self.velocities[b, :n] = system['velocities']
+
+    self.dt = self._per_system(dt, float)
+    self.G = self._per_system(G, float)
+    self.max_steps = self._per_system(np.iinfo(np.int64).max if max_steps is None else max_steps, np.int64)
+    self.t_end = self._per_system(np.inf if t_end is None else t_end, float)
+
+    self.time = np.zeros(self.n_systems)
+    self.steps = np.zeros(self.n_systems, dtype=np.int64)
+
+    # The accelerations at the current positions, reused at the start of the next step.
+    self.accelerations = None
+
+  @classmethod
+  def from_parameters(cls, systems, parameters, batch_size=DEFAULT_BATCH_SIZE):
+    '''Make an ensemble from one parameter dictionary per system, using their 'dt', 'G',
+    'max_steps' and 't_end'. Their 'softening' and 'softening_kernel' must all be the same.
+
+    Args:
+    systems -- List of particle dictionaries, one per system
+    parameters -- List of parameter dictionaries, one per system
+    batch_size -- How many systems to calculate the accelerations for at once
+    '''
+
+    if len(parameters) != len(systems):
+      raise ValueError('Expected parameters for {} systems, got {}.'.format(len(systems), len(parameters)))
+
+    max_steps = [p.get('max_steps', np.iinfo(np.int64).max) for p in parameters]
+    t_end = [p.get('t_end', np.inf) for p in parameters]
+
+    softenings = set(n_body_softening.get_softening(p) for p in parameters)
+    if len(softenings) != 1:
+      raise ValueError('Every system in an ensemble must have the same softening, got {}.'.format(sorted(softenings)))
+    softening, softening_kernel = softenings.pop()
+
+    return cls(systems, [p['dt'] for p in parameters], [p['G'] for p in parameters], max_steps, t_end, batch_size,
+               softening, softening_kernel)
+
+  ########################################################################
+
+  @property
+  def active(self):
+    '''Which systems still have steps to take, shape (B,).'''
+
+    return (self.steps < self.max_steps) & (self.time < self.t_end)
+
+  @property
+  def finished(self):
+    '''Whether every system has stopped.'''
+
+    return not self.active.any()
+
+  def run(self, max_iterations=None):
+    '''Step until every system has stopped.
+
+    Args:
+    max_iterations -- Stop after this many calls to step(), even if some systems are still running
+    '''
+
+    iteration = 0
+    while not self.finished and (max_iterations is None or iteration < max_iterations):
+      self.step()
+      iteration += 1
+
+  def step(self):
+    '''Advance every active system by one kick-drift-kick step of its own dt.'''
+
+    if self.accelerations is None:
+      self.accelerations = self.calculate_accelerations()
+
+    active = np.flatnonzero(self.active)
+    if active.size == 0:
+      return
+
+    # Work on views while every system is running, and on copies of the running ones after that.
+    if active.size == self.n_systems:
+      active = slice(None)
+
+    dt = np.minimum(self.dt[active], self.t_end[active] - self.time[active])[:, np.newaxis, np.newaxis]
+    moving = self.mask[active][:, :, np.newaxis]
+
+    velocities = self.velocities[active] + 0.5*dt*self.accelerations[active]
+    positions = self.positions[active] + np.where(moving, dt*velocities, 0.)
+
+    accelerations = self.calculate_accelerations(active, positions)
+    velocities += 0.5*dt*accelerations
+
+    self.positions[active] = positions
+    self.velocities[active] = velocities
+    self.accelerations[active] = accelerations
+
+    self.time[active] += dt[:, 0, 0]
+    self.steps[active] += 1
+
+    # Don't leave rounding errors that would take another, tiny step.
+    finishing = np.isclose(self.time, self.t_end, rtol=1e-12, atol=0.)
+    self.time[finishing] = self.t_end[finishing]
+
+  ########################################################################
+
+  def calculate_accelerations(self, systems=slice(None), positions=None):
+    '''Calculate the accelerations of every particle in some of the systems.
+
+    Args:
+    systems -- Which systems, as a slice or an index array. Defaults to all of them.
+    positions -- Positions to use for those systems. Defaults to their current positions.
+
+    Returns:
+    accelerations -- Array of shape (n_chosen_systems, N, D), zero for padding particles
+    '''
+
+    masses = self.masses[systems]
+    mask = self.mask[systems]
+    G = self.G[systems]
+    if positions is None:
+      positions = self.positions[systems]
+
+    accelerations = np.zeros(positions.shape)
+
+    n_particles = positions.shape[1]
+    not_self = ~np.eye(n_particles, dtype=bool)
+
+    for start in range(0, len(masses), self.batch_size):
+      batch = slice(start, start + self.batch_size)
+
+      # Displacements from particle i to particle j, shape (batch, N, N, D)
+      displacements = positions[batch, np.newaxis, :, :] - positions[batch, :, np.newaxis, :]
+      distances_squared = (displacements**2.).sum(axis=3)
+
+      # Padding particles have zero mass, but may sit on top of each other.
+      pairs = mask[batch, :, np.newaxis] & mask[batch, np.newaxis, :] & not_self
+      inverse_cubes = np.where(pairs, n_body_softening.calculate_inverse_cubes(distances_squared, self.softening, self.softening_kernel), 0.)
+
+      weights = G[batch, np.newaxis, np.newaxis]*masses[batch, np.newaxis, :]*inverse_cubes
+
+      accelerations[batch] = np.einsum('bij,bijd->bid', weights, displacements)
+
+    return accelerations
+
+  def calculate_energies(self):
+    '''Calculate the total energy of each system, shape (B,).'''
+
+    kinetic = 0.5*(self.masses*(self.velocities**2.).sum(axis=2)).sum(axis=1)
+
+    displacements = self.positions[:, np.newaxis, :, :] - self.positions[:, :, np.newaxis, :]
+    distances_squared = (displacements**2.).sum(axis=3)
+
+    n_particles = self.masses.shape[1]
+    pairs = self.mask[:, :, np.newaxis] & self.mask[:, np.newaxis, :] & np.triu(np.ones((n_particles, n_particles), dtype=bool), k=1)
+    inverse_distances = np.where(pairs, n_body_softening.calculate_inverse_distances(distances_squared, self.softening, self.softening_kernel), 0.)
+
+    potential = -self.G*(self.masses[:, :, np.newaxis]*self.masses[:, np.newaxis, :]*inverse_distances).sum(axis=(1, 2))
+
+    return kinetic + potential
+
+  def get_system(self, b):
+    '''Get one system as a particle dictionary, without its padding.
+
+    Args:
+    b -- Which system
+    '''
+
+    n = self.n_particles[b]
+
+    return {
+      'masses' : self.masses[b, :n].copy(),
+      'positions' : self.positions[b, :n].copy(),
+      'velocities' : self.velocities[b, :n].copy(),
+    }
+
+  ########################################################################
+
+  def _per_system(self, value, dtype):
+    '''Broadcast a setting to one value per system.'''
+
+    value = np.asarray(value, dtype=dtype)
+    if value.ndim > 0 and value.shape != (self.n_systems,):
+      raise ValueError('Expected one value, or one per system ({}), got shape {}.'.format(self.n_systems, value.shape))
+
+    return np.array(np.broadcast_to(value, (self.n_systems,)))
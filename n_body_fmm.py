@@ -0,0 +1,488 @@
+'''
+Fast multipole method (FMM) gravity, with Cartesian Taylor expansions of any order.
+
+Like Barnes-Hut, the FMM groups distant particles into cells, but it also groups the targets: each
+pair of well-separated cells interacts once, through their expansions, instead of every particle
+walking the tree (Greengard & Rokhlin 1987; the Cartesian form and the dual tree walk follow Dehnen
+2002). Asymptotically the cost is O(N) rather than O(N log N), but not at the sizes measured here:
+the number of accepted pairs of cells per cell keeps growing with N. With the default order and
+theta, the time on a Plummer sphere grew as about N^1.2 to N^1.4 from 4000 to 16000 particles, and
+N^1.2 from 16000 to 64000, nearly all of it in the M2L and P2P steps. Barnes-Hut grew as about
+N^1.4 over the same range. At the defaults the two have similar largest force errors, a few
+percent, although the FMM's median error is several times smaller. At these matched largest errors
+the two took about as long for 1000 particles, and the FMM was faster from 4000, see
+benchmarks/fmm.py crossover.
+
+The steps are
+  P2M -- Each leaf's multipole moments M_a = sum m (z - x)^a/a! about the cell centre z, for every
+    multi-index a with |a| <= order
+  M2M -- Parents' moments from their children's, shifted to the parent's centre
+  Dual tree walk -- Pairs of cells, starting from (root, root). A pair is accepted if
+    (r_A + r_B) < theta*|c_A - c_B|, where r is the radius of the cell's bounding sphere. Otherwise
+    the larger cell is split, and two leaves that can't be accepted are summed directly (P2P).
+  M2L -- Each accepted pair adds to the target cell's local expansion
+    L_b = -G sum_a M_a D_(a+b)(c - z), with D_a the derivatives of 1/r and |a| + |b| <= order
+  L2L -- Local expansions passed down to the children
+  L2P -- Each particle's acceleration from its leaf's local expansion
+
+The gravity is 1/r^2 in any number of dimensions, as in the rest of the code. The expansions are of
+unsoftened gravity, so accepted cells must also be further apart than the spline softening kernel
+reaches (2.8 softening lengths), beyond which it is exactly Newtonian. Plummer softening is never
+exactly Newtonian, so it can't be used with the FMM.
+
+The tree is n_body_tree.build_tree(), with 'fmm_leaf_size' particles per leaf.
+'''
+
+import functools
+import itertools
+
+import numpy as np
+
+import n_body_softening
+import n_body_tree
+
+# Default expansion order. The force error falls roughly as theta^(order + 1).
+DEFAULT_ORDER = 4
+
+# Default opening angle for the dual tree walk
+DEFAULT_THETA = 0.5
+
+# Default maximum number of particles in a leaf. Larger than Barnes-Hut's, because leaves are
+# summed directly against each other.
+DEFAULT_LEAF_SIZE = 32
+
+# Upper limit, in bytes, on the temporary arrays of each batch of interactions. Small enough for
+# them to stay in cache, which matters more than the number of batches.
+DEFAULT_MEMORY_BUDGET = 2**22
+
+########################################################################
+
+def calculate_fmm_forces(particles, parameters):
+  '''Calculate the forces on each particle with the fast multipole method.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information. Uses 'fmm_order', 'fmm_theta',
+    'fmm_leaf_size', 'softening' and 'softening_kernel' if they are given.
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+
+  return evaluate_fmm_forces(masses, positions, parameters['G'],
+                             parameters.get('fmm_order', DEFAULT_ORDER),
+                             parameters.get('fmm_theta', DEFAULT_THETA),
+                             parameters.get('fmm_leaf_size', DEFAULT_LEAF_SIZE),
+                             softening, softening_kernel)
+
+########################################################################
+
+def evaluate_fmm_forces(masses, positions, G, order=DEFAULT_ORDER, theta=DEFAULT_THETA, leaf_size=DEFAULT_LEAF_SIZE,
+                        softening=0., softening_kernel='plummer'):
+  '''Calculate the net force on every particle with the fast multipole method.
+
+  Args:
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  G -- The gravitational constant
+  order -- The expansion order, at least 1
+  theta -- The opening angle
+  leaf_size -- Leaves with more particles than this are split
+  softening -- The softening length, see n_body_softening. Only the spline kernel can be used.
+  softening_kernel -- How the softening is done
+
+  Returns:
+  forces -- Array of net forces, shape (n_particles, n_dimensions)
+  '''
+
+  if order < 1:
+    raise ValueError('fmm_order must be at least 1, got {}.'.format(order))
+
+  if softening > 0. and softening_kernel != 'spline':
+    raise ValueError("The FMM's expansions are Newtonian, so it needs softening_kernel='spline', not {}.".format(softening_kernel))
+
+  n_particles, n_dimensions = positions.shape
+  if n_particles == 0:
+    return np.zeros(positions.shape)
+
+  expansion = _get_expansion(n_dimensions, order)
+
+  tree = n_body_tree.build_tree(masses, positions, leaf_size)
+  tree['is_leaf'] = (tree['children'] < 0).all(axis=1)
+  tree['radii'] = calculate_radii(tree, positions)
+
+  moments = calculate_moments(tree, masses, positions, expansion)
+
+  accepted, leaf_pairs = find_interactions(tree, theta, n_body_softening.SPLINE_RADIUS_FACTOR*softening)
+
+  local = np.zeros((len(tree['half_widths']), expansion.n_terms))
+  _translate_multipoles_to_locals(local, tree, moments, accepted, G, expansion)
+  _pass_locals_down(local, tree, expansion)
+
+  forces = _evaluate_locals(local, tree, masses, positions, expansion)
+  forces += _calculate_leaf_pair_forces(tree, leaf_pairs, masses, positions, G, softening, softening_kernel)
+
+  return forces
+
+########################################################################
+
+def calculate_moments(tree, masses, positions, expansion):
+  '''Calculate every cell's multipole moments about its centre: P2M for the leaves, then M2M up the tree.
+
+  Args:
+  tree -- The tree from n_body_tree.build_tree()
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  expansion -- The _Expansion for this dimension and order
+
+  Returns:
+  moments -- Array of moments, shape (n_nodes, n_terms)
+  '''
+
+  n_nodes = len(tree['half_widths'])
+
+  # P2M
+  leaves = np.repeat(np.arange(n_nodes), tree['leaf_counts'])
+  order = tree['order']
+  monomials = expansion.monomials(tree['centers'][leaves] - positions[order])
+  moments = np.array([np.bincount(leaves, masses[order]*monomials[:, a], minlength=n_nodes)
+                      for a in range(expansion.n_terms)]).transpose()
+
+  # M2M, deepest level first
+  parents = _get_parents(tree)
+  for level in reversed(_get_levels(tree)[1:]):
+    shifted = expansion.shift(moments[level], tree['centers'][parents[level]] - tree['centers'][level], upwards=True)
+    for a in range(expansion.n_terms):
+      moments[:, a] += np.bincount(parents[level], shifted[:, a], minlength=n_nodes)
+
+  return moments
+
+########################################################################
+
+def calculate_radii(tree, positions):
+  '''Calculate the radius about each cell's centre that holds all of its particles, which is often
+  much less than the radius of the cell itself.
+
+  Args:
+  tree -- The tree from n_body_tree.build_tree()
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+
+  Returns:
+  radii -- Array of radii, shape (n_nodes,)
+  '''
+
+  n_nodes = len(tree['half_widths'])
+
+  leaves = np.repeat(np.arange(n_nodes), tree['leaf_counts'])
+  distances = np.sqrt(((positions[tree['order']] - tree['centers'][leaves])**2.).sum(axis=1))
+
+  radii = np.zeros(n_nodes)
+  np.maximum.at(radii, leaves, distances)
+
+  # Each parent holds its children's spheres, deepest level first.
+  parents = _get_parents(tree)
+  for level in reversed(_get_levels(tree)[1:]):
+    reach = radii[level] + np.sqrt(((tree['centers'][level] - tree['centers'][parents[level]])**2.).sum(axis=1))
+    np.maximum.at(radii, parents[level], reach)
+
+  # Never more than the cell's own bounding sphere
+  return np.minimum(radii, np.sqrt(positions.shape[1])*tree['half_widths'])
+
+########################################################################
+
+def find_interactions(tree, theta, separation=0.):
+  '''Walk the tree against itself to find which pairs of cells interact through their expansions,
+  and which pairs of leaves are summed directly. The walk is mutual, so each pair is found once and
+  then works both ways.
+
+  Args:
+  tree -- The tree from n_body_tree.build_tree(), with 'radii' and 'is_leaf'
+  theta -- The opening angle
+  separation -- Accepted pairs of cells must also have at least this gap between their bounding spheres
+
+  Returns:
+  accepted -- Array of pairs of cells, shape (n_accepted, 2)
+  leaf_pairs -- Array of pairs of leaves, shape (n_leaf_pairs, 2), including each leaf with itself
+  '''
+
+  centers = tree['centers']
+  radii = tree['radii']
+  is_leaf = tree['is_leaf']
+  children = tree['children']
+
+  n_children = children.shape[1]
+  first_children, second_children = np.triu_indices(n_children)
+
+  accepted = []
+  leaf_pairs = []
+
+  cells_a = np.zeros(1, dtype=int)
+  cells_b = np.zeros(1, dtype=int)
+
+  while cells_a.size > 0:
+
+    distances = np.sqrt(((centers[cells_a] - centers[cells_b])**2.).sum(axis=1))
+    reach = radii[cells_a] + radii[cells_b]
+    accept = (cells_a != cells_b) & (reach < theta*distances) & (distances - reach > separation)
+    accepted.append(np.array([cells_a[accept], cells_b[accept]]).T)
+
+    both_leaves = ~accept & is_leaf[cells_a] & is_leaf[cells_b]
+    leaf_pairs.append(np.array([cells_a[both_leaves], cells_b[both_leaves]]).T)
+
+    opened = ~accept & ~both_leaves
+    cells_a, cells_b = cells_a[opened], cells_b[opened]
+
+    # A cell against itself becomes every pair of its children, each pair once.
+    same = cells_a == cells_b
+    child_lists = children[cells_a[same]]
+    new_a = [child_lists[:, first_children].ravel()]
+    new_b = [child_lists[:, second_children].ravel()]
+
+    # Otherwise the larger cell is split, unless it's a leaf.
+    cells_a, cells_b = cells_a[~same], cells_b[~same]
+    split_a = ~is_leaf[cells_a] & (is_leaf[cells_b] | (radii[cells_a] >= radii[cells_b]))
+
+    new_a.append(children[cells_a[split_a]].ravel())
+    new_b.append(np.repeat(cells_b[split_a], n_children))
+
+    new_a.append(np.repeat(cells_a[~split_a], n_children))
+    new_b.append(children[cells_b[~split_a]].ravel())
+
+    cells_a = np.concatenate(new_a)
+    cells_b = np.concatenate(new_b)
+
+    real = (cells_a >= 0) & (cells_b >= 0)
+    cells_a, cells_b = cells_a[real], cells_b[real]
+
+  return np.concatenate(accepted).reshape(-1, 2), np.concatenate(leaf_pairs).reshape(-1, 2)
+
+########################################################################
+
+def _translate_multipoles_to_locals(local, tree, moments, accepted, G, expansion):
+  '''M2L: add each cell's moments to the local expansion of every cell it was accepted against.'''
+
+  # Each interaction holds its derivatives and every (a, b) product.
+  batch_size = max(1, DEFAULT_MEMORY_BUDGET//(8*(expansion.n_terms + 2*len(expansion.m2l_moments))))
+
+  for start in range(0, len(accepted), batch_size):
+    cells_a, cells_b = accepted[start:start + batch_size].T
+
+    derivatives = expansion.derivatives(tree['centers'][cells_a] - tree['centers'][cells_b])[:, expansion.m2l_derivatives]
+
+    np.add.at(local, cells_a, -G*(moments[cells_b][:, expansion.m2l_moments]*derivatives).dot(expansion.m2l_sums))
+
+    # The other way, D_a(-R) = (-1)^|a| D_a(R).
+    derivatives *= expansion.m2l_parities
+    np.add.at(local, cells_b, -G*(moments[cells_a][:, expansion.m2l_moments]*derivatives).dot(expansion.m2l_sums))
+
+########
+
+def _pass_locals_down(local, tree, expansion):
+  '''L2L: shift each cell's local expansion to its children's centres and add it to theirs.'''
+
+  parents = _get_parents(tree)
+
+  for level in _get_levels(tree)[1:]:
+    local[level] += expansion.shift(local[parents[level]], tree['centers'][level] - tree['centers'][parents[level]], upwards=False)
+
+########################################################################
+
+def _evaluate_locals(local, tree, masses, positions, expansion):
+  '''L2P: the force on each particle from its leaf's local expansion.'''
+
+  n_particles, n_dimensions = positions.shape
+
+  leaves = np.repeat(np.arange(len(tree['half_widths'])), tree['leaf_counts'])
+  order = tree['order']
+
+  monomials = expansion.monomials(positions[order] - tree['centers'][leaves])
+  leaf_local = local[leaves]
+
+  # a_d = -sum_c L_(c + e_d) y^c/c!
+  forces = np.zeros(positions.shape)
+  for d in range(n_dimensions):
+    terms, raised = expansion.gradient_terms[d]
+    forces[order, d] = -masses[order]*(leaf_local[:, raised]*monomials[:, terms]).sum(axis=1)
+
+  return forces
+
+########################################################################
+
+def _calculate_leaf_pair_forces(tree, leaf_pairs, masses, positions, G, softening, softening_kernel):
+  '''P2P: sum the forces between every particle in each pair of nearby leaves directly.'''
+
+  n_particles, n_dimensions = positions.shape
+
+  forces = np.zeros(positions.shape)
+
+  # Batches of leaf pairs with about the same number of particle pairs in each
+  pair_counts = tree['leaf_counts'][leaf_pairs[:, 0]]*tree['leaf_counts'][leaf_pairs[:, 1]]
+  batch_size = max(1, DEFAULT_MEMORY_BUDGET//(8*(3*n_dimensions + 6)))
+  batch_ends = np.searchsorted(np.cumsum(pair_counts), np.arange(batch_size, pair_counts.sum() + batch_size, batch_size), side='right')
+  batch_ends = np.unique(np.clip(np.append(batch_ends, len(leaf_pairs)), 1, len(leaf_pairs)))
+
+  start = 0
+  for end in batch_ends:
+    target_leaves, source_leaves = leaf_pairs[start:end].T
+    counts = pair_counts[start:end]
+    start = end
+
+    # Expand each pair of leaves into its pairs of particles, keeping each pair inside a leaf once.
+    n_sources = np.repeat(tree['leaf_counts'][source_leaves], counts)
+    pair_numbers = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    target_slots = pair_numbers//n_sources
+    source_slots = pair_numbers % n_sources
+
+    keep = (np.repeat(target_leaves != source_leaves, counts)) | (target_slots < source_slots)
+    targets = tree['order'][np.repeat(tree['leaf_starts'][target_leaves], counts)[keep] + target_slots[keep]]
+    sources = tree['order'][np.repeat(tree['leaf_starts'][source_leaves], counts)[keep] + source_slots[keep]]
+
+    displacements = positions[sources] - positions[targets]
+    distances_squared = (displacements**2.).sum(axis=1)
+
+    factors = G*masses[targets]*masses[sources]*n_body_softening.calculate_inverse_cubes(distances_squared, softening, softening_kernel)
+    pair_forces = displacements*factors[:, np.newaxis]
+
+    # Newton's third law
+    n_body_tree._accumulate(forces, targets, pair_forces)
+    n_body_tree._accumulate(forces, sources, -pair_forces)
+
+  return forces
+
+########################################################################
+
+def _get_parents(tree):
+  '''The parent of every node, with -1 for the root.'''
+
+  parents = np.full(len(tree['half_widths']), -1)
+  has_child = tree['children'] >= 0
+  parents[tree['children'][has_child]] = np.nonzero(has_child)[0]
+
+  return parents
+
+def _get_levels(tree):
+  '''The nodes on each level of the tree, root first.'''
+
+  # Each level halves the cell width.
+  depths = np.rint(np.log2(tree['half_widths'][0]/tree['half_widths'])).astype(int)
+
+  return [np.flatnonzero(depths == depth) for depth in range(depths.max() + 1)]
+
+########################################################################
+
+@functools.lru_cache(maxsize=None)
+def _get_expansion(n_dimensions, order):
+  '''The _Expansion for a dimension and order, made once and then reused.'''
+
+  return _Expansion(n_dimensions, order)
+
+class _Expansion(object):
+  '''The multi-indices of a Cartesian expansion, and the index tables for working with them.
+
+  Every quantity indexed by multi-index is stored as a column, in order of |a|.
+  '''
+
+  def __init__(self, n_dimensions, order):
+
+    self.n_dimensions = n_dimensions
+    self.order = order
+
+    self.indices = sorted((a for a in itertools.product(range(order + 1), repeat=n_dimensions) if sum(a) <= order),
+                          key=lambda a: (sum(a), tuple(-k for k in a)))
+    self.n_terms = len(self.indices)
+    position = dict((a, n) for n, a in enumerate(self.indices))
+
+    def step(a, d, amount):
+      b = list(a)
+      b[d] += amount
+      return position.get(tuple(b)) if b[d] >= 0 else None
+
+    # Monomials y^a/a!, each from a lower one: y^a/a! = y^(a - e_k)/(a - e_k)! * y_k/a_k
+    self.monomial_steps = []
+    for n, a in enumerate(self.indices[1:], 1):
+      k = next(d for d in range(n_dimensions) if a[d] > 0)
+      self.monomial_steps.append((n, step(a, k, -1), k, a[k]))
+
+    # Derivatives of 1/r. From r^2 d_k(1/r) = -R_k/r, differentiating by b = a - e_k gives
+    # r^2 D_a = -sum_i c_i R_i D_(a - e_i) - sum_i c'_i D_(a - 2e_i), where c_k = 2a_k - 1,
+    # c_i = 2a_i otherwise, c'_k = (a_k - 1)^2 and c'_i = a_i(a_i - 1) otherwise.
+    self.derivative_steps = []
+    for n, a in enumerate(self.indices[1:], 1):
+      k = next(d for d in range(n_dimensions) if a[d] > 0)
+      first = [(2*a[i] - (i == k), i, step(a, i, -1)) for i in range(n_dimensions) if a[i] > 0]
+      second = [((a[i] - 1)**2 if i == k else a[i]*(a[i] - 1), step(a, i, -2)) for i in range(n_dimensions) if a[i] > 1]
+      self.derivative_steps.append((n, first, [(c, j) for c, j in second if c != 0]))
+
+    # M2L: L_b = sum_a M_a D_(a+b), as a product of gathered columns and a sum matrix
+    pairs = []
+    for b, index_b in enumerate(self.indices):
+      for a, index_a in enumerate(self.indices):
+        if sum(index_a) + sum(index_b) <= order:
+          pairs.append((b, a, position[tuple(np.add(index_a, index_b))]))
+    self.m2l_moments = np.array([a for b, a, ab in pairs])
+    self.m2l_derivatives = np.array([ab for b, a, ab in pairs])
+    self.m2l_parities = np.array([(-1.)**sum(self.indices[ab]) for b, a, ab in pairs])
+    self.m2l_sums = np.zeros((len(pairs), self.n_terms))
+    self.m2l_sums[np.arange(len(pairs)), [b for b, a, ab in pairs]] = 1.
+
+    # Shifts: new_a = sum_(c <= a) old_c s^(a - c)/(a - c)!, upwards for M2M, and
+    # new_c = sum_(a >= c) old_a s^(a - c)/(a - c)!, downwards for L2L
+    self.shift_terms = [(position[a], position[c], position[tuple(np.subtract(a, c))])
+                        for a in self.indices for c in self.indices if all(np.less_equal(c, a))]
+
+    # L2P: a_d = -sum_c L_(c + e_d) y^c/c!
+    self.gradient_terms = []
+    for d in range(n_dimensions):
+      terms = [(n, step(c, d, 1)) for n, c in enumerate(self.indices) if sum(c) < order]
+      self.gradient_terms.append((np.array([n for n, raised in terms]), np.array([raised for n, raised in terms])))
+
+  def monomials(self, y):
+    '''y^a/a! for every multi-index a, shape (n_points, n_terms).'''
+
+    values = np.empty((y.shape[0], self.n_terms))
+    values[:, 0] = 1.
+    for n, lower, k, a_k in self.monomial_steps:
+      values[:, n] = values[:, lower]*y[:, k]/a_k
+
+    return values
+
+  def derivatives(self, R):
+    '''The derivatives D_a of 1/|R| for every multi-index a, shape (n_points, n_terms).'''
+
+    distances_squared = (R**2.).sum(axis=1)
+
+    values = np.empty((R.shape[0], self.n_terms))
+    values[:, 0] = 1./np.sqrt(distances_squared)
+    for n, first, second in self.derivative_steps:
+      total = 0.
+      for c, i, lower in first:
+        total = total + c*R[:, i]*values[:, lower]
+      for c, lower in second:
+        total = total + c*values[:, lower]
+      values[:, n] = -total/distances_squared
+
+    return values
+
+  def shift(self, coefficients, s, upwards):
+    '''Shift moments (upwards=True) or local expansions (upwards=False) by s.
+
+    Args:
+    coefficients -- Array of coefficients, shape (n_cells, n_terms)
+    s -- Array of the new centres minus the old ones, shape (n_cells, n_dimensions)
+
+    Returns:
+    shifted -- Array of shifted coefficients, shape (n_cells, n_terms)
+    '''
+
+    powers = self.monomials(s)
+
+    shifted = np.zeros(coefficients.shape)
+    for a, c, difference in self.shift_terms:
+      if upwards:
+        shifted[:, a] += coefficients[:, c]*powers[:, difference]
+      else:
+        shifted[:, c] += coefficients[:, a]*powers[:, difference]
+
+    return shifted
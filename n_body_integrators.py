@@ -0,0 +1,613 @@
+'''
+Integrators that advance the particles through one timestep.
+
+Integrators are objects, rather than plain functions, so they can remember the accelerations from
+the end of one step and reuse them at the start of the next. Every integrator has
+  step(particles, parameters) -- Advance the particles by parameters['dt']
+  n_force_evaluations -- How many times the forces on every particle have been calculated
+  get_state(particles, parameters), set_state(state, particles, parameters) -- For checkpoints
+The leapfrog, composition and Runge-Kutta integrators get their forces from n_body_physics, so any
+parameters['force_method'] can be used with them. The Hermite integrators also need the jerks, so
+they sum the accelerations and jerks together over every pair, and only work with the default
+'direct' force_method, in full precision.
+
+INTEGRATORS maps the names used for parameters['integrator'] to the integrator classes.
+'''
+
+import numpy as np
+
+import n_body_encounters
+import n_body_physics
+
+# The parameters that change the accelerations, for a given set of positions and masses.
+FORCE_PARAMETERS = ('G', 'force_method', 'theta', 'leaf_size', 'softening', 'softening_kernel', 'mixed_precision',
+                    'fmm_order', 'fmm_theta', 'fmm_leaf_size', 'box_size', 'pm_grid_size', 'pm_split', 'pm_cutoff')
+
+# Default accuracy parameter for block timesteps, which are chosen as dt = eta*|a|/|jerk|.
+DEFAULT_ETA = 0.02
+
+# Default limit on how many times parameters['dt'] can be halved for block timesteps.
+DEFAULT_MAX_LEVEL = 20
+
+# Default error tolerance for the adaptive Runge-Kutta integrator.
+DEFAULT_TOLERANCE = 1.e-10
+
+########################################################################
+
+def make_integrator(parameters):
+  '''Make the integrator named by parameters['integrator'], which defaults to 'leapfrog'.
+
+  Args:
+  parameters -- The simulation parameter information
+  '''
+
+  name = parameters.get('integrator', 'leapfrog')
+
+  if name not in INTEGRATORS:
+    raise ValueError('Unknown integrator: {}. Choose from {}.'.format(name, sorted(INTEGRATORS)))
+
+  return INTEGRATORS[name]()
+
+########################################################################
+
+def register_integrator(name, integrator_class):
+  '''Make an integrator available as parameters['integrator'] = name.
+
+  Args:
+  name -- The name to use for the integrator
+  integrator_class -- The integrator class, which is made with no arguments
+  '''
+
+  INTEGRATORS[name] = integrator_class
+
+########################################################################
+
+class LeapfrogIntegrator(object):
+  '''Kick-drift-kick leapfrog, also known as velocity Verlet.
+
+  Only one force evaluation is needed per step, because the accelerations at the end of a step are
+  the accelerations at the start of the next. The cached accelerations are thrown away whenever the
+  positions, masses or force parameters no longer match the ones they were calculated from, e.g.
+  when the caller edits particles between steps.
+  '''
+
+  def __init__(self):
+
+    self.accelerations = None
+    self.n_force_evaluations = 0
+
+    # What the cached accelerations were calculated from
+    self._positions = None
+    self._masses = None
+    self._force_parameters = None
+
+  def step(self, particles, parameters):
+    '''Advance the particles by parameters['dt'].
+
+    Args:
+    particles -- The particle information
+    parameters -- The simulation parameter information
+    '''
+
+    self.kick_drift_kick(particles, parameters, parameters['dt'])
+
+  def kick_drift_kick(self, particles, parameters, dt):
+    '''Advance the particles by dt with one leapfrog step.
+
+    Pairs found by n_body_encounters.find_encounter_pairs() leave their mutual gravity out of the
+    kicks and follow their Kepler orbit during the drift instead.
+    '''
+
+    accelerations = self.get_accelerations(particles, parameters)
+
+    pairs = n_body_encounters.find_encounter_pairs(particles, parameters, dt)
+    if len(pairs) > 0:
+      accelerations = accelerations - n_body_encounters.calculate_pair_accelerations(particles, parameters, pairs)
+
+    # Kick
+    n_body_physics.kick(particles, parameters, accelerations, 0.5*dt)
+
+    # Drift
+    if len(pairs) > 0:
+      n_body_encounters.drift(particles, parameters, pairs, dt)
+    else:
+      n_body_physics.drift(particles, parameters, dt)
+
+    # Kick
+    accelerations = self.calculate_accelerations(particles, parameters)
+    if len(pairs) > 0:
+      accelerations = accelerations - n_body_encounters.calculate_pair_accelerations(particles, parameters, pairs)
+    n_body_physics.kick(particles, parameters, accelerations, 0.5*dt)
+
+  def get_accelerations(self, particles, parameters):
+    '''Get the accelerations at the current positions, reusing the cached ones if they are still valid.'''
+
+    if self.is_cache_valid(particles, parameters):
+      return self.accelerations
+
+    return self.calculate_accelerations(particles, parameters)
+
+  def calculate_accelerations(self, particles, parameters):
+    '''Calculate the accelerations at the current positions, and cache them.'''
+
+    self.accelerations = n_body_physics.calculate_accelerations(particles, parameters)
+    self.n_force_evaluations += 1
+
+    self._positions = np.array(particles['positions'], copy=True)
+    self._masses = np.array(particles['masses'], copy=True)
+    self._force_parameters = [parameters.get(key) for key in FORCE_PARAMETERS]
+
+    return self.accelerations
+
+  def is_cache_valid(self, particles, parameters):
+    '''Check whether the cached accelerations still belong to particles and parameters.'''
+
+    if self.accelerations is None:
+      return False
+
+    if self._force_parameters != [parameters.get(key) for key in FORCE_PARAMETERS]:
+      return False
+
+    return np.array_equal(self._positions, particles['positions']) and np.array_equal(self._masses, particles['masses'])
+
+  def invalidate(self):
+    '''Throw away the cached accelerations.'''
+
+    self.accelerations = None
+
+  def get_state(self, particles, parameters):
+    '''Everything needed to carry on exactly where this integrator left off, as a dictionary of
+    arrays and numbers. The cached accelerations are only included while they are valid.'''
+
+    state = {'n_force_evaluations' : self.n_force_evaluations}
+
+    if self.is_cache_valid(particles, parameters):
+      state['accelerations'] = self.accelerations
+
+    return state
+
+  def set_state(self, state, particles, parameters):
+    '''Restore the state from get_state(). The cached accelerations are taken to belong to the
+    current particles and parameters.'''
+
+    self.n_force_evaluations = state['n_force_evaluations']
+
+    if 'accelerations' in state:
+      self.accelerations = np.array(state['accelerations'], copy=True)
+      self._positions = np.array(particles['positions'], copy=True)
+      self._masses = np.array(particles['masses'], copy=True)
+      self._force_parameters = [parameters.get(key) for key in FORCE_PARAMETERS]
+
+########################################################################
+
+class BlockHermiteIntegrator(object):
+  '''Fourth-order Hermite integrator with individual, power-of-two block timesteps.
+
+  Each particle has its own timestep parameters['dt']/2**level, chosen from its acceleration and jerk
+  with dt = parameters['eta']*|a|/|jerk|. A step of parameters['dt'] is split into substeps. On each
+  substep every particle is predicted forward, but only the "active" particles, whose own timesteps
+  end there, have their forces recalculated and are corrected. At the end of the step every particle
+  is back in sync.
+
+  stats counts the force evaluations on single particles, and how many a single global timestep
+  as small as the smallest particle timestep would have needed.
+  '''
+
+  def __init__(self):
+
+    self.accelerations = None
+    self.jerks = None
+    self.levels = None
+
+    # In units of force evaluations on every particle
+    self.n_force_evaluations = 0.
+
+    self.stats = {
+      'particle_force_evaluations' : 0,
+      'global_particle_force_evaluations' : 0,
+      'substeps' : 0,
+    }
+
+    # What the cached accelerations and jerks were calculated from
+    self._positions = None
+    self._velocities = None
+    self._masses = None
+    self._force_parameters = None
+
+  def step(self, particles, parameters):
+    '''Advance the particles by parameters['dt'].
+
+    Args:
+    particles -- The particle information
+    parameters -- The simulation parameter information. Uses 'eta' and 'max_level' if they are given.
+    '''
+
+    self.check_parameters(parameters)
+
+    dt = parameters['dt']
+    eta = parameters.get('eta', DEFAULT_ETA)
+    max_level = self.get_max_level(parameters)
+
+    masses = np.asarray(particles['masses'], dtype=float)
+    n_particles = masses.size
+
+    if not self.is_cache_valid(particles, parameters):
+      self.accelerations, self.jerks = n_body_physics.calculate_accelerations_and_jerks(particles, parameters)
+      self.count_force_evaluations(n_particles, n_particles)
+      self.levels = choose_levels(self.accelerations, self.jerks, dt, eta, max_level)
+
+    # Times are counted in ticks of the smallest allowed timestep, from the start of this step.
+    n_ticks = 2**max_level
+    tick = dt/n_ticks
+    times = np.zeros(n_particles, dtype=np.int64)
+
+    # Each particle's state at its own time
+    positions = np.array(particles['positions'], dtype=float)
+    velocities = np.array(particles['velocities'], dtype=float)
+    accelerations = self.accelerations
+    jerks = self.jerks
+    levels = self.levels
+
+    deepest_level = levels.max()
+
+    while True:
+
+      step_ticks = np.int64(2)**(max_level - levels)
+      next_times = times + step_ticks
+      next_time = next_times.min()
+      active = np.flatnonzero(next_times == next_time)
+
+      # Predict everybody forward to the end of the substep.
+      taus = ((next_time - times)*tick)[:, np.newaxis]
+      predicted = {
+        'masses' : masses,
+        'positions' : positions + taus*(velocities + taus*(accelerations/2. + taus*jerks/6.)),
+        'velocities' : velocities + taus*(accelerations + taus*jerks/2.),
+      }
+
+      new_accelerations, new_jerks = n_body_physics.calculate_accelerations_and_jerks(predicted, parameters, active)
+      self.count_force_evaluations(active.size, n_particles)
+
+      # Correct the active particles.
+      h = taus[active]
+      new_velocities = velocities[active] + h/2.*(accelerations[active] + new_accelerations) + h**2./12.*(jerks[active] - new_jerks)
+      new_positions = positions[active] + h/2.*(velocities[active] + new_velocities) + h**2./12.*(accelerations[active] - new_accelerations)
+
+      positions[active] = new_positions
+      velocities[active] = new_velocities
+      accelerations[active] = new_accelerations
+      jerks[active] = new_jerks
+      times[active] = next_time
+
+      # Pick the next timesteps. A timestep may only double if the particle stays in step with it.
+      old_levels = levels[active]
+      new_levels = np.maximum(choose_levels(new_accelerations, new_jerks, dt, eta, max_level), old_levels - 1)
+      out_of_sync = (new_levels < old_levels) & (next_time % (2*step_ticks[active]) != 0)
+      new_levels[out_of_sync] = old_levels[out_of_sync]
+      levels[active] = new_levels
+
+      deepest_level = max(deepest_level, new_levels.max())
+      self.stats['substeps'] += 1
+
+      if next_time == n_ticks:
+        break
+
+    self.stats['global_particle_force_evaluations'] += n_particles*2**int(deepest_level)
+
+    particles['positions'][:] = positions
+    particles['velocities'][:] = velocities
+
+    self.remember_particles(particles, parameters)
+
+  def check_parameters(self, parameters):
+    '''Make sure the forces can be calculated as parameters asks. The accelerations and jerks are
+    summed together over every pair, in full precision and without periodic images, so no other
+    force_method can be used, and nor can a periodic box.'''
+
+    force_method = parameters.get('force_method', 'direct')
+    if force_method != 'direct':
+      raise ValueError("The Hermite integrators sum the forces directly, so can't use force_method {}.".format(force_method))
+
+    if parameters.get('mixed_precision', False):
+      raise ValueError("The Hermite integrators sum the forces in full precision, so can't use mixed_precision.")
+
+    if parameters.get('box_size') is not None:
+      raise ValueError("The Hermite integrators sum the forces in open space, so can't use a periodic box_size.")
+
+  def get_max_level(self, parameters):
+    '''How many times parameters['dt'] can be halved.'''
+
+    return parameters.get('max_level', DEFAULT_MAX_LEVEL)
+
+  def count_force_evaluations(self, n_evaluated, n_particles):
+    '''Keep track of how many particles had their forces calculated.'''
+
+    self.stats['particle_force_evaluations'] += n_evaluated
+    self.n_force_evaluations += float(n_evaluated)/n_particles
+
+  def savings(self):
+    '''How many times fewer force evaluations were needed than with a single global timestep.'''
+
+    if self.stats['particle_force_evaluations'] == 0:
+      return 1.
+
+    return float(self.stats['global_particle_force_evaluations'])/self.stats['particle_force_evaluations']
+
+  def remember_particles(self, particles, parameters):
+    '''Note what the cached accelerations and jerks belong to.'''
+
+    self._positions = np.array(particles['positions'], copy=True)
+    self._velocities = np.array(particles['velocities'], copy=True)
+    self._masses = np.array(particles['masses'], copy=True)
+    self._force_parameters = [parameters.get(key) for key in FORCE_PARAMETERS]
+
+  def is_cache_valid(self, particles, parameters):
+    '''Check whether the cached accelerations and jerks still belong to particles and parameters.'''
+
+    if self.accelerations is None:
+      return False
+
+    if self._force_parameters != [parameters.get(key) for key in FORCE_PARAMETERS]:
+      return False
+
+    return np.array_equal(self._positions, particles['positions']) and np.array_equal(self._velocities, particles['velocities']) \
+      and np.array_equal(self._masses, particles['masses'])
+
+  def invalidate(self):
+    '''Throw away the cached accelerations and jerks.'''
+
+    self.accelerations = None
+
+  def get_state(self, particles, parameters):
+    '''Everything needed to carry on exactly where this integrator left off.'''
+
+    state = {'n_force_evaluations' : self.n_force_evaluations}
+    for key, value in self.stats.items():
+      state['stats_' + key] = value
+
+    if self.is_cache_valid(particles, parameters):
+      state['accelerations'] = self.accelerations
+      state['jerks'] = self.jerks
+      state['levels'] = self.levels
+
+    return state
+
+  def set_state(self, state, particles, parameters):
+    '''Restore the state from get_state().'''
+
+    self.n_force_evaluations = state['n_force_evaluations']
+    for key in self.stats:
+      self.stats[key] = state['stats_' + key]
+
+    if 'accelerations' in state:
+      self.accelerations = np.array(state['accelerations'], copy=True)
+      self.jerks = np.array(state['jerks'], copy=True)
+      self.levels = np.array(state['levels'], copy=True)
+      self.remember_particles(particles, parameters)
+
+########################################################################
+
+def choose_levels(accelerations, jerks, dt, eta, max_level):
+  '''Choose block timestep levels, so each particle's timestep dt/2**level is no bigger than
+  eta*|a|/|jerk|.
+
+  Args:
+  accelerations -- Array of accelerations, shape (n_particles, n_dimensions)
+  jerks -- Array of jerks, shape (n_particles, n_dimensions)
+  dt -- The largest timestep
+  eta -- Accuracy parameter
+  max_level -- The deepest level allowed
+
+  Returns:
+  levels -- Array of integer levels, shape (n_particles,)
+  '''
+
+  acceleration_sizes = np.linalg.norm(accelerations, axis=1)
+  jerk_sizes = np.linalg.norm(jerks, axis=1)
+
+  # Particles with no jerk can take the largest timestep.
+  ideal_dts = np.full(acceleration_sizes.shape, np.inf)
+  np.divide(eta*acceleration_sizes, jerk_sizes, out=ideal_dts, where=jerk_sizes > 0.)
+
+  with np.errstate(divide='ignore'):
+    levels = np.ceil(np.log2(dt/ideal_dts))
+
+  return np.clip(np.nan_to_num(levels, nan=max_level), 0, max_level).astype(np.int64)
+
+########################################################################
+
+class HermiteIntegrator(BlockHermiteIntegrator):
+  '''Fourth-order Hermite predictor-corrector with one shared timestep, parameters['dt'].
+
+  Needs one force and jerk evaluation per step. Like the block timestep version, the forces are
+  always summed directly.
+  '''
+
+  def get_max_level(self, parameters):
+    '''Every particle takes the full step.'''
+
+    return 0
+
+########################################################################
+
+class CompositionIntegrator(LeapfrogIntegrator):
+  '''A symplectic integrator made of several leapfrog steps with carefully chosen lengths.
+
+  Each leapfrog substep needs one force evaluation, since the accelerations are still cached
+  between substeps.
+  '''
+
+  # Fractions of dt taken by each leapfrog substep, which add up to 1
+  weights = (1.,)
+
+  def step(self, particles, parameters):
+    '''Advance the particles by parameters['dt'].
+
+    Args:
+    particles -- The particle information
+    parameters -- The simulation parameter information
+    '''
+
+    for weight in self.weights:
+      self.kick_drift_kick(particles, parameters, weight*parameters['dt'])
+
+########################################################################
+
+class ForestRuthIntegrator(CompositionIntegrator):
+  '''Fourth-order symplectic integrator of Forest & Ruth (1990), also found by Yoshida (1990).
+  Three force evaluations per step.'''
+
+  weights = (1./(2. - 2.**(1./3.)), -2.**(1./3.)/(2. - 2.**(1./3.)), 1./(2. - 2.**(1./3.)))
+
+########################################################################
+
+class Yoshida6Integrator(CompositionIntegrator):
+  '''Sixth-order symplectic integrator of Yoshida (1990), solution A. Seven force evaluations
+  per step.'''
+
+  _w1 = -1.17767998417887
+  _w2 = 0.235573213359357
+  _w3 = 0.784513610477560
+  _w0 = 1. - 2.*(_w1 + _w2 + _w3)
+
+  weights = (_w3, _w2, _w1, _w0, _w1, _w2, _w3)
+
+########################################################################
+
+class DormandPrinceIntegrator(LeapfrogIntegrator):
+  '''Adaptive embedded Runge-Kutta 5(4) integrator of Dormand & Prince (1980).
+
+  Each step of parameters['dt'] is covered by as many substeps as are needed to keep the estimated
+  error of each substep below parameters['tolerance'], relative to the size of the positions and
+  velocities. The substep size carries over from one step to the next. The last stage of a substep is
+  the first stage of the next, so an accepted substep needs six force evaluations.
+  '''
+
+  # The Butcher tableau
+  c = np.array([0., 1./5., 3./10., 4./5., 8./9., 1., 1.])
+  a = [
+    [],
+    [1./5.],
+    [3./40., 9./40.],
+    [44./45., -56./15., 32./9.],
+    [19372./6561., -25360./2187., 64448./6561., -212./729.],
+    [9017./3168., -355./33., 46732./5247., 49./176., -5103./18656.],
+    [35./384., 0., 500./1113., 125./192., -2187./6784., 11./84.],
+  ]
+  # Fifth order weights are the last row of a. These are the differences from the fourth order ones.
+  error_weights = np.array([71./57600., 0., -71./16695., 71./1920., -17253./339200., 22./525., -1./40.])
+
+  def __init__(self):
+
+    LeapfrogIntegrator.__init__(self)
+
+    # The substep size, which is remembered between steps
+    self.substep = None
+
+  def step(self, particles, parameters):
+    '''Advance the particles by parameters['dt'].
+
+    Args:
+    particles -- The particle information
+    parameters -- The simulation parameter information. Uses 'tolerance' if it is given.
+    '''
+
+    dt = parameters['dt']
+    tolerance = parameters.get('tolerance', DEFAULT_TOLERANCE)
+
+    if self.substep is None:
+      self.substep = dt
+
+    remaining = dt
+    while remaining > 0.:
+
+      h = min(self.substep, remaining)
+      error = self.try_substep(particles, parameters, h, tolerance)
+
+      # Grow or shrink the substep for the error to match the tolerance.
+      factor = 5. if error == 0. else min(5., max(0.2, 0.9*error**-0.2))
+      if error <= 1.:
+        remaining -= h
+        # Only grow the substep if the whole of it was used.
+        if h == self.substep or factor < 1.:
+          self.substep = h*factor
+      else:
+        self.substep = h*factor
+
+  def try_substep(self, particles, parameters, h, tolerance):
+    '''Attempt one substep of length h. Keep it if the error is small enough.
+
+    Returns:
+    error -- The estimated error relative to the tolerance. The substep was kept if this is at most 1.
+    '''
+
+    positions = np.array(particles['positions'], dtype=float)
+    velocities = np.array(particles['velocities'], dtype=float)
+
+    stage = {'masses' : particles['masses']}
+
+    # The derivatives of the positions and velocities at each stage
+    position_rates = [velocities]
+    velocity_rates = [self.get_accelerations(particles, parameters)]
+
+    for i in range(1, 7):
+      stage['positions'] = positions + h*sum(weight*rate for weight, rate in zip(self.a[i], position_rates) if weight != 0.)
+      stage_velocities = velocities + h*sum(weight*rate for weight, rate in zip(self.a[i], velocity_rates) if weight != 0.)
+
+      position_rates.append(stage_velocities)
+      velocity_rates.append(n_body_physics.calculate_accelerations(stage, parameters))
+      self.n_force_evaluations += 1
+
+    # The last stage is the fifth order solution.
+    new_positions = stage['positions']
+    new_velocities = position_rates[-1]
+
+    position_error = h*sum(weight*rate for weight, rate in zip(self.error_weights, position_rates) if weight != 0.)
+    velocity_error = h*sum(weight*rate for weight, rate in zip(self.error_weights, velocity_rates) if weight != 0.)
+
+    tiny = np.finfo(float).tiny
+    position_scale = tolerance*max(np.maximum(np.abs(positions), np.abs(new_positions)).max(), tiny)
+    velocity_scale = tolerance*max(np.maximum(np.abs(velocities), np.abs(new_velocities)).max(), tiny)
+
+    error = max(np.abs(position_error).max()/position_scale, np.abs(velocity_error).max()/velocity_scale)
+
+    if error <= 1.:
+      particles['positions'][:] = new_positions
+      particles['velocities'][:] = new_velocities
+
+      # First same as last: the final stage's accelerations start the next substep.
+      self.accelerations = velocity_rates[-1]
+      self._positions = np.array(particles['positions'], copy=True)
+      self._masses = np.array(particles['masses'], copy=True)
+      self._force_parameters = [parameters.get(key) for key in FORCE_PARAMETERS]
+
+    return error
+
+  def get_state(self, particles, parameters):
+    '''Everything needed to carry on exactly where this integrator left off.'''
+
+    state = LeapfrogIntegrator.get_state(self, particles, parameters)
+    if self.substep is not None:
+      state['substep'] = self.substep
+
+    return state
+
+  def set_state(self, state, particles, parameters):
+    '''Restore the state from get_state().'''
+
+    LeapfrogIntegrator.set_state(self, state, particles, parameters)
+    self.substep = state.get('substep')
+
+########################################################################
+# The available integrators
+########################################################################
+
+INTEGRATORS = {
+  'leapfrog' : LeapfrogIntegrator,
+  'hermite' : HermiteIntegrator,
+  'block_hermite' : BlockHermiteIntegrator,
+  'forest_ruth' : ForestRuthIntegrator,
+  'yoshida4' : ForestRuthIntegrator,
+  'yoshida6' : Yoshida6Integrator,
+  'dormand_prince' : DormandPrinceIntegrator,
+}
@@ -0,0 +1,287 @@
+'''
+Neighbour lists: every pair of particles closer than some radius, found with a cell list and kept
+between steps as a Verlet list.
+
+The particles are put into cubic cells at least radius + skin wide, by sorting them on their cell's
+key, so each cell is a contiguous run of the sorted particles. Every particle is then checked
+against the particles in its own cell and in the neighbouring cells, which holds every pair within
+radius + skin. Only the cells that hold particles are stored, so open boundaries with a few distant
+particles don't need a huge grid.
+
+The pairs are kept, and reused until some particle has moved more than skin/2 since they were
+found: until then no two particles can have come from further than radius + skin apart to within
+radius. The kernels that use the pairs drop the ones that are further apart than radius.
+
+The pairs are stored in compressed sparse row (CSR) form: the particles after i that are paired with
+it are neighbours[offsets[i]:offsets[i + 1]], so each pair is held once, with i < j.
+
+With a box_size, the box [0, box_size)^n_dimensions is periodic and pairs are found between nearest
+periodic images.
+'''
+
+import itertools
+
+import numpy as np
+
+# Bits in the cell keys, which are shared between the dimensions
+KEY_BITS = 62
+
+########################################################################
+
+def find_pairs(positions, radius, box_size=None):
+  '''Find every pair of particles closer than radius.
+
+  Args:
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  radius -- The largest separation to find
+  box_size -- Side length of the periodic box, or None for open boundaries
+
+  Returns:
+  pairs -- Array of particle indices (i, j) with i < j, shape (n_pairs, 2)
+  '''
+
+  return NeighbourIndex(radius, 0., box_size).find_pairs(positions)
+
+########################################################################
+
+def get_nearest_images(displacements, box_size):
+  '''Replace displacements in a periodic box by those to the nearest periodic image, in place.
+
+  Args:
+  displacements -- Array of displacements, shape (n, n_dimensions)
+  box_size -- Side length of the periodic box
+
+  Returns:
+  displacements -- The same array
+  '''
+
+  displacements -= box_size*np.round(displacements/box_size)
+
+  return displacements
+
+########################################################################
+
+def get_rows(offsets):
+  '''The first particle of each pair in a CSR pair list.
+
+  Args:
+  offsets -- The CSR row offsets, shape (n_particles + 1,)
+
+  Returns:
+  rows -- Array of particle indices, shape (n_pairs,)
+  '''
+
+  return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+########################################################################
+
+class NeighbourIndex(object):
+  '''A cell list of the particles, and the Verlet list of pairs found with it.'''
+
+  def __init__(self, radius, skin=0., box_size=None):
+    '''
+    Args:
+    radius -- The largest separation the pairs are needed for
+    skin -- How much further apart to look, so the pairs can be reused while the particles move
+      less than skin/2
+    box_size -- Side length of the periodic box, or None for open boundaries
+    '''
+
+    if radius < 0. or skin < 0.:
+      raise ValueError('radius and skin must not be negative, got {} and {}.'.format(radius, skin))
+
+    if box_size is not None and radius + skin > box_size/2.:
+      raise ValueError('radius + skin, {}, must be at most half of box_size, {}.'.format(radius + skin, box_size))
+
+    self.radius = radius
+    self.skin = skin
+    self.box_size = box_size
+
+    self.offsets = None
+    self.neighbours = None
+    self.n_builds = 0
+
+    self._positions = None
+
+  @property
+  def n_pairs(self):
+
+    return 0 if self.neighbours is None else len(self.neighbours)
+
+  def update(self, positions):
+    '''Find the pairs again if the particles have moved too far since they were last found.
+
+    Args:
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+
+    Returns:
+    rebuilt -- Whether the pairs were found again
+    '''
+
+    if self.needs_rebuild(positions):
+      self.rebuild(positions)
+      return True
+
+    return False
+
+  def needs_rebuild(self, positions):
+    '''Check whether any particle has moved more than skin/2 since the pairs were found.'''
+
+    if self._positions is None or self._positions.shape != positions.shape:
+      return True
+
+    displacements = positions - self._positions
+    if self.box_size is not None:
+      get_nearest_images(displacements, self.box_size)
+
+    return (displacements**2.).sum(axis=1).max(initial=0.) > (self.skin/2.)**2.
+
+  def rebuild(self, positions):
+    '''Sort the particles into cells and find every pair within radius + skin.
+
+    Args:
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+    '''
+
+    positions = np.asarray(positions, dtype=float)
+    n_particles = positions.shape[0]
+
+    i, j = self._find_candidates(positions)
+
+    close = _get_distances_squared(positions, i, j, self.box_size) <= (self.radius + self.skin)**2.
+
+    i, j = np.minimum(i[close], j[close]), np.maximum(i[close], j[close])
+    order = np.argsort(i, kind='stable')
+
+    self.neighbours = j[order]
+    self.offsets = np.zeros(n_particles + 1, dtype=np.int64)
+    np.cumsum(np.bincount(i, minlength=n_particles), out=self.offsets[1:])
+
+    self._positions = positions.copy()
+    self.n_builds += 1
+
+  def get_pairs(self, positions):
+    '''Get the Verlet list for the current positions, finding it again if it is out of date.
+
+    Args:
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+
+    Returns:
+    offsets -- The CSR row offsets, shape (n_particles + 1,)
+    neighbours -- The second particle of each pair, shape (n_pairs,). Every pair within radius
+      is included, as well as some further apart, up to radius + skin.
+    '''
+
+    self.update(positions)
+
+    return self.offsets, self.neighbours
+
+  def find_pairs(self, positions):
+    '''Find every pair of particles currently closer than radius, using the Verlet list.
+
+    Args:
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+
+    Returns:
+    pairs -- Array of particle indices (i, j) with i < j, shape (n_pairs, 2)
+    '''
+
+    offsets, neighbours = self.get_pairs(positions)
+    i = get_rows(offsets)
+
+    close = _get_distances_squared(positions, i, neighbours, self.box_size) <= self.radius**2.
+
+    return np.array([i[close], neighbours[close]]).T.reshape(-1, 2)
+
+  def _find_candidates(self, positions):
+    '''Pair every particle with those after it in its own cell and with every particle in half of
+    the neighbouring cells, so each nearby pair turns up once.'''
+
+    n_particles, n_dimensions = positions.shape
+    reach = self.radius + self.skin
+
+    if n_particles == 0:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    max_cells = 2**(KEY_BITS//n_dimensions)
+
+    if self.box_size is not None:
+      n_cells = int(self.box_size//reach) if reach > 0. else max_cells
+      n_cells = np.full(n_dimensions, min(n_cells, max_cells))
+      lower = np.zeros(n_dimensions)
+      width = self.box_size/n_cells
+      positions = np.mod(positions, self.box_size)
+    else:
+      lower = positions.min(axis=0)
+      extent = positions.max(axis=0) - lower
+      width = np.maximum(reach, extent/(max_cells - 1))
+      width[width == 0.] = 1.
+      n_cells = np.floor(extent/width).astype(np.int64) + 1
+
+    # With fewer than three cells along a side of a periodic box, a cell's neighbours overlap, so
+    # check every pair.
+    if self.box_size is not None and n_cells[0] < 3:
+      return np.triu_indices(n_particles, 1)
+
+    cells = np.minimum(((positions - lower)/width).astype(np.int64), n_cells - 1)
+    keys = np.ravel_multi_index(cells.T, n_cells)
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    sorted_cells = cells[order]
+
+    cell_keys, starts, counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+    cell_numbers = np.searchsorted(cell_keys, sorted_keys)
+
+    # Within a cell, each particle is paired with the ones after it.
+    remaining = starts[cell_numbers] + counts[cell_numbers] - np.arange(n_particles) - 1
+    first = [np.repeat(np.arange(n_particles), remaining)]
+    second = [_expand_ranges(np.arange(n_particles) + 1, remaining)]
+
+    # Half of the neighbouring cells, so each pair of cells is checked once.
+    for offset in itertools.product([-1, 0, 1], repeat=n_dimensions):
+      if offset <= (0,)*n_dimensions:
+        continue
+
+      neighbour_cells = sorted_cells + offset
+      if self.box_size is not None:
+        neighbour_cells %= n_cells
+        inside = np.ones(n_particles, dtype=bool)
+      else:
+        inside = np.all((neighbour_cells >= 0) & (neighbour_cells < n_cells), axis=1)
+
+      neighbour_keys = np.ravel_multi_index(neighbour_cells[inside].T, n_cells)
+      found = np.minimum(np.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+      neighbour_counts = np.where(cell_keys[found] == neighbour_keys, counts[found], 0)
+
+      first.append(np.repeat(np.nonzero(inside)[0], neighbour_counts))
+      second.append(_expand_ranges(starts[found], neighbour_counts))
+
+    return order[np.concatenate(first)], order[np.concatenate(second)]
+
+########################################################################
+
+def _get_distances_squared(positions, i, j, box_size=None):
+  '''The squared distances between the particles in each pair, one dimension at a time, which
+  gathers from contiguous columns.'''
+
+  distances_squared = np.zeros(len(i))
+
+  for column in np.ascontiguousarray(np.transpose(positions)):
+    displacements = column[j] - column[i]
+    if box_size is not None:
+      displacements -= box_size*np.round(displacements/box_size)
+    displacements *= displacements
+    distances_squared += displacements
+
+  return distances_squared
+
+########################################################################
+
+def _expand_ranges(starts, counts):
+  '''Concatenate the ranges starts[k], ..., starts[k] + counts[k] - 1.'''
+
+  total = counts.sum()
+  offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+  return np.repeat(starts, counts) + offsets
@@ -0,0 +1,242 @@
+'''
+Compiled kernels for the direct force sum and the leapfrog kick and drift, using Numba.
+
+They are used automatically when Numba can be imported, unless parameters['use_numba'] is False.
+Without Numba the same functions run as plain Python loops, but n_body_physics uses its NumPy
+kernels instead, so nothing gets slower.
+
+The kernels loop over the particles directly, so they need no temporary arrays. Each kernel is
+compiled the first time it is used with a given set of options, which come from the parameters:
+  numba_parallel -- True (the default) to spread the force sum over all cores, False not to
+  numba_fastmath -- True to let the compiler reorder floating point operations. Faster, but the kick
+    and drift no longer match the NumPy versions bit for bit. Defaults to False.
+Numba's disk cache doesn't tell compile options apart, so only the kernels compiled with the
+default options are cached on disk, next to this file. The others are compiled once per process.
+
+Numba's threading layer is left for the user to choose, e.g. with NUMBA_THREADING_LAYER.
+'''
+
+import numpy as np
+
+import n_body_softening
+
+try:
+  import numba
+except ImportError:
+  numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# How the kernels are told which softening to use
+SOFTENING_CODES = {'plummer' : 1, 'spline' : 2}
+
+if NUMBA_AVAILABLE:
+  prange = numba.prange
+else:
+  prange = range
+
+# The compiled kernels, by name and compile options
+_dispatchers = {}
+
+########################################################################
+
+def get_kernel(name, parallel=True, fastmath=False):
+  '''Get a kernel compiled with the given options, compiling it the first time it is asked for.
+
+  Args:
+  name -- The kernel's name in KERNELS
+  parallel -- Whether to spread the kernel's loop over all cores, if it can be
+  fastmath -- Whether to let the compiler reorder floating point operations
+
+  Returns:
+  kernel -- The compiled kernel, or the plain Python function without Numba
+  '''
+
+  function, can_run_in_parallel = KERNELS[name]
+
+  if not NUMBA_AVAILABLE:
+    return function
+
+  parallel = bool(parallel) and can_run_in_parallel
+  fastmath = bool(fastmath)
+
+  key = (name, parallel, fastmath)
+  if key not in _dispatchers:
+    cache = parallel == can_run_in_parallel and not fastmath
+    _dispatchers[key] = numba.njit(parallel=parallel, fastmath=fastmath, cache=cache)(function)
+
+  return _dispatchers[key]
+
+########################################################################
+
+def _inline(function):
+  '''Compile a helper that the kernels call, so it is inlined into them with their options.'''
+
+  if not NUMBA_AVAILABLE:
+    return function
+
+  return numba.njit(inline='always')(function)
+
+########################################################################
+
+def use_numba(parameters):
+  '''Check whether the compiled kernels should be used.
+
+  Args:
+  parameters -- The simulation parameter information
+  '''
+
+  return NUMBA_AVAILABLE and parameters.get('use_numba', True)
+
+########################################################################
+
+def calculate_numba_forces(masses, positions, G, softening=0., softening_kernel='plummer', potentials=None,
+                           parallel=True, fastmath=False):
+  '''Calculate the net force on every particle with the compiled direct sum.
+
+  Each target particle is handled by one thread, so Newton's third law isn't used: every pair is
+  visited twice, but no two threads ever write to the same place.
+
+  Args:
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  G -- The gravitational constant
+  softening -- The softening length, see n_body_softening
+  softening_kernel -- How the softening is done, 'plummer' or 'spline'
+  potentials -- If given, an array, shape (n_particles,), that the gravitational potential at each
+    particle is added to
+  parallel -- Whether to spread the targets over all cores
+  fastmath -- Whether to let the compiler reorder floating point operations
+
+  Returns:
+  forces -- Array of net forces, shape (n_particles, n_dimensions)
+  '''
+
+  if softening_kernel not in SOFTENING_CODES:
+    raise ValueError('Unknown softening_kernel: {}. Choose from {}.'.format(softening_kernel, n_body_softening.SOFTENING_KERNELS))
+
+  softening_code = SOFTENING_CODES[softening_kernel] if softening > 0. else 0
+
+  forces = np.zeros(positions.shape)
+
+  # The kernel always takes an array, so there is only one compiled version of it.
+  particle_potentials = np.zeros(positions.shape[0] if potentials is not None else 0)
+
+  direct_forces = get_kernel('direct_forces', parallel, fastmath)
+  direct_forces(np.ascontiguousarray(masses, dtype=float), np.ascontiguousarray(positions, dtype=float), float(G),
+                float(softening), softening_code, forces, particle_potentials)
+
+  if potentials is not None:
+    potentials += particle_potentials
+
+  return forces
+
+########################################################################
+
+def kick(velocities, accelerations, dt, fastmath=False):
+  '''Add accelerations*dt to velocities, in place.'''
+
+  get_kernel('kick', fastmath=fastmath)(velocities, np.ascontiguousarray(accelerations, dtype=float), float(dt))
+
+########################################################################
+
+def drift(positions, velocities, dt, fastmath=False):
+  '''Add velocities*dt to positions, in place.'''
+
+  get_kernel('drift', fastmath=fastmath)(positions, np.ascontiguousarray(velocities, dtype=float), float(dt))
+
+########################################################################
+# The kernels
+########################################################################
+
+@_inline
+def _inverse_cube(distance_squared, softening, softening_code):
+  # The same as n_body_softening.calculate_inverse_cubes(), for one pair.
+
+  if softening_code == 1:
+    return (distance_squared + softening*softening)**-1.5
+
+  if softening_code == 2:
+    h = n_body_softening.SPLINE_RADIUS_FACTOR*softening
+    u = np.sqrt(distance_squared)/h
+    if u < 0.5:
+      return (32./3. + u*u*(32.*u - 38.4))/(h*h*h)
+    if u < 1.:
+      return (64./3. - 48.*u + 38.4*u*u - 32./3.*u*u*u - 1./(15.*u*u*u))/(h*h*h)
+
+  return 1./(distance_squared*np.sqrt(distance_squared))
+
+########################################################################
+
+@_inline
+def _inverse_distance(distance_squared, softening, softening_code):
+  # The same as n_body_softening.calculate_inverse_distances(), for one pair.
+
+  if softening_code == 1:
+    return 1./np.sqrt(distance_squared + softening*softening)
+
+  if softening_code == 2:
+    h = n_body_softening.SPLINE_RADIUS_FACTOR*softening
+    u = np.sqrt(distance_squared)/h
+    if u < 0.5:
+      return (2.8 - u*u*(16./3. + u*u*(6.4*u - 9.6)))/h
+    if u < 1.:
+      return (3.2 - 1./(15.*u) - u*u*(32./3. + u*(-16. + u*(9.6 - 32./15.*u))))/h
+
+  return 1./np.sqrt(distance_squared)
+
+########################################################################
+
+def _direct_forces(masses, positions, G, softening, softening_code, forces, potentials):
+
+  n_particles, n_dimensions = positions.shape
+  compute_potentials = potentials.shape[0] > 0
+
+  for i in prange(n_particles):
+    for j in range(n_particles):
+
+      distance_squared = 0.
+      for d in range(n_dimensions):
+        displacement = positions[j, d] - positions[i, d]
+        distance_squared += displacement*displacement
+
+      # Skips the particle itself, and anything exactly on top of it.
+      if distance_squared == 0.:
+        continue
+
+      factor = G*masses[i]*masses[j]*_inverse_cube(distance_squared, softening, softening_code)
+
+      for d in range(n_dimensions):
+        forces[i, d] += factor*(positions[j, d] - positions[i, d])
+
+      if compute_potentials:
+        potentials[i] -= G*masses[j]*_inverse_distance(distance_squared, softening, softening_code)
+
+########################################################################
+
+def _kick(velocities, accelerations, dt):
+
+  n_particles, n_dimensions = velocities.shape
+
+  for i in range(n_particles):
+    for d in range(n_dimensions):
+      velocities[i, d] += dt*accelerations[i, d]
+
+########################################################################
+
+def _drift(positions, velocities, dt):
+
+  n_particles, n_dimensions = positions.shape
+
+  for i in range(n_particles):
+    for d in range(n_dimensions):
+      positions[i, d] += dt*velocities[i, d]
+
+########################################################################
+
+# The kernels, and whether each can be spread over several cores
+KERNELS = {
+  'direct_forces' : (_direct_forces, True),
+  'kick' : (_kick, False),
+  'drift' : (_drift, False),
+}
@@ -0,0 +1,197 @@
+'''
+Direct force summation spread over several processes.
+
+The masses, positions and output forces live in shared memory, so each step only the positions are
+copied in and no arrays are pickled. Each worker calculates the forces on a range of target particles
+and writes them straight into the shared force array.
+
+The shared arrays have room for up to the pool's capacity of particles, so the same pool keeps
+working while particles are removed, e.g. merged by n_body_collisions.
+
+The workers are started by a fork server, rather than forked from this process, which may already be
+running threads of its own, e.g. Numba's.
+'''
+
+import atexit
+import concurrent.futures
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import n_body_physics
+import n_body_softening
+
+# Default number of target particles per task when a deterministic reduction order is requested.
+DEFAULT_CHUNK_SIZE = 256
+
+# Default number of source particles summed over at once inside a task.
+DEFAULT_SOURCE_TILE_SIZE = 1024
+
+# The shared arrays, as seen from inside a worker process.
+_worker_arrays = {}
+
+########################################################################
+
+def calculate_parallel_forces(particles, parameters):
+  '''Calculate the forces on each particle with a pool of worker processes.
+
+  The pool is kept in parameters['parallel_state'] and reused between steps.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information. Uses 'n_workers' (defaults to the number of
+    CPUs), 'deterministic' (defaults to False), 'parallel_chunk_size', 'softening' and
+    'softening_kernel' if they are given.
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  n_workers = parameters.get('n_workers') or os.cpu_count()
+
+  pool = parameters.get('parallel_state')
+  if pool is None or not pool.fits(positions.shape, n_workers):
+    if pool is not None:
+      pool.close()
+    pool = SharedForcePool(positions.shape[0], positions.shape[1], n_workers)
+    parameters['parallel_state'] = pool
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+
+  return pool.calculate_forces(masses, positions, parameters['G'],
+                               deterministic=parameters.get('deterministic', False),
+                               chunk_size=parameters.get('parallel_chunk_size', DEFAULT_CHUNK_SIZE),
+                               softening=softening, softening_kernel=softening_kernel)
+
+########################################################################
+
+class SharedForcePool(object):
+  '''A process pool whose workers share the particle and force arrays with the parent.'''
+
+  def __init__(self, capacity, n_dimensions, n_workers):
+    '''
+    Args:
+    capacity -- The most particles the shared arrays have room for
+    n_dimensions -- Number of dimensions of the positions
+    n_workers -- Number of worker processes
+    '''
+
+    self.capacity = capacity
+    self.n_dimensions = n_dimensions
+    self.n_workers = n_workers
+
+    shapes = {
+      'masses' : (capacity,),
+      'positions' : (capacity, n_dimensions),
+      'forces' : (capacity, n_dimensions),
+    }
+
+    self._memory = {}
+    self.arrays = {}
+    for key, shape in shapes.items():
+      self._memory[key] = shared_memory.SharedMemory(create=True, size=max(8*int(np.prod(shape)), 1))
+      self.arrays[key] = np.ndarray(shape, dtype=float, buffer=self._memory[key].buf)
+
+    layout = dict((key, (self._memory[key].name, shape)) for key, shape in shapes.items())
+    self.executor = concurrent.futures.ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('forkserver'),
+                                                           initializer=_attach_worker, initargs=(layout,))
+
+    atexit.register(self.close)
+
+  def fits(self, shape, n_workers):
+    '''Check whether the pool has room for this many particles, and was made for this many
+    dimensions and workers.'''
+
+    return self.executor is not None and shape[0] <= self.capacity and shape[1] == self.n_dimensions and n_workers == self.n_workers
+
+  def calculate_forces(self, masses, positions, G, deterministic=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                       softening=0., softening_kernel='plummer'):
+    '''Calculate the forces on each particle.
+
+    Args:
+    masses -- Array of particle masses, shape (n_particles,)
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+    G -- The gravitational constant
+    deterministic -- If True, the targets are always split into the same chunks, so the result is
+      bitwise identical for any number of workers. Otherwise there is one chunk per worker.
+    chunk_size -- Number of targets per chunk when deterministic is True
+    softening -- The softening length, see n_body_softening
+    softening_kernel -- How the softening is done, 'plummer' or 'spline'
+
+    Returns:
+    forces -- Array of forces, shape (n_particles, n_dimensions)
+    '''
+
+    n_particles = len(masses)
+
+    self.arrays['masses'][:n_particles] = masses
+    self.arrays['positions'][:n_particles] = positions
+
+    if not deterministic:
+      chunk_size = -(-n_particles//self.n_workers)
+
+    futures = [self.executor.submit(_calculate_chunk, start, min(start + chunk_size, n_particles), n_particles, G,
+                                    softening, softening_kernel)
+               for start in range(0, n_particles, max(chunk_size, 1))]
+
+    # Raises any exception from the workers.
+    for future in futures:
+      future.result()
+
+    return self.arrays['forces'][:n_particles].copy()
+
+  def close(self):
+    '''Shut down the workers and free the shared memory.'''
+
+    if self.executor is None:
+      return
+
+    self.executor.shutdown()
+    self.executor = None
+
+    atexit.unregister(self.close)
+
+    self.arrays = {}
+    for memory in self._memory.values():
+      memory.close()
+      memory.unlink()
+
+########################################################################
+# Inside the worker processes
+########################################################################
+
+def _attach_worker(layout):
+  '''Attach a worker process to the shared arrays.'''
+
+  for key, (name, shape) in layout.items():
+    memory = shared_memory.SharedMemory(name=name)
+    _worker_arrays[key] = (memory, np.ndarray(shape, dtype=float, buffer=memory.buf))
+
+########################################################################
+
+def _calculate_chunk(start, stop, n_particles, G, softening=0., softening_kernel='plummer'):
+  '''Calculate the forces on targets start to stop, from the first n_particles in the shared arrays,
+  and write them into the shared force array.
+
+  The sources are always summed in the same order and tiles, so the result only depends on
+  start and stop.
+  '''
+
+  masses = _worker_arrays['masses'][1][:n_particles]
+  positions = _worker_arrays['positions'][1][:n_particles]
+  forces = _worker_arrays['forces'][1]
+
+  total_forces = np.zeros((stop - start, positions.shape[1]))
+
+  for source_start in range(0, positions.shape[0], DEFAULT_SOURCE_TILE_SIZE):
+    source_stop = source_start + DEFAULT_SOURCE_TILE_SIZE
+
+    pair_forces = n_body_physics.calculate_block_forces(masses[start:stop], positions[start:stop],
+                                                        masses[source_start:source_stop], positions[source_start:source_stop], G,
+                                                        softening, softening_kernel)
+
+    total_forces += pair_forces.sum(axis=1)
+
+  forces[start:stop] = total_forces
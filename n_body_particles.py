@@ -0,0 +1,223 @@
+'''
+A container for the particle information.
+
+ParticleSet can be used anywhere the plain {'masses': ..., 'positions': ..., 'velocities': ...}
+dictionary is used, but keeps each quantity in one contiguous float64 buffer with room to grow, so
+bodies can be added and removed without reallocating every time.
+'''
+
+import numpy as np
+
+########################################################################
+
+class ParticleSet(object):
+  '''Structure-of-arrays particle storage with dictionary-style access.
+
+  particles['positions'] etc. are views of the first n_particles rows of each buffer, so they can
+  be updated in place as usual. The masses view is read-only, because 1/m is cached: assign a new
+  array with particles['masses'] = ... to change the masses.
+
+  Other per-particle quantities (e.g. 'radii') can be stored the same way, by assigning an array
+  with one row per particle.
+  '''
+
+  __slots__ = ('n_particles', 'n_dimensions', '_buffers', '_inverse_masses')
+
+  def __init__(self, masses, positions, velocities=None, capacity=None):
+    '''
+    Args:
+    masses -- Array of particle masses, shape (n_particles,)
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+    velocities -- Array of particle velocities. Defaults to zeros.
+    capacity -- How many particles to make room for. Defaults to n_particles.
+    '''
+
+    positions = np.asarray(positions, dtype=float)
+    self.n_particles, self.n_dimensions = positions.shape
+
+    if velocities is None:
+      velocities = np.zeros(positions.shape)
+
+    if capacity is None:
+      capacity = self.n_particles
+
+    self._buffers = {}
+    self._inverse_masses = None
+
+    self._set_field('masses', masses, capacity)
+    self._set_field('positions', positions, capacity)
+    self._set_field('velocities', velocities, capacity)
+
+  @classmethod
+  def from_dict(cls, particles, capacity=None):
+    '''Make a ParticleSet from a particle dictionary, copying any extra per-particle fields.'''
+
+    particle_set = cls(particles['masses'], particles['positions'], particles.get('velocities'), capacity)
+
+    for key in particles:
+      if key not in particle_set:
+        particle_set[key] = particles[key]
+
+    return particle_set
+
+  ########################################################################
+  # Dictionary-style access
+  ########################################################################
+
+  def __getitem__(self, key):
+
+    view = self._buffers[key][:self.n_particles]
+
+    if key == 'masses':
+      view.flags.writeable = False
+
+    return view
+
+  def __setitem__(self, key, value):
+
+    value = np.asarray(value)
+
+    if key in self._buffers:
+
+      if value.shape != self[key].shape:
+        raise ValueError('Expected {} with shape {}, got {}. Use add() or remove() to change the number of particles.'.format(key, self[key].shape, value.shape))
+
+      self._buffers[key][:self.n_particles] = value
+
+      if key == 'masses':
+        self._inverse_masses = None
+
+    else:
+      self._set_field(key, value, self.capacity)
+
+  def __contains__(self, key):
+
+    return key in self._buffers
+
+  def __iter__(self):
+
+    return iter(self._buffers)
+
+  def keys(self):
+
+    return self._buffers.keys()
+
+  def items(self):
+
+    return [(key, self[key]) for key in self._buffers]
+
+  def get(self, key, default=None):
+
+    if key in self._buffers:
+      return self[key]
+
+    return default
+
+  ########################################################################
+
+  @property
+  def capacity(self):
+    '''How many particles fit before the buffers have to grow.'''
+
+    return self._buffers['masses'].shape[0]
+
+  @property
+  def inverse_masses(self):
+    '''1/m as a column, shape (n_particles, 1), cached until the masses change.'''
+
+    if self._inverse_masses is None:
+      self._inverse_masses = 1./self._buffers['masses'][:self.n_particles, np.newaxis]
+
+    return self._inverse_masses
+
+  ########################################################################
+  # Adding and removing particles
+  ########################################################################
+
+  def add(self, masses, positions, velocities=None, **fields):
+    '''Append particles, growing the buffers geometrically when they are full.
+
+    Args:
+    masses -- Array of new masses, shape (n_new,)
+    positions -- Array of new positions, shape (n_new, n_dimensions)
+    velocities -- Array of new velocities. Defaults to zeros.
+    fields -- Values of any other per-particle fields for the new particles. Defaults to zeros.
+    '''
+
+    masses = np.atleast_1d(np.asarray(masses, dtype=float))
+    n_new = masses.size
+
+    values = dict(fields)
+    values['masses'] = masses
+    values['positions'] = positions
+    if velocities is not None:
+      values['velocities'] = velocities
+
+    n_total = self.n_particles + n_new
+    if n_total > self.capacity:
+      self.reserve(max(n_total, 2*self.capacity))
+
+    for key, buffer in self._buffers.items():
+      if key in values:
+        buffer[self.n_particles:n_total] = np.reshape(values[key], (n_new,) + buffer.shape[1:])
+      else:
+        buffer[self.n_particles:n_total] = 0
+
+    self.n_particles = n_total
+    self._inverse_masses = None
+
+  def remove(self, indices):
+    '''Remove particles, moving the rest down in their buffers. Keeps the order of the remaining particles.
+
+    Args:
+    indices -- Indices, or a boolean mask, of the particles to remove
+    '''
+
+    keep = np.ones(self.n_particles, dtype=bool)
+    keep[indices] = False
+    n_keep = np.count_nonzero(keep)
+
+    for buffer in self._buffers.values():
+      buffer[:n_keep] = buffer[:self.n_particles][keep]
+
+    self.n_particles = n_keep
+    self._inverse_masses = None
+
+  def reserve(self, capacity):
+    '''Make sure there is room for at least capacity particles.'''
+
+    if capacity <= self.capacity:
+      return
+
+    for key, buffer in self._buffers.items():
+      new_buffer = np.zeros((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+      new_buffer[:self.n_particles] = buffer[:self.n_particles]
+      self._buffers[key] = new_buffer
+
+  def copy(self):
+    '''Make an independent copy, with the same capacity.'''
+
+    particle_set = ParticleSet(self['masses'], self['positions'], self['velocities'], self.capacity)
+
+    for key in self._buffers:
+      if key not in particle_set:
+        particle_set[key] = self[key]
+
+    return particle_set
+
+  ########################################################################
+
+  def _set_field(self, key, value, capacity):
+    '''Store a new per-particle field in its own buffer.'''
+
+    value = np.asarray(value)
+    if value.shape[:1] != (self.n_particles,):
+      raise ValueError('Expected {} for {} particles, got shape {}.'.format(key, self.n_particles, value.shape))
+
+    # Masses, positions, velocities and any other floating point fields are kept as float64.
+    dtype = value.dtype
+    if key in ('masses', 'positions', 'velocities') or dtype.kind == 'f':
+      dtype = np.float64
+
+    self._buffers[key] = np.zeros((capacity,) + value.shape[1:], dtype=dtype)
+    self._buffers[key][:self.n_particles] = value
@@ -5,36 +5,59 @@ This module determines how the system updates each time step.
 import numpy as np
 import pdb
 
+import n_body_collisions
+import n_body_diagnostics
+import n_body_fmm
+import n_body_integrators
+import n_body_numba
+import n_body_parallel
+import n_body_particles
+import n_body_pm
+import n_body_precision
+import n_body_profiling
+import n_body_softening
+import n_body_tree
+
+# Default upper limit, in bytes, on the temporary arrays used by the force calculation.
+DEFAULT_MEMORY_BUDGET = 2**28
+
 ########################################################################
 
 def update_system(particles, parameters):
-  '''Update the system per timestep.'''
+  '''Update the system per timestep.
 
-  # Get the forces
-  forces = calculate_net_force_on_all_particles(particles, parameters)
+  parameters['integrator'] chooses the integrator, see n_body_integrators.make_integrator(). It is
+  kept in parameters['integrator_state'], so the forces calculated at the end of one step are reused
+  at the start of the next. parameters['step'] and parameters['time'] count the
+  steps taken and the simulation time.
+
+  With parameters['collisions'] set, touching bodies are merged at the end of the step, see
+  n_body_collisions.
+  '''
+
+  if parameters.get('integrator_state') is None:
+    parameters['integrator_state'] = n_body_integrators.make_integrator(parameters)
 
-  # Update the positions
-  update_positions(particles, parameters, forces)
+  parameters['integrator_state'].step(particles, parameters)
 
-  # Get the forces again, this time for calculating velocities.
-  forces_new = calculate_net_force_on_all_particles(particles, parameters)
+  n_body_collisions.merge_collisions(particles, parameters)
 
-  # Update the velocities
-  update_velocities(particles, parameters, forces, forces_new)
+  parameters['step'] = parameters.get('step', 0) + 1
+  parameters['time'] = parameters.get('time', 0.) + parameters['dt']
 
 ########################################################################
 # Calculate the forces
 ########################################################################
 
-def calculate_force(m1, m2, pos1, pos2, G):
+def calculate_force(m1, m2, pos1, pos2, G, softening=0., softening_kernel='plummer'):
   '''Calculate the force on particle 1 due to particle 2. Doesn't use the dictionary structure.
   '''
 
   displacement = pos2 - pos1
 
-  distance = np.linalg.norm(displacement)
+  distance_squared = np.dot(displacement, displacement)
 
-  force = G*m1*m2*displacement/distance**3.
+  force = G*m1*m2*displacement*n_body_softening.calculate_inverse_cubes(distance_squared, softening, softening_kernel)
 
   return force
 
@@ -51,6 +74,8 @@ def calculate_net_force_on_particle(i, particles, parameters):
 
   total_force = np.zeros(len(particles['positions'][0]))
 
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+
   m_i = particles['masses'][i]
   pos_i = particles['positions'][i]
 
@@ -60,7 +85,8 @@ def calculate_net_force_on_particle(i, particles, parameters):
     if i == j:
       continue
 
-    force = calculate_force(m_i, particles['masses'][j], pos_i, particles['positions'][j], parameters['G'])
+    force = calculate_force(m_i, particles['masses'][j], pos_i, particles['positions'][j], parameters['G'],
+                            softening, softening_kernel)
 
     total_force += force
 
@@ -68,22 +94,435 @@ def calculate_net_force_on_particle(i, particles, parameters):
 
 ########################################################################
 
+def calculate_pairwise_forces(masses, positions, G, softening=0., softening_kernel='plummer', potentials=None):
+  '''Calculate the net force on every particle in one vectorized pass.
+
+  Each pair (i, j) with i < j is evaluated once, and Newton's third law is used
+  to give the equal and opposite force to the other member of the pair.
+
+  Args:
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  G -- The gravitational constant
+  softening -- The softening length, see n_body_softening
+  softening_kernel -- How the softening is done, 'plummer' or 'spline'
+  potentials -- If given, an array, shape (n_particles,), that the gravitational potential at each
+    particle is added to
+
+  Returns:
+  total_forces -- Array of net forces, shape (n_particles, n_dimensions)
+  '''
+
+  n_particles, n_dimensions = positions.shape
+
+  # The indices of every unique pair
+  i, j = np.triu_indices(n_particles, k=1)
+
+  displacements = positions[j] - positions[i]
+  distances_squared = (displacements**2.).sum(axis=1)
+
+  inverse_cubes = n_body_softening.calculate_inverse_cubes(distances_squared, softening, softening_kernel)
+
+  pair_forces = displacements*(G*masses[i]*masses[j]*inverse_cubes)[:, np.newaxis]
+
+  # Add each pair force to particle i, and subtract it from particle j.
+  total_forces = np.zeros((n_particles, n_dimensions))
+  for d in range(n_dimensions):
+    total_forces[:, d] = np.bincount(i, pair_forces[:, d], minlength=n_particles) \
+                         - np.bincount(j, pair_forces[:, d], minlength=n_particles)
+
+  if potentials is not None:
+    inverse_distances = n_body_softening.calculate_inverse_distances(distances_squared, softening, softening_kernel)
+    potentials -= G*(np.bincount(i, masses[j]*inverse_distances, minlength=n_particles)
+                     + np.bincount(j, masses[i]*inverse_distances, minlength=n_particles))
+
+  return total_forces
+
+########################################################################
+
+def calculate_block_forces(target_masses, target_positions, source_masses, source_positions, G,
+                           softening=0., softening_kernel='plummer', target_potentials=None, source_potentials=None):
+  '''Calculate the force on each target particle due to each source particle.
+
+  Pairs that are separated by zero distance (i.e. a particle and itself) contribute no force.
+
+  Args:
+  target_masses -- Array of target masses, shape (n_targets,)
+  target_positions -- Array of target positions, shape (n_targets, n_dimensions)
+  source_masses -- Array of source masses, shape (n_sources,)
+  source_positions -- Array of source positions, shape (n_sources, n_dimensions)
+  G -- The gravitational constant
+  softening -- The softening length, see n_body_softening
+  softening_kernel -- How the softening is done, 'plummer' or 'spline'
+  target_potentials -- If given, an array, shape (n_targets,), that the potential at each target
+    due to the sources is added to
+  source_potentials -- If given, an array, shape (n_sources,), that the potential at each source
+    due to the targets is added to
+
+  Returns:
+  pair_forces -- Array of forces, shape (n_targets, n_sources, n_dimensions)
+  '''
+
+  pair_forces = source_positions[np.newaxis, :, :] - target_positions[:, np.newaxis, :]
+  distances_squared = np.einsum('tsd,tsd->ts', pair_forces, pair_forces)
+
+  if target_potentials is not None or source_potentials is not None:
+    inverse_distances = G*n_body_softening.calculate_inverse_distances(distances_squared, softening, softening_kernel)
+    if target_potentials is not None:
+      target_potentials -= inverse_distances.dot(source_masses)
+    if source_potentials is not None:
+      source_potentials -= target_masses.dot(inverse_distances)
+
+  inverse_cubes = n_body_softening.calculate_inverse_cubes(distances_squared, softening, softening_kernel)
+
+  # Reuse the displacement buffer for the forces.
+  inverse_cubes *= G*np.outer(target_masses, source_masses)
+  pair_forces *= inverse_cubes[:, :, np.newaxis]
+
+  return pair_forces
+
+########################################################################
+
+def calculate_tiled_forces(masses, positions, G, tile_size, softening=0., softening_kernel='plummer', potentials=None):
+  '''Calculate the net force on every particle, one pair of tiles at a time.
+
+  Only tiles on or above the diagonal are evaluated, with Newton's third law giving the rest,
+  so the temporary arrays never hold more than tile_size**2 pairs.
+
+  Args:
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  G -- The gravitational constant
+  tile_size -- Number of particles in each tile
+  softening -- The softening length, see n_body_softening
+  softening_kernel -- How the softening is done, 'plummer' or 'spline'
+  potentials -- If given, an array, shape (n_particles,), that the gravitational potential at each
+    particle is added to
+
+  Returns:
+  total_forces -- Array of net forces, shape (n_particles, n_dimensions)
+  '''
+
+  n_particles, n_dimensions = positions.shape
+
+  total_forces = np.zeros((n_particles, n_dimensions))
+
+  def tile_potentials(start, end):
+    return None if potentials is None else potentials[start:end]
+
+  for start_i in range(0, n_particles, tile_size):
+    end_i = min(start_i + tile_size, n_particles)
+
+    # Pairs inside the tile
+    total_forces[start_i:end_i] += calculate_pairwise_forces(masses[start_i:end_i], positions[start_i:end_i], G,
+                                                             softening, softening_kernel, tile_potentials(start_i, end_i))
+
+    # Pairs between this tile and the tiles after it
+    for start_j in range(end_i, n_particles, tile_size):
+      end_j = min(start_j + tile_size, n_particles)
+
+      pair_forces = calculate_block_forces(masses[start_i:end_i], positions[start_i:end_i],
+                                           masses[start_j:end_j], positions[start_j:end_j], G,
+                                           softening, softening_kernel,
+                                           tile_potentials(start_i, end_i), tile_potentials(start_j, end_j))
+
+      total_forces[start_i:end_i] += pair_forces.sum(axis=1)
+      total_forces[start_j:end_j] -= pair_forces.sum(axis=0)
+
+  return total_forces
+
+########################################################################
+
+def choose_tile_size(n_particles, n_dimensions, memory_budget):
+  '''Choose the largest tile whose temporary arrays fit inside a memory budget.
+
+  Args:
+  n_particles -- Number of particles
+  n_dimensions -- Number of dimensions
+  memory_budget -- Maximum number of bytes to use for temporary arrays
+
+  Returns:
+  tile_size -- Number of particles in each tile
+  '''
+
+  # Each pair in a tile holds a force vector plus a couple of scalars.
+  bytes_per_pair = 8*(n_dimensions + 3)
+
+  tile_size = int(np.sqrt(memory_budget/bytes_per_pair))
+
+  return max(1, min(tile_size, n_particles))
+
+########################################################################
+
 def calculate_net_force_on_all_particles(particles, parameters):
   '''Calculate the forces on each particle
 
+  parameters['force_method'] chooses how: 'direct' (the default) sums over every pair,
+  'parallel' splits the direct sum over several processes, 'tree' uses a Barnes-Hut tree,
+  'fmm' uses the fast multipole method, and 'pm' and 'p3m' use a particle mesh in a periodic box.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  '''
+
+  force_method = parameters.get('force_method', 'direct')
+
+  if force_method == 'direct':
+    calculate_forces = calculate_direct_forces
+  elif force_method == 'parallel':
+    calculate_forces = n_body_parallel.calculate_parallel_forces
+  elif force_method == 'tree':
+    calculate_forces = n_body_tree.calculate_tree_forces
+  elif force_method == 'fmm':
+    calculate_forces = n_body_fmm.calculate_fmm_forces
+  elif force_method in ('pm', 'p3m'):
+    calculate_forces = n_body_pm.calculate_pm_forces
+  else:
+    raise ValueError('Unknown force_method: {}'.format(force_method))
+
+  profiler = n_body_profiling.get_profiler(parameters)
+  with profiler.phase('forces'):
+
+    # The direct sum can work out the potential energy in the same pass, for the diagnostics.
+    if force_method == 'direct' and n_body_diagnostics.is_due(parameters, parameters.get('step', 0) + 1):
+      potentials = np.zeros(len(particles['masses']))
+      forces = calculate_direct_forces(particles, parameters, potentials)
+      n_body_diagnostics.record_potentials(particles, parameters, potentials)
+    else:
+      forces = calculate_forces(particles, parameters)
+
+  # Counted as for the direct sum, whatever the method, so the rates compare.
+  n_particles = len(particles['masses'])
+  profiler.count('force_evaluations')
+  profiler.count('pair_interactions', n_particles*(n_particles - 1)//2)
+
+  return forces
+
+########################################################################
+
+def calculate_direct_forces(particles, parameters, potentials=None):
+  '''Calculate the forces on each particle by summing over every pair.
+
+  With parameters['mixed_precision'] set, uses the float32 pairs and float64 sums of n_body_precision.
+  Otherwise uses the compiled kernel in n_body_numba when Numba is available, unless parameters['use_numba']
+  is False, compiled as parameters['numba_parallel'] and 'numba_fastmath' ask. Otherwise uses a single
+  pass over all pairs when it fits in parameters['memory_budget'] (bytes), and otherwise falls back to
+  tiles. parameters['tile_size'] forces a particular tile size.
+
+  The forces are softened by parameters['softening'] and 'softening_kernel', see n_body_softening.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  potentials -- If given, an array, shape (n_particles,), that the gravitational potential at each
+    particle is added to
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+
+  if parameters.get('mixed_precision', False):
+    return n_body_precision.calculate_mixed_precision_forces(masses, positions, parameters['G'],
+                                                             parameters.get('tile_size', n_body_precision.DEFAULT_CELL_SIZE),
+                                                             softening, softening_kernel, potentials)
+
+  if n_body_numba.use_numba(parameters):
+    return n_body_numba.calculate_numba_forces(masses, positions, parameters['G'], softening, softening_kernel, potentials,
+                                               parameters.get('numba_parallel', True), parameters.get('numba_fastmath', False))
+
+  n_particles, n_dimensions = positions.shape
+
+  tile_size = parameters.get('tile_size')
+  if tile_size is None:
+
+    memory_budget = parameters.get('memory_budget', DEFAULT_MEMORY_BUDGET)
+
+    # The single pass holds two indices, a force vector and a few scalars per pair.
+    n_pairs = n_particles*(n_particles - 1)//2
+    if n_pairs*8*(2*n_dimensions + 5) <= memory_budget:
+      return calculate_pairwise_forces(masses, positions, parameters['G'], softening, softening_kernel, potentials)
+
+    tile_size = choose_tile_size(n_particles, n_dimensions, memory_budget)
+
+  return calculate_tiled_forces(masses, positions, parameters['G'], tile_size, softening, softening_kernel, potentials)
+
+########################################################################
+
+def estimate_force_error(particles, parameters, n_samples=100, forces=None, seed=None):
+  '''Compare the forces from parameters['force_method'] against a direct sum on a random sample
+  of particles. Useful for tuning approximate methods, e.g. the tree opening angle 'theta'.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  n_samples -- How many particles to check
+  forces -- Forces already calculated for every particle. Calculated if not given.
+  seed -- Seed for choosing the sample
+
+  Returns:
+  errors -- Dictionary of statistics of the relative error |F - F_direct|/|F_direct|:
+    'mean', 'rms', 'median', 'max'
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  if forces is None:
+    forces = calculate_net_force_on_all_particles(particles, parameters)
+
+  rng = np.random.RandomState(seed)
+  samples = rng.choice(len(masses), min(n_samples, len(masses)), replace=False)
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+
+  direct_forces = calculate_block_forces(masses[samples], positions[samples], masses, positions, parameters['G'],
+                                         softening, softening_kernel).sum(axis=1)
+
+  relative_errors = np.linalg.norm(forces[samples] - direct_forces, axis=1)/np.linalg.norm(direct_forces, axis=1)
+
+  errors = {
+    'mean' : relative_errors.mean(),
+    'rms' : np.sqrt((relative_errors**2.).mean()),
+    'median' : np.median(relative_errors),
+    'max' : relative_errors.max(),
+  }
+
+  return errors
+
+########################################################################
+
+def calculate_accelerations(particles, parameters):
+  '''Calculate the acceleration of each particle.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  '''
+
+  forces = calculate_net_force_on_all_particles(particles, parameters)
+
+  return forces*get_inverse_masses(particles)
+
+########################################################################
+
+def calculate_accelerations_and_jerks(particles, parameters, targets=None):
+  '''Calculate the accelerations and their time derivatives (the jerks) by summing over every pair.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  targets -- Indices of the particles to calculate them for. Defaults to all of them.
+
+  Returns:
+  accelerations -- Array of accelerations, shape (n_targets, n_dimensions)
+  jerks -- Array of jerks, shape (n_targets, n_dimensions)
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+  velocities = np.asarray(particles['velocities'], dtype=float)
+
+  n_particles, n_dimensions = positions.shape
+
+  if targets is None:
+    targets = np.arange(n_particles)
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+
+  profiler = n_body_profiling.get_profiler(parameters)
+  profiler.count('force_evaluations')
+  # The pairs with at least one member among the targets, so all of them counts as a full direct sum.
+  n_targets = len(targets)
+  profiler.count('pair_interactions', n_targets*(n_particles - 1) - n_targets*(n_targets - 1)//2)
+
+  accelerations = np.zeros((len(targets), n_dimensions))
+  jerks = np.zeros((len(targets), n_dimensions))
+
+  # Each target holds two vectors and a few scalars per source.
+  memory_budget = parameters.get('memory_budget', DEFAULT_MEMORY_BUDGET)
+  tile_size = max(1, int(memory_budget//(8*max(n_particles, 1)*(2*n_dimensions + 4))))
+
+  for start in range(0, len(targets), tile_size):
+    tile = targets[start:start + tile_size]
+
+    displacements = positions[np.newaxis, :, :] - positions[tile, np.newaxis, :]
+    relative_velocities = velocities[np.newaxis, :, :] - velocities[tile, np.newaxis, :]
+
+    distances_squared = np.einsum('tsd,tsd->ts', displacements, displacements)
+    radial_velocities = np.einsum('tsd,tsd->ts', displacements, relative_velocities)
+
+    # Pairs of a particle with itself contribute nothing, since their displacements are zero.
+    factors = parameters['G']*masses*n_body_softening.calculate_inverse_cubes(distances_squared, softening, softening_kernel)
+    derivatives = parameters['G']*masses*n_body_softening.calculate_inverse_cube_derivatives(distances_squared, softening, softening_kernel)
+
+    accelerations[start:start + tile_size] = np.einsum('ts,tsd->td', factors, displacements)
+    jerks[start:start + tile_size] = np.einsum('ts,tsd->td', factors, relative_velocities) \
+                                     + np.einsum('ts,tsd->td', derivatives*radial_velocities, displacements)
+
+  return accelerations, jerks
+
+########################################################################
+
+def calculate_kinetic_energy(particles):
+  '''Calculate the total kinetic energy.
+
+  Args:
+  particles -- The particle information
+  '''
+
+  return 0.5*(np.asarray(particles['masses'])*(np.asarray(particles['velocities'])**2.).sum(axis=1)).sum()
+
+########################################################################
+
+def calculate_potential_energy(particles, parameters):
+  '''Calculate the total gravitational potential energy by summing over every pair, softened in the
+  same way as the forces.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  i, j = np.triu_indices(len(masses), k=1)
+
+  distances_squared = ((positions[j] - positions[i])**2.).sum(axis=1)
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+  inverse_distances = n_body_softening.calculate_inverse_distances(distances_squared, softening, softening_kernel)
+
+  return -parameters['G']*(masses[i]*masses[j]*inverse_distances).sum()
+
+########################################################################
+
+def calculate_total_energy(particles, parameters):
+  '''Calculate the total kinetic plus potential energy.
+
   Args:
   particles -- The particle information
   parameters -- The simulation parameter information
   '''
 
-  total_forces = []
-  for i in range(len(particles['masses'])):
+  return calculate_kinetic_energy(particles) + calculate_potential_energy(particles, parameters)
+
+########################################################################
+
+def get_inverse_masses(particles):
+  '''Get 1/m as a column, shape (n_particles, 1), reusing the cached one of a ParticleSet.
 
-    total_force = calculate_net_force_on_particle(i, particles, parameters)
+  Args:
+  particles -- The particle information
+  '''
 
-    total_forces.append(total_force)
+  if isinstance(particles, n_body_particles.ParticleSet):
+    return particles.inverse_masses
 
-  return np.array(total_forces)
+  return 1./np.asarray(particles['masses'], dtype=float)[:, np.newaxis]
 
 ########################################################################
 # Updating the particles
@@ -109,6 +548,56 @@ def update_position(i, particles, parameters, forces):
 
 ########################################################################
 
+def kick(particles, parameters, accelerations, dt):
+  '''Change the velocities by accelerations*dt, in place.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  accelerations -- Accelerations of the particles
+  dt -- How long to accelerate them for
+  '''
+
+  velocities = particles['velocities']
+
+  with n_body_profiling.get_profiler(parameters).phase('kick'):
+    if n_body_numba.use_numba(parameters) and _is_compiled_kernel_compatible(velocities):
+      n_body_numba.kick(velocities, accelerations, dt, parameters.get('numba_fastmath', False))
+    else:
+      velocities += dt*accelerations
+
+########################################################################
+
+def drift(particles, parameters, dt):
+  '''Move the particles at their current velocities for dt, in place. In a periodic box, set by
+  parameters['box_size'], they are wrapped back into the box.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  dt -- How long to move them for
+  '''
+
+  positions = particles['positions']
+
+  with n_body_profiling.get_profiler(parameters).phase('drift'):
+    if n_body_numba.use_numba(parameters) and _is_compiled_kernel_compatible(positions):
+      n_body_numba.drift(positions, particles['velocities'], dt, parameters.get('numba_fastmath', False))
+    else:
+      positions += dt*particles['velocities']
+
+    if parameters.get('box_size') is not None:
+      np.mod(positions, parameters['box_size'], out=positions)
+
+########################################################################
+
+def _is_compiled_kernel_compatible(array):
+  '''Whether a compiled kernel can update array in place.'''
+
+  return array.dtype == np.float64 and array.ndim == 2 and array.flags.c_contiguous and array.flags.writeable
+
+########################################################################
+
 def update_positions(particles, parameters, forces):
   '''Update the positions and velocities of each particle.
 
@@ -121,7 +610,7 @@ def update_positions(particles, parameters, forces):
 
   vel_term = particles['velocities']*parameters['dt']
 
-  acc = forces/np.array([particles['masses'],]*parameters['n_dimensions']).transpose()
+  acc = forces*get_inverse_masses(particles)
   acc_term = 0.5*acc*parameters['dt']**2.
 
   pos_change = vel_term + acc_term
@@ -132,8 +621,10 @@ def update_positions(particles, parameters, forces):
 
 def update_velocities(particles, parameters, forces_old, forces_new):
 
-  acceleration_old = forces_old/np.array([particles['masses'],]*parameters['n_dimensions']).transpose() 
-  acceleration_new = forces_new/np.array([particles['masses'],]*parameters['n_dimensions']).transpose() 
+  inverse_masses = get_inverse_masses(particles)
+
+  acceleration_old = forces_old*inverse_masses
+  acceleration_new = forces_new*inverse_masses
 
   vel_change = 0.5*(acceleration_old + acceleration_new)*parameters['dt']
 
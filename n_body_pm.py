@@ -0,0 +1,368 @@
+'''
+Particle-mesh (PM) gravity in a periodic box, with an optional P3M short-range correction.
+
+Turned on by parameters['force_method'] = 'pm' or 'p3m', with the box [0, box_size)^n_dimensions
+set by parameters['box_size']. Each step
+  1. the masses are spread onto a grid of pm_grid_size^n_dimensions points by cloud-in-cell (CIC)
+     assignment,
+  2. Poisson's equation is solved with numpy.fft.rfftn: the potential's Fourier transform is the
+     density's times the Green's function -4 pi/k^2, divided by the CIC window twice, once for the
+     assignment and once for the interpolation,
+  3. the accelerations are the gradient -i k phi_k, transformed back one component at a time, and
+  4. interpolated back to the particles with the same CIC weights.
+
+The box is periodic, and the mean density is left out (the k = 0 mode is zero), as in cosmological
+boxes. Positions are wrapped back into the box by the drift. The Hermite integrators sum their own
+forces in open space, so they refuse a box_size.
+
+The mesh force is smoothed by exp(-k^2 r_s^2), with r_s = pm_split grid cells, which keeps the
+divided-out window from amplifying the grid's aliasing. It is then accurate for particles more than
+a few r_s apart, and softened closer than that. 'p3m' adds back the difference (Hockney & Eastwood
+1988, with the Gaussian split of GADGET-2), the direct pair force times
+  erfc(r/2r_s) + r/(r_s sqrt(pi)) exp(-r^2/4r_s^2),
+for every pair closer than pm_cutoff*r_s, using the nearest periodic image. The pairs come from a
+n_body_neighbours Verlet list with a skin of pm_skin grid cells, so they are only looked for again
+once some particle has moved more than half of that.
+
+Unlike the rest of the code, this only works in 3D. In other dimensions 1/r gravity isn't the
+solution of Poisson's equation, so the smoothing changes it on every scale rather than just below r_s.
+
+Everything that depends on the box and grid, i.e. the Green's function, the grid buffers, the
+per-particle work arrays and the neighbour list, is made once and kept in parameters['pm_state'], so a step's transforms
+and assignments write into the same memory every time. Transforming straight into the grid buffers
+needs the out argument of NumPy 2.0's numpy.fft. With older versions each transform makes a
+temporary array, which is copied into the buffer. numpy.fft keeps its own cache of plans for each
+transform length, which the repeated transforms of the same grid reuse.
+'''
+
+import inspect
+import itertools
+import math
+
+import numpy as np
+
+import n_body_neighbours
+import n_body_softening
+import n_body_tree
+
+# Default number of grid points along each side of the box
+DEFAULT_GRID_SIZE = 64
+
+# Default force split scale r_s, in grid cells
+DEFAULT_SPLIT = 1.25
+
+# Default distance beyond which the short-range force is dropped, in units of r_s. The split factor
+# has fallen to under 2% there.
+DEFAULT_CUTOFF = 4.5
+
+# Default Verlet list skin for the short-range pairs, in grid cells
+DEFAULT_SKIN = 0.5
+
+# Number of points in the table of the short-range split factor
+N_SPLIT_TABLE = 4096
+
+# Whether numpy.fft can write into an existing array, which it can from NumPy 2.0
+FFT_HAS_OUT = 'out' in inspect.signature(np.fft.rfftn).parameters
+
+########################################################################
+
+def calculate_pm_forces(particles, parameters):
+  '''Calculate the forces on each particle with the particle-mesh method, adding the short-range
+  correction if parameters['force_method'] is 'p3m'.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information. Needs 'box_size', and uses 'pm_grid_size',
+    'pm_split', 'pm_cutoff', 'pm_skin', 'softening' and 'softening_kernel' if they are given.
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  mesh = get_particle_mesh(parameters, positions.shape[1])
+
+  forces = mesh.calculate_forces(masses, positions, parameters['G'])
+
+  if mesh.short_range:
+    softening, softening_kernel = n_body_softening.get_softening(parameters)
+    forces += mesh.calculate_short_range_forces(masses, positions, parameters['G'], softening, softening_kernel)
+
+  return forces
+
+########################################################################
+
+def get_particle_mesh(parameters, n_dimensions):
+  '''Get the ParticleMesh kept in parameters['pm_state'], making a new one if there isn't one yet or
+  the box or grid have changed.
+
+  Args:
+  parameters -- The simulation parameter information
+  n_dimensions -- Number of dimensions
+
+  Returns:
+  mesh -- The ParticleMesh
+  '''
+
+  if parameters.get('box_size') is None:
+    raise ValueError('The particle-mesh force methods need a periodic box_size.')
+
+  grid_size = parameters.get('pm_grid_size', DEFAULT_GRID_SIZE)
+  box_size = float(parameters['box_size'])
+
+  split = parameters.get('pm_split', DEFAULT_SPLIT)*box_size/grid_size
+  skin = parameters.get('pm_skin', DEFAULT_SKIN)*box_size/grid_size
+  short_range = parameters.get('force_method') == 'p3m'
+
+  settings = (box_size, grid_size, n_dimensions, split, short_range, parameters.get('pm_cutoff', DEFAULT_CUTOFF), skin)
+
+  mesh = parameters.get('pm_state')
+  if mesh is None or mesh.settings != settings:
+    mesh = ParticleMesh(*settings)
+    parameters['pm_state'] = mesh
+
+  return mesh
+
+########################################################################
+
+class ParticleMesh(object):
+  '''The grid, Green's function and work arrays for the particle-mesh forces in one periodic box.'''
+
+  def __init__(self, box_size, grid_size, n_dimensions, split, short_range=False, cutoff=DEFAULT_CUTOFF, skin=0.):
+    '''
+    Args:
+    box_size -- Side length of the periodic box
+    grid_size -- Number of grid points along each side
+    n_dimensions -- Number of dimensions, which must be 3
+    split -- The force split scale r_s, as a length
+    short_range -- Whether the short-range force will be added, for P3M
+    cutoff -- Where the short-range force is dropped, in units of split
+    skin -- The Verlet list skin for the short-range pairs, as a length
+    '''
+
+    if n_dimensions != 3:
+      raise ValueError('The particle-mesh forces only work in 3 dimensions, got {}.'.format(n_dimensions))
+
+    self.settings = (box_size, grid_size, n_dimensions, split, short_range, cutoff, skin)
+    self.box_size = box_size
+    self.grid_size = grid_size
+    self.n_dimensions = n_dimensions
+    self.split = split
+    self.short_range = short_range
+    self.cutoff = cutoff
+    self.cell_size = box_size/grid_size
+    self.axes = tuple(range(n_dimensions))
+
+    shape = (grid_size,)*n_dimensions
+    transform_shape = shape[:-1] + (grid_size//2 + 1,)
+
+    self.density = np.zeros(shape)
+    self.density_transform = np.zeros(transform_shape, dtype=complex)
+    self.potential_transform = np.zeros(transform_shape, dtype=complex)
+    self.gradient_transform = np.zeros(transform_shape, dtype=complex)
+    self.acceleration_grids = np.zeros((n_dimensions,) + shape)
+
+    self.wavenumbers = self._get_wavenumbers()
+    self.greens_function = self._get_greens_function()
+
+    # -i k for the gradient, leaving out the unpaired Nyquist frequency so the result stays real
+    self.gradient_factors = []
+    for k in self.wavenumbers:
+      k = k.copy()
+      if grid_size % 2 == 0:
+        k[np.abs(k) == np.pi*grid_size/box_size] = 0.
+      self.gradient_factors.append(-1.j*k)
+
+    if short_range:
+      self.neighbours = n_body_neighbours.NeighbourIndex(cutoff*split, skin, box_size)
+      self.split_radii = np.linspace(0., cutoff*split, N_SPLIT_TABLE)
+      self.split_factors = np.array([math.erfc(r/(2.*split)) + r/(split*math.sqrt(math.pi))*math.exp(-r**2./(4.*split**2.))
+                                     for r in self.split_radii])
+
+    self._n_particles = None
+
+  @property
+  def nbytes(self):
+    '''Bytes used by the grids and the Green's function.'''
+
+    return (self.density.nbytes + self.density_transform.nbytes + self.potential_transform.nbytes
+            + self.gradient_transform.nbytes + self.acceleration_grids.nbytes + self.greens_function.nbytes)
+
+  def calculate_forces(self, masses, positions, G):
+    '''Calculate the mesh force on every particle.
+
+    Args:
+    masses -- Array of particle masses, shape (n_particles,)
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+    G -- The gravitational constant
+
+    Returns:
+    forces -- Array of forces, shape (n_particles, n_dimensions)
+    '''
+
+    self.assign_masses(masses, positions)
+
+    _transform(np.fft.rfftn, self.density, self.density_transform, axes=self.axes)
+    np.multiply(self.density_transform, self.greens_function, out=self.potential_transform)
+
+    for d in range(self.n_dimensions):
+      np.multiply(self.potential_transform, self.gradient_factors[d], out=self.gradient_transform)
+      _transform(np.fft.irfftn, self.gradient_transform, self.acceleration_grids[d], s=self.density.shape, axes=self.axes)
+
+    accelerations = self.interpolate(self.acceleration_grids)
+
+    return G*masses[:, np.newaxis]*accelerations
+
+  def assign_masses(self, masses, positions):
+    '''Spread the masses onto self.density, as mass per unit volume, by cloud-in-cell assignment.'''
+
+    self._find_cells(positions)
+
+    self.density.fill(0.)
+    flat_density = self.density.reshape(-1)
+
+    for corner in itertools.product([0, 1], repeat=self.n_dimensions):
+      self._find_corner(corner)
+      np.multiply(self._weights, masses, out=self._values)
+      np.add.at(flat_density, self._indices, self._values)
+
+    self.density *= 1./self.cell_size**self.n_dimensions
+
+  def interpolate(self, grids):
+    '''Interpolate grids of values, shape (n_components,) + grid shape, to the particles found by
+    the last assign_masses(), with the same cloud-in-cell weights.
+
+    Returns:
+    values -- Array of values, shape (n_particles, n_components). The same array is reused by
+      the next call.
+    '''
+
+    self._interpolated.fill(0.)
+
+    for corner in itertools.product([0, 1], repeat=self.n_dimensions):
+      self._find_corner(corner)
+      for d in range(len(grids)):
+        np.take(grids[d].reshape(-1), self._indices, out=self._values)
+        self._values *= self._weights
+        self._interpolated[:, d] += self._values
+
+    return self._interpolated
+
+  def calculate_short_range_forces(self, masses, positions, G, softening=0., softening_kernel='plummer'):
+    '''Calculate the short-range P3M force on every particle, the direct pair force times the split
+    factor, from the nearest periodic image of every particle within the cutoff. Pairs in the Verlet
+    list that are further apart than that add nothing.
+
+    Args:
+    masses -- Array of particle masses, shape (n_particles,)
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+    G -- The gravitational constant
+    softening -- The softening length, see n_body_softening
+    softening_kernel -- How the softening is done, 'plummer' or 'spline'
+
+    Returns:
+    forces -- Array of forces, shape (n_particles, n_dimensions)
+    '''
+
+    offsets, j = self.neighbours.get_pairs(positions)
+    i = n_body_neighbours.get_rows(offsets)
+
+    displacements = n_body_neighbours.get_nearest_images(positions[j] - positions[i], self.box_size)
+    distances_squared = (displacements**2.).sum(axis=1)
+
+    factors = G*masses[i]*masses[j]*n_body_softening.calculate_inverse_cubes(distances_squared, softening, softening_kernel)
+    factors *= np.interp(np.sqrt(distances_squared), self.split_radii, self.split_factors, right=0.)
+
+    pair_forces = displacements*factors[:, np.newaxis]
+
+    forces = np.zeros(positions.shape)
+    n_body_tree._accumulate(forces, i, pair_forces)
+    n_body_tree._accumulate(forces, j, -pair_forces)
+
+    return forces
+
+  def _get_wavenumbers(self):
+    '''The wavenumbers along each axis of the transform, shaped to broadcast against it.'''
+
+    wavenumbers = []
+    for d in range(self.n_dimensions):
+      if d == self.n_dimensions - 1:
+        k = np.fft.rfftfreq(self.grid_size, self.cell_size)
+      else:
+        k = np.fft.fftfreq(self.grid_size, self.cell_size)
+
+      shape = [1]*self.n_dimensions
+      shape[d] = len(k)
+      wavenumbers.append(2.*np.pi*k.reshape(shape))
+
+    return wavenumbers
+
+  def _get_greens_function(self):
+    '''The transform of the potential of a unit density, with the CIC window divided out twice and
+    the Gaussian smoothing.'''
+
+    k_squared = sum(k**2. for k in self.wavenumbers)
+    k_squared.reshape(-1)[0] = 1.
+
+    greens_function = -4.*np.pi/k_squared
+
+    # The cloud-in-cell window is sinc^2 along each axis.
+    for k in self.wavenumbers:
+      greens_function /= np.sinc(k*self.cell_size/(2.*np.pi))**4.
+
+    greens_function *= np.exp(-k_squared*self.split**2.)
+
+    greens_function.reshape(-1)[0] = 0.
+
+    return greens_function
+
+  def _find_cells(self, positions):
+    '''Work out which grid cell each particle is in and how far across it, in the work arrays.'''
+
+    n_particles = positions.shape[0]
+
+    if self._n_particles != n_particles:
+      self._n_particles = n_particles
+      self._scaled = np.empty((self.n_dimensions, n_particles))
+      self._cells = np.empty((self.n_dimensions, n_particles), dtype=np.int64)
+      self._upper_cells = np.empty((self.n_dimensions, n_particles), dtype=np.int64)
+      self._fractions = np.empty((self.n_dimensions, n_particles))
+      self._complements = np.empty((self.n_dimensions, n_particles))
+      self._indices = np.empty(n_particles, dtype=np.int64)
+      self._weights = np.empty(n_particles)
+      self._values = np.empty(n_particles)
+      self._interpolated = np.empty((n_particles, self.n_dimensions))
+
+    np.multiply(positions.T, 1./self.cell_size, out=self._scaled)
+    np.floor(self._scaled, out=self._fractions)
+    self._cells[:] = self._fractions
+    np.subtract(self._scaled, self._fractions, out=self._fractions)
+    np.subtract(1., self._fractions, out=self._complements)
+
+    np.remainder(self._cells, self.grid_size, out=self._cells)
+    np.add(self._cells, 1, out=self._upper_cells)
+    np.remainder(self._upper_cells, self.grid_size, out=self._upper_cells)
+
+  def _find_corner(self, corner):
+    '''Put each particle's flat grid index and weight for one corner of its cell in the work arrays.'''
+
+    self._indices.fill(0)
+    self._weights.fill(1.)
+
+    for d, upper in enumerate(corner):
+      self._indices *= self.grid_size
+      if upper:
+        self._indices += self._upper_cells[d]
+        self._weights *= self._fractions[d]
+      else:
+        self._indices += self._cells[d]
+        self._weights *= self._complements[d]
+
+########################################################################
+
+def _transform(function, array, out, **kwargs):
+  '''Apply a numpy.fft transform, writing the result into out.'''
+
+  if FFT_HAS_OUT:
+    function(array, out=out, **kwargs)
+  else:
+    out[...] = function(array, **kwargs)
@@ -0,0 +1,240 @@
+'''
+Mixed precision direct forces: each pair is worked out in float32, and the sums over pairs are
+done in float64.
+
+Turned on by parameters['mixed_precision'] = True with the direct force method. Plain float32
+positions would lose everything below the seventh significant figure of the coordinates, so two
+nearby particles far from the origin would have badly wrong separations. Instead, the particles are
+sorted along a Morton (Z-order) curve and cut into cells of nearby particles, and each position is
+stored as a float32 offset from its cell's float64 origin. A displacement between two particles is
+then the (float32) difference of their cells' origins plus the difference of their offsets, which
+keeps float32's relative precision in the separation itself rather than in the coordinates.
+
+Lengths are measured in units of a power of two near the largest offset, and masses in units of the
+mean mass, so nothing overflows or underflows in float32 whatever units the simulation is in.
+
+This only speeds up the force calculation. The particles still hold float64 positions, which the
+integrators update, and the relative float32 positions are rebuilt from them on every force call, so
+no memory is saved between steps.
+
+compare_with_float64() measures how much accuracy this loses, and benchmarks/mixed_precision.py
+tabulates it for a few particle distributions.
+'''
+
+import numpy as np
+
+import n_body_physics
+import n_body_softening
+
+# Default number of particles in each cell, which is also the tile size of the force calculation.
+DEFAULT_CELL_SIZE = 512
+
+########################################################################
+
+def sort_spatially(positions):
+  '''Sort particles along a Morton (Z-order) curve, so particles that are close in the order are
+  close in space.
+
+  Args:
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+
+  Returns:
+  order -- Array of particle indices in Morton order
+  '''
+
+  n_particles, n_dimensions = positions.shape
+
+  # As many bits per dimension as fit in a signed 64 bit key
+  n_bits = min(21, 63//n_dimensions)
+
+  lower = positions.min(axis=0)
+  width = (positions.max(axis=0) - lower).max()
+  if width == 0.:
+    width = 1.
+
+  cells = ((positions - lower)*((2**n_bits - 1)/width)).astype(np.int64)
+
+  keys = np.zeros(n_particles, dtype=np.int64)
+  for bit in range(n_bits):
+    for d in range(n_dimensions):
+      keys |= ((cells[:, d] >> bit) & 1) << (bit*n_dimensions + d)
+
+  return np.argsort(keys, kind='stable')
+
+########################################################################
+
+class RelativePositions(object):
+  '''Positions stored as float32 offsets from float64 cell origins, with the particles sorted so
+  that each cell is a contiguous run of nearby particles.'''
+
+  def __init__(self, positions, cell_size=DEFAULT_CELL_SIZE):
+    '''
+    Args:
+    positions -- Array of particle positions, shape (n_particles, n_dimensions)
+    cell_size -- Number of particles in each cell
+    '''
+
+    positions = np.asarray(positions, dtype=float)
+    n_particles = positions.shape[0]
+
+    self.order = sort_spatially(positions)
+    self.starts = np.arange(0, n_particles, cell_size)
+    self.ends = np.minimum(self.starts + cell_size, n_particles)
+
+    sorted_positions = positions[self.order]
+
+    # Each cell's middle particle, rather than the centre of its bounding box, since a cell that
+    # spans a jump in the Morton curve may have a few outlying particles.
+    self.origins = sorted_positions[(self.starts + self.ends)//2]
+
+    cells = np.repeat(np.arange(len(self.starts)), self.ends - self.starts)
+    offsets = sorted_positions - self.origins[cells]
+
+    # A power of two, so scaling by it is exact.
+    largest_offset = np.abs(offsets).max() if n_particles > 0 else 0.
+    self.length_scale = 2.**np.ceil(np.log2(largest_offset)) if largest_offset > 0. else 1.
+
+    self.offsets = (offsets/self.length_scale).astype(np.float32)
+
+  @property
+  def n_cells(self):
+
+    return len(self.starts)
+
+  @property
+  def nbytes(self):
+    '''Bytes used by the origins and offsets.'''
+
+    return self.origins.nbytes + self.offsets.nbytes
+
+  def cell_slice(self, cell):
+    '''Where a cell's particles are in the sorted order.'''
+
+    return slice(self.starts[cell], self.ends[cell])
+
+  def origin_shift(self, cell_i, cell_j):
+    '''The displacement from cell_i's origin to cell_j's, in units of length_scale.'''
+
+    return (self.origins[cell_j] - self.origins[cell_i])/self.length_scale
+
+  def to_positions(self):
+    '''The positions in float64, in the original order.'''
+
+    cells = np.repeat(np.arange(self.n_cells), self.ends - self.starts)
+
+    positions = np.empty(self.offsets.shape)
+    positions[self.order] = self.origins[cells] + self.length_scale*self.offsets.astype(float)
+
+    return positions
+
+########################################################################
+
+def calculate_mixed_precision_forces(masses, positions, G, cell_size=DEFAULT_CELL_SIZE, softening=0.,
+                                     softening_kernel='plummer', potentials=None):
+  '''Calculate the net force on every particle, one pair of cells at a time, with float32 pairs and
+  float64 sums. The positions are converted to RelativePositions on every call.
+
+  Args:
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  G -- The gravitational constant
+  cell_size -- Number of particles in each cell
+  softening -- The softening length, see n_body_softening
+  softening_kernel -- How the softening is done, 'plummer' or 'spline'
+  potentials -- If given, an array, shape (n_particles,), that the gravitational potential at each
+    particle is added to
+
+  Returns:
+  total_forces -- Array of net forces, shape (n_particles, n_dimensions)
+  '''
+
+  masses = np.asarray(masses, dtype=float)
+  n_particles, n_dimensions = np.shape(positions)
+
+  relative = RelativePositions(positions, cell_size)
+
+  mass_scale = np.abs(masses).mean() if np.any(masses) else 1.
+  scaled_masses = (masses[relative.order]/mass_scale).astype(np.float32)
+  scaled_softening = float(softening/relative.length_scale)
+
+  # Sums of scaled_mass*displacement*inverse_cube, and of scaled_mass*inverse_distance
+  sums = np.zeros((n_particles, n_dimensions))
+  potential_sums = np.zeros(n_particles) if potentials is not None else None
+
+  offsets = relative.offsets.astype(np.float64)
+
+  for cell_i in range(relative.n_cells):
+    slice_i = relative.cell_slice(cell_i)
+
+    for cell_j in range(cell_i, relative.n_cells):
+      slice_j = relative.cell_slice(cell_j)
+
+      origin_shift = relative.origin_shift(cell_i, cell_j)
+
+      # The pairs, in float32
+      displacements = (relative.offsets[slice_j] + origin_shift.astype(np.float32))[np.newaxis, :, :] \
+                      - relative.offsets[slice_i][:, np.newaxis, :]
+      distances_squared = np.einsum('tsd,tsd->ts', displacements, displacements)
+      inverse_cubes = n_body_softening.calculate_inverse_cubes(distances_squared, scaled_softening, softening_kernel, dtype=np.float32)
+
+      # The sums, as float64 matrix products: sum_j w_ij (x_j - x_i) = sum_j w_ij x_j - x_i sum_j w_ij,
+      # with each cell's positions relative to cell_i's origin.
+      targets = offsets[slice_i]
+      sources = offsets[slice_j] + origin_shift
+
+      weights = (inverse_cubes*scaled_masses[np.newaxis, slice_j]).astype(np.float64)
+      sums[slice_i] += weights.dot(sources) - targets*weights.sum(axis=1)[:, np.newaxis]
+
+      # Newton's third law gives the sources their share, except within a cell, where every pair
+      # is already there twice.
+      if cell_j != cell_i:
+        weights = (inverse_cubes*scaled_masses[slice_i, np.newaxis]).astype(np.float64)
+        sums[slice_j] += weights.T.dot(targets) - sources*weights.sum(axis=0)[:, np.newaxis]
+
+      if potentials is not None:
+        inverse_distances = n_body_softening.calculate_inverse_distances(distances_squared, scaled_softening, softening_kernel,
+                                                                         dtype=np.float32).astype(np.float64)
+        if cell_j == cell_i:
+          np.fill_diagonal(inverse_distances, 0.)
+        else:
+          potential_sums[slice_j] += scaled_masses[slice_i].dot(inverse_distances)
+        potential_sums[slice_i] += inverse_distances.dot(scaled_masses[slice_j])
+
+  total_forces = np.empty((n_particles, n_dimensions))
+  total_forces[relative.order] = (G*mass_scale/relative.length_scale**2.)*masses[relative.order, np.newaxis]*sums
+
+  if potentials is not None:
+    potentials[relative.order] -= (G*mass_scale/relative.length_scale)*potential_sums
+
+  return total_forces
+
+########################################################################
+
+def compare_with_float64(particles, parameters, naive=False):
+  '''Measure the accuracy lost by the mixed precision forces, against the float64 direct sum.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  naive -- If True, measure plain float32 positions instead (everything is cast to float32 before
+    the float64 direct sum), for comparison.
+
+  Returns:
+  errors -- Dictionary of the 'median', '99th_percentile' and 'max' relative error in the force on
+    each particle, |F - F_64|/|F_64|
+  '''
+
+  float64_parameters = dict(parameters, mixed_precision=False, use_numba=False)
+  expected = n_body_physics.calculate_direct_forces(particles, float64_parameters)
+
+  if naive:
+    rounded = dict(particles, masses=np.asarray(particles['masses'], dtype=np.float32),
+                   positions=np.asarray(particles['positions'], dtype=np.float32))
+    actual = n_body_physics.calculate_direct_forces(rounded, float64_parameters)
+  else:
+    actual = n_body_physics.calculate_direct_forces(particles, dict(parameters, mixed_precision=True))
+
+  magnitudes = np.sqrt((expected**2.).sum(axis=1))
+  errors = np.sqrt(((actual - expected)**2.).sum(axis=1))/np.where(magnitudes > 0., magnitudes, 1.)
+
+  return {'median' : float(np.median(errors)), '99th_percentile' : float(np.percentile(errors, 99.)), 'max' : float(errors.max())}
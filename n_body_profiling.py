@@ -0,0 +1,202 @@
+'''
+Opt-in timing of the phases of a run.
+
+Set parameters['profile'] = True to time each phase of the main loop (update_system, save_data,
+checkpoint, check_if_finished) and of the physics inside it (forces, kick, drift), and to count
+force evaluations, pair interactions and bytes written. A pair interaction is one unordered pair of
+particles, so a full direct sum over N particles is N*(N - 1)/2 of them, whatever force method is
+used. These parameters are used if given:
+  'profile_every' -- Print a summary every this many steps. Defaults to 100; 0 only prints one at the end.
+  'profile_window' -- (first step, last step) to run cProfile over, e.g. [1000, 1010]. The
+    statistics are saved to 'profile_output' (default profile.prof), which snakeviz, flameprof or
+    gprof2dot can turn into a flame graph or call graph.
+
+The profiler is kept in parameters['profiler_state']. When profiling is off, get_profiler() returns
+a profiler whose methods do nothing, so the instrumented code costs a dictionary lookup and an
+empty call per phase.
+'''
+
+import cProfile
+import time
+
+DEFAULT_REPORT_EVERY = 100
+
+DEFAULT_TRACE_FILE = 'profile.prof'
+
+########################################################################
+
+def get_profiler(parameters):
+  '''Get the profiler for this run, making it the first time if profiling is on.
+
+  Args:
+  parameters -- The simulation parameter information
+  '''
+
+  profiler = parameters.get('profiler_state')
+  if profiler is not None:
+    return profiler
+
+  if not parameters.get('profile', False):
+    return NULL_PROFILER
+
+  profiler = Profiler(parameters.get('profile_every', DEFAULT_REPORT_EVERY),
+                      parameters.get('profile_window'),
+                      parameters.get('profile_output', DEFAULT_TRACE_FILE))
+  parameters['profiler_state'] = profiler
+
+  return profiler
+
+########################################################################
+
+class Profiler(object):
+  '''Phase timers and counters, with periodic summaries and an optional cProfile window.'''
+
+  def __init__(self, report_every=DEFAULT_REPORT_EVERY, window=None, trace_file=DEFAULT_TRACE_FILE, report=print):
+    '''
+    Args:
+    report_every -- Report a summary every this many steps. 0 never reports until close().
+    window -- (first step, last step) to run cProfile over, or None
+    trace_file -- Where to save the cProfile statistics
+    report -- Function called with each summary
+    '''
+
+    self.report_every = report_every
+    self.window = None if window is None else (int(window[0]), int(window[1]))
+    self.trace_file = trace_file
+    self.report = report
+
+    self.phases = {}
+    self.counters = {}
+    self.n_steps = 0
+    self.start_time = time.perf_counter()
+
+    self.trace = None
+
+  def phase(self, name):
+    '''A context manager that adds the time spent inside it to the named phase.'''
+
+    if name not in self.phases:
+      self.phases[name] = _Phase()
+
+    return self.phases[name]
+
+  def count(self, name, amount=1):
+    '''Add amount to the named counter.'''
+
+    self.counters[name] = self.counters.get(name, 0) + amount
+
+  def start_step(self, step):
+    '''Call at the start of each step, with the number the step will have once it is taken.'''
+
+    if self.window is not None and step == self.window[0] and self.trace is None:
+      self.trace = cProfile.Profile()
+      self.trace.enable()
+
+  def end_step(self, step):
+    '''Call at the end of each step, with its number.'''
+
+    self.n_steps += 1
+
+    if self.trace is not None and step >= self.window[1]:
+      self.save_trace()
+
+    if self.report_every and self.n_steps % self.report_every == 0:
+      self.report(self.summary())
+
+  def save_trace(self):
+    '''Stop cProfile and save what it recorded.'''
+
+    self.trace.disable()
+    self.trace.dump_stats(self.trace_file)
+    self.trace = None
+
+  def summary(self):
+    '''A table of the time spent in each phase and the counters, as a string.'''
+
+    elapsed = time.perf_counter() - self.start_time
+
+    lines = ['Profile after {} steps, {:.3f} s'.format(self.n_steps, elapsed)]
+    lines.append('{:>20}{:>10}{:>12}{:>14}{:>9}'.format('phase', 'calls', 'total (s)', 'per call (ms)', '% time'))
+
+    for name, phase in sorted(self.phases.items(), key=lambda item: -item[1].total):
+      lines.append('{:>20}{:>10}{:>12.3f}{:>14.3f}{:>9.1f}'.format(
+        name, phase.calls, phase.total, 1.e3*phase.total/max(phase.calls, 1), 100.*phase.total/max(elapsed, 1.e-12)))
+
+    for name, value in sorted(self.counters.items()):
+      lines.append('{:>20}{:>22.4g}{:>14.4g} /s'.format(name, value, value/max(elapsed, 1.e-12)))
+
+    return '\n'.join(lines)
+
+  def close(self):
+    '''Save any unfinished cProfile window and report a final summary.'''
+
+    if self.trace is not None:
+      self.save_trace()
+
+    self.report(self.summary())
+
+########################################################################
+
+class _Phase(object):
+  '''The running total for one phase. Phases can be nested, but not inside themselves.'''
+
+  __slots__ = ('calls', 'total', 'started')
+
+  def __init__(self):
+
+    self.calls = 0
+    self.total = 0.
+    self.started = 0.
+
+  def __enter__(self):
+
+    self.started = time.perf_counter()
+    return self
+
+  def __exit__(self, *exception):
+
+    self.total += time.perf_counter() - self.started
+    self.calls += 1
+
+########################################################################
+
+class NullProfiler(object):
+  '''A profiler that records nothing, used when profiling is off.'''
+
+  def phase(self, name):
+
+    return _NULL_PHASE
+
+  def count(self, name, amount=1):
+
+    pass
+
+  def start_step(self, step):
+
+    pass
+
+  def end_step(self, step):
+
+    pass
+
+  def close(self):
+
+    pass
+
+########################################################################
+
+class _NullPhase(object):
+
+  __slots__ = ()
+
+  def __enter__(self):
+
+    return self
+
+  def __exit__(self, *exception):
+
+    pass
+
+_NULL_PHASE = _NullPhase()
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,430 @@
+'''
+A long-running simulation server, so that many short jobs don't each pay for starting Python and
+importing NumPy.
+
+The server listens on a Unix socket, and keeps n_workers worker processes with the simulation
+modules already imported. The workers are started by a fork server, never forked from the server
+itself, whose event loop and thread pool would be copied into them half-way through. Jobs wait in a
+queue of at most queue_size, and each worker takes the next job as soon as it is free. A client that
+submits jobs while the queue is full is held back until there is room, and a client that reads its
+messages slowly holds back the worker running its job, so neither piles up in the server's memory.
+
+The protocol is one JSON object per line, both ways. A client sends
+  {"type": "submit", "job": {...}} -- Queue a job. The server replies {"type": "accepted", "job": id}.
+  {"type": "status"} -- The server replies with the queue length and the number of busy workers.
+A job is a config dictionary, as for n_body_setup.parse_config() (particles or initial_conditions,
+plus parameters, which must include max_steps or t_end), with optional
+  "stream" -- "snapshots" to send the positions and velocities, "diagnostics" to send the conserved
+    quantities from n_body_diagnostics, or "summary" (the default) for neither
+  "stream_every" -- How many steps apart to send them. Defaults to 1.
+While the job runs, the server sends {"type": "snapshot" or "diagnostics", "job": id, ...} lines,
+and finally {"type": "done", "job": id, "summary": {...}} or {"type": "error", "job": id,
+"message": ...}. Nothing is written to disk.
+
+Usage:
+python n_body_server.py [--socket n_body.sock] [--workers 4] [--queue-size 64]
+
+and, from Python, run_jobs() submits jobs and collects what comes back.
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import traceback
+
+import numpy as np
+
+import n_body_diagnostics
+import n_body_physics
+import n_body_setup
+import n_body_wrapup
+
+DEFAULT_SOCKET = 'n_body.sock'
+
+# Default maximum number of jobs waiting for a worker
+DEFAULT_QUEUE_SIZE = 64
+
+# Longest line the server reads from a client, so a job can hold plenty of particles
+MAX_LINE_LENGTH = 2**28
+
+STREAMS = ('summary', 'snapshots', 'diagnostics')
+
+########################################################################
+
+def run_job(job, send):
+  '''Run one job to the end, sending what it asks for along the way.
+
+  Args:
+  job -- The job: a config dictionary, with optional 'stream' and 'stream_every'
+  send -- Called with each message, as a dictionary of plain numbers and lists
+
+  Returns:
+  summary -- Dictionary of the steps taken, the time, why the job finished and the final
+    conserved quantities
+  '''
+
+  config = dict(job)
+  stream = config.pop('stream', 'summary')
+  stream_every = config.pop('stream_every', 1)
+
+  if stream not in STREAMS:
+    raise ValueError('Unknown stream: {}. Choose from {}.'.format(stream, STREAMS))
+
+  if config.get('max_steps') is None and config.get('t_end') is None:
+    raise ValueError('A job needs max_steps or t_end, so that it finishes.')
+
+  # The initial conditions are made afresh for each job, not cached on disk.
+  config.setdefault('ic_cache_dir', None)
+
+  particles, parameters = n_body_setup.parse_config(config)
+
+  # What the drifts are measured from
+  n_body_diagnostics.update_diagnostics(particles, parameters, force=True)
+
+  n_body_wrapup.check_if_finished(particles, parameters)
+
+  while not parameters['finished']:
+    n_body_physics.update_system(particles, parameters)
+
+    if stream != 'summary' and parameters['step'] % stream_every == 0:
+      if stream == 'snapshots':
+        send({'type' : 'snapshot', 'step' : parameters['step'], 'time' : parameters['time'],
+              'positions' : np.asarray(particles['positions']).tolist(), 'velocities' : np.asarray(particles['velocities']).tolist()})
+      else:
+        send(dict(n_body_diagnostics.update_diagnostics(particles, parameters, force=True), type='diagnostics'))
+
+    n_body_wrapup.check_if_finished(particles, parameters)
+
+  return {
+    'steps' : int(parameters.get('step', 0)),
+    'time' : float(parameters.get('time', 0.)),
+    'finish_reason' : parameters.get('finish_reason'),
+    'n_particles' : len(particles['masses']),
+    'diagnostics' : n_body_diagnostics.update_diagnostics(particles, parameters, force=True),
+  }
+
+########################################################################
+
+class Server(object):
+  '''The job queue, the worker processes and the socket they are served on.'''
+
+  def __init__(self, socket_path=DEFAULT_SOCKET, n_workers=None, queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+    Args:
+    socket_path -- Where to make the Unix socket
+    n_workers -- Number of worker processes. Defaults to the number of cores.
+    queue_size -- Maximum number of jobs waiting for a worker
+    '''
+
+    self.socket_path = socket_path
+    self.n_workers = n_workers or os.cpu_count() or 1
+    self.queue_size = queue_size
+
+    self.workers = []
+    self.n_busy = 0
+
+    self._job_ids = itertools.count()
+    self._queue = None
+    self._server = None
+    self._tasks = []
+    self._threads = None
+
+    # The task serving each connected client, by its writer
+    self._clients = {}
+
+  def start_workers(self):
+    '''Start the worker processes, which import the simulation modules straight away.'''
+
+    self._threads = concurrent.futures.ThreadPoolExecutor(self.n_workers)
+    self.workers = [_Worker() for i in range(self.n_workers)]
+
+  async def start(self):
+    '''Start the workers, if they haven't been already, and listen on the socket.'''
+
+    if not self.workers:
+      self.start_workers()
+
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+
+    self._queue = asyncio.Queue(self.queue_size)
+    self._tasks = [asyncio.ensure_future(self._dispatch(worker)) for worker in self.workers]
+    self._server = await asyncio.start_unix_server(self._serve_client, self.socket_path, limit=MAX_LINE_LENGTH)
+
+  async def serve_forever(self):
+
+    await self.start()
+    try:
+      await self._server.serve_forever()
+    finally:
+      await self.close()
+
+  async def close(self):
+    '''Stop listening, hang up on the clients, and shut down the workers.'''
+
+    if self._server is not None:
+      self._server.close()
+
+    clients = list(self._clients.items())
+    for writer, task in clients:
+      writer.close()
+      task.cancel()
+    await asyncio.gather(*[task for writer, task in clients], return_exceptions=True)
+    self._clients = {}
+
+    if self._server is not None:
+      await self._server.wait_closed()
+      self._server = None
+
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+    self._tasks = []
+
+    for worker in self.workers:
+      worker.stop()
+    self.workers = []
+
+    if self._threads is not None:
+      self._threads.shutdown(wait=False)
+      self._threads = None
+
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+
+  async def _serve_client(self, reader, writer):
+    '''Read a client's requests, one per line, until it disconnects or the server closes.'''
+
+    self._clients[writer] = asyncio.current_task()
+
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+
+        try:
+          request = json.loads(line)
+          request_type = request.get('type')
+        except (ValueError, AttributeError):
+          _write(writer, {'type' : 'error', 'message' : 'Requests must be JSON objects, one per line.'})
+          continue
+
+        if request_type == 'submit':
+          job_id = next(self._job_ids)
+          _write(writer, {'type' : 'accepted', 'job' : job_id})
+
+          # Waits here while the queue is full.
+          await self._queue.put((job_id, request.get('job', {}), writer))
+
+        elif request_type == 'status':
+          _write(writer, {'type' : 'status', 'queued' : self._queue.qsize(), 'busy' : self.n_busy, 'workers' : len(self.workers)})
+
+        else:
+          _write(writer, {'type' : 'error', 'message' : 'Unknown request type: {}'.format(request_type)})
+
+        await writer.drain()
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+
+    except asyncio.CancelledError:
+      # The server is closing. Nothing waits on this task but close(), so it ends quietly.
+      pass
+
+    finally:
+      self._clients.pop(writer, None)
+      writer.close()
+
+  async def _dispatch(self, worker):
+    '''Hand jobs from the queue to one worker, and pass its messages back to the job's client.'''
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+      job_id, job, writer = await self._queue.get()
+      self.n_busy += 1
+
+      try:
+        worker.connection.send((job_id, job))
+
+        while True:
+          finished, line = await loop.run_in_executor(self._threads, worker.connection.recv)
+          _write_line(writer, line)
+
+          # Waits for a slow client to catch up before taking the next message from the worker.
+          await _drain(writer)
+          if finished:
+            break
+
+      except (EOFError, OSError):
+        # The worker died, so start a new one in its place.
+        _write(writer, {'type' : 'error', 'job' : job_id, 'message' : 'The worker running the job stopped.'})
+        worker.restart()
+
+      finally:
+        self.n_busy -= 1
+        self._queue.task_done()
+
+      await _drain(writer)
+
+########################################################################
+
+class _Worker(object):
+  '''A worker process, and the pipe the server talks to it through.'''
+
+  # Workers may be restarted from inside the event loop, while the thread pool is running, so they
+  # are never forked from the server.
+  context = multiprocessing.get_context('forkserver')
+
+  def __init__(self):
+
+    self.start()
+
+  def start(self):
+
+    self.connection, child_connection = self.context.Pipe()
+    self.process = self.context.Process(target=_worker_main, args=(child_connection,), daemon=True)
+    self.process.start()
+    child_connection.close()
+
+  def restart(self):
+
+    self.stop()
+    self.start()
+
+  def stop(self):
+
+    try:
+      self.connection.send(None)
+    except (OSError, ValueError):
+      pass
+
+    self.process.join(timeout=1.)
+    if self.process.is_alive():
+      self.process.terminate()
+      self.process.join()
+
+    self.connection.close()
+
+########################################################################
+
+def _worker_main(connection):
+  '''Run jobs from the server until it sends None.'''
+
+  while True:
+    try:
+      task = connection.recv()
+    except EOFError:
+      return
+
+    if task is None:
+      return
+
+    job_id, job = task
+
+    def send(message):
+      connection.send((False, _encode(dict(message, job=job_id))))
+
+    try:
+      summary = run_job(job, send)
+      connection.send((True, _encode({'type' : 'done', 'job' : job_id, 'summary' : summary})))
+    except Exception as error:
+      connection.send((True, _encode({'type' : 'error', 'job' : job_id, 'message' : '{}: {}'.format(type(error).__name__, error),
+                                      'traceback' : traceback.format_exc()})))
+
+########################################################################
+
+def _encode(message):
+  '''A message as one line of JSON.'''
+
+  return (json.dumps(message, default=_to_json) + '\n').encode('utf-8')
+
+def _to_json(value):
+
+  if isinstance(value, np.generic):
+    return value.item()
+  if isinstance(value, np.ndarray):
+    return value.tolist()
+
+  raise TypeError('Cannot send {} as JSON.'.format(type(value).__name__))
+
+def _write(writer, message):
+
+  _write_line(writer, _encode(message))
+
+def _write_line(writer, line):
+
+  # The client may have gone, in which case its job's messages are dropped.
+  if not writer.is_closing():
+    writer.write(line)
+
+async def _drain(writer):
+
+  try:
+    await writer.drain()
+  except ConnectionError:
+    pass
+
+########################################################################
+
+def run_jobs(jobs, socket_path=DEFAULT_SOCKET):
+  '''Submit jobs to a running server and wait for all of them to finish.
+
+  Args:
+  jobs -- List of jobs, see run_job()
+  socket_path -- The server's socket
+
+  Returns:
+  results -- For each job, in order, the list of messages sent back for it, ending with 'done' or 'error'
+  '''
+
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.connect(socket_path)
+
+  with client, client.makefile('rb') as lines:
+
+    job_ids = []
+    for job in jobs:
+      client.sendall(_encode({'type' : 'submit', 'job' : job}))
+
+    results = {}
+    n_finished = 0
+    while n_finished < len(jobs):
+      line = lines.readline()
+      if not line:
+        raise ConnectionError('The server closed the connection.')
+
+      message = json.loads(line)
+      if message['type'] == 'accepted':
+        job_ids.append(message['job'])
+        results[message['job']] = []
+        continue
+
+      results.setdefault(message.get('job'), []).append(message)
+      if message['type'] in ('done', 'error'):
+        n_finished += 1
+
+  return [results[job_id] for job_id in job_ids]
+
+########################################################################
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('--socket', default=DEFAULT_SOCKET)
+  parser.add_argument('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of cores.')
+  parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE)
+  arguments = parser.parse_args()
+
+  server = Server(arguments.socket, arguments.workers, arguments.queue_size)
+
+  try:
+    asyncio.run(server.serve_forever())
+  except KeyboardInterrupt:
+    pass
@@ -1,19 +1,390 @@
 '''
 Contains functions for setting up the simulation.
+
+The simulation is set up by a config file, config.py by default, which is ordinary Python. Every
+variable it defines becomes a parameter, e.g.
+
+  G = 1.
+  dt = 1.e-3
+  integrator = 'leapfrog'
+
+and the particles come either from 'masses', 'positions' and (optionally) 'velocities' arrays, or
+from an 'initial_conditions' dictionary naming one of the samplers in INITIAL_CONDITIONS, e.g.
+
+  initial_conditions = {'type' : 'plummer', 'n_particles' : 100000, 'seed' : 42}
+
+Generated initial conditions with a seed are cached in parameters['ic_cache_dir'], so the next run
+with the same initial conditions loads them instead of sampling them again.
 '''
 
+import hashlib
+import inspect
+import json
+import os
+import runpy
+
+import numpy as np
+
+import n_body_checkpoint
+import n_body_particles
+
+DEFAULT_CONFIG_FILE = 'config.py'
+
+DEFAULT_CACHE_DIR = 'ic_cache'
+
+# Change this when a sampler changes, so old cached initial conditions aren't used.
+CACHE_VERSION = 1
+
+# The config variables that describe the particles rather than the parameters.
+PARTICLE_KEYS = ('masses', 'positions', 'velocities', 'radii')
+
 ########################################################################
 
-def load_config():
+def load_settings(filename=DEFAULT_CONFIG_FILE):
+  '''Load the config file and set up the particles and parameters from it.
+
+  Args:
+  filename -- The config file
+
+  Returns:
+  particles -- The particle information
+  parameters -- The simulation parameter information
+  '''
+
+  return parse_config(load_config(filename))
+
+########################################################################
+
+def load_config(filename=DEFAULT_CONFIG_FILE):
   '''Looks for a file named config.py and loads it.
+
+  Args:
+  filename -- The config file
+
+  Returns:
+  config -- Dictionary of the variables defined in the file, leaving out modules, functions and
+    names starting with an underscore
   '''
 
-  pass
+  if not os.path.exists(filename):
+    raise IOError('Config file {} not found.'.format(filename))
+
+  variables = runpy.run_path(filename)
+
+  config = {}
+  for key, value in variables.items():
+    if key.startswith('_') or inspect.ismodule(value) or callable(value):
+      continue
+    config[key] = value
+
+  return config
 
 ########################################################################
 
-def parse_config():
+def parse_config(config):
   '''Parses the information contained in config.py .
+
+  Args:
+  config -- Dictionary of config variables, as returned by load_config()
+
+  Returns:
+  particles -- The particle information. A ParticleSet if config['particle_set'] is True,
+    otherwise a dictionary of arrays.
+  parameters -- The simulation parameter information: everything else in config.
   '''
 
-  pass
+  parameters = dict((key, value) for key, value in config.items() if key not in PARTICLE_KEYS)
+  parameters.setdefault('G', 6.67e-11)
+  parameters.setdefault('finished', False)
+
+  if 'initial_conditions' in config:
+    particles = get_initial_conditions(config['initial_conditions'], parameters['G'],
+                                       parameters.get('ic_cache_dir', DEFAULT_CACHE_DIR))
+
+  elif 'masses' in config and 'positions' in config:
+    particles = {
+      'masses' : np.array(config['masses'], dtype=float),
+      'positions' : np.array(config['positions'], dtype=float),
+    }
+    if config.get('velocities') is None:
+      particles['velocities'] = np.zeros(particles['positions'].shape)
+    else:
+      particles['velocities'] = np.array(config['velocities'], dtype=float)
+
+  else:
+    raise ValueError('The config needs either initial_conditions, or masses and positions.')
+
+  # The bodies' sizes, for collisions: one radius each, or one for all of them
+  if config.get('radii') is not None:
+    particles['radii'] = np.broadcast_to(np.array(config['radii'], dtype=float), particles['masses'].shape).copy()
+
+  if parameters.get('particle_set', False):
+    particles = n_body_particles.ParticleSet.from_dict(particles)
+
+  return particles, parameters
+
+########################################################################
+# Initial conditions
+########################################################################
+
+def get_initial_conditions(spec, G, cache_dir=DEFAULT_CACHE_DIR):
+  '''Generate initial conditions, or load them from the cache if they were generated before.
+
+  Only initial conditions with a 'seed' are cached, since without one each run should get a
+  different sample. The cache file is named after a hash of spec and G, the only things the
+  samplers depend on.
+
+  Args:
+  spec -- Dictionary with the name of the sampler as 'type', an optional 'seed', and the rest of
+    the sampler's arguments
+  G -- The gravitational constant
+  cache_dir -- Where to cache the initial conditions. None turns the cache off.
+
+  Returns:
+  particles -- Dictionary of masses, positions and velocities
+  '''
+
+  if not cache_dir or spec.get('seed') is None:
+    return make_initial_conditions(spec, G)
+
+  key = json.dumps({'initial_conditions' : spec, 'G' : G, 'version' : CACHE_VERSION}, sort_keys=True, default=_to_json)
+  filename = os.path.join(cache_dir, 'ic_{}.nbody'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]))
+
+  if os.path.exists(filename):
+    header, arrays = n_body_checkpoint.read_arrays(filename)
+    return dict((name, np.array(value)) for name, value in arrays.items())
+
+  particles = make_initial_conditions(spec, G)
+
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  n_body_checkpoint.write_arrays(filename, {'version' : CACHE_VERSION, 'key' : key}, dict(particles))
+
+  return particles
+
+########################################################################
+
+def make_initial_conditions(spec, G):
+  '''Sample initial conditions with one of the samplers in INITIAL_CONDITIONS.
+
+  Args:
+  spec -- Dictionary with the name of the sampler as 'type', an optional 'seed', and the rest of
+    the sampler's arguments
+  G -- The gravitational constant
+
+  Returns:
+  particles -- Dictionary of masses, positions and velocities
+  '''
+
+  options = dict(spec)
+  name = options.pop('type', None)
+  seed = options.pop('seed', None)
+
+  if name not in INITIAL_CONDITIONS:
+    raise ValueError('Unknown initial conditions: {}. Choose from {}.'.format(name, sorted(INITIAL_CONDITIONS)))
+
+  return INITIAL_CONDITIONS[name](rng=np.random.default_rng(seed), G=G, **options)
+
+########################################################################
+
+def sample_plummer_sphere(n_particles, rng=None, G=1., n_dimensions=3, total_mass=1., scale_radius=1.):
+  '''Sample a Plummer sphere in equilibrium, with equal mass particles (Aarseth, Henon & Wielen 1974).
+
+  Args:
+  n_particles -- Number of particles
+  rng -- The random number generator. Defaults to a new, unseeded one.
+  G -- The gravitational constant
+  n_dimensions -- Must be 3
+  total_mass -- Total mass of the sphere
+  scale_radius -- The Plummer radius
+
+  Returns:
+  particles -- Dictionary of masses, positions and velocities, in the centre of mass frame
+  '''
+
+  if n_dimensions != 3:
+    raise ValueError('A Plummer sphere needs 3 dimensions, not {}.'.format(n_dimensions))
+
+  if rng is None:
+    rng = np.random.default_rng()
+
+  # Invert the cumulative mass profile M(<r)/M = r^3/(r^2 + a^2)^(3/2).
+  mass_fractions = rng.uniform(0., 1., n_particles)
+  radii = scale_radius/np.sqrt(mass_fractions**(-2./3.) - 1.)
+
+  positions = radii[:, np.newaxis]*_random_directions(rng, n_particles, 3)
+
+  # Speeds as fractions q of the local escape speed, by rejection from g(q) = q^2 (1 - q^2)^(7/2),
+  # whose maximum is just under 0.1.
+  fractions = np.empty(n_particles)
+  remaining = np.arange(n_particles)
+  while remaining.size > 0:
+    q = rng.uniform(0., 1., remaining.size)
+    accepted = rng.uniform(0., 0.1, remaining.size) < q**2.*(1. - q**2.)**3.5
+    fractions[remaining[accepted]] = q[accepted]
+    remaining = remaining[~accepted]
+
+  escape_speeds = np.sqrt(2.*G*total_mass/scale_radius)*(1. + (radii/scale_radius)**2.)**-0.25
+
+  velocities = (fractions*escape_speeds)[:, np.newaxis]*_random_directions(rng, n_particles, 3)
+
+  masses = np.full(n_particles, total_mass/n_particles)
+
+  return _centre_of_mass_frame(masses, positions, velocities)
+
+########################################################################
+
+def sample_uniform_disk(n_particles, rng=None, G=1., n_dimensions=2, total_mass=1., radius=1., central_mass=0.):
+  '''Sample a disk of uniform surface density in the x-y plane, on circular orbits about its centre.
+
+  Each particle's orbital speed comes from the mass inside its radius, so the disk starts close to
+  rotational equilibrium.
+
+  Args:
+  n_particles -- Number of disk particles
+  rng -- The random number generator. Defaults to a new, unseeded one.
+  G -- The gravitational constant
+  n_dimensions -- 2, or 3 for a flat disk in 3D
+  total_mass -- Total mass of the disk
+  radius -- Radius of the disk
+  central_mass -- Mass of an extra particle at the centre. None is added if it is 0.
+
+  Returns:
+  particles -- Dictionary of masses, positions and velocities, in the centre of mass frame
+  '''
+
+  if n_dimensions not in (2, 3):
+    raise ValueError('A disk needs 2 or 3 dimensions, not {}.'.format(n_dimensions))
+
+  if rng is None:
+    rng = np.random.default_rng()
+
+  radii = radius*np.sqrt(rng.uniform(0., 1., n_particles))
+  angles = rng.uniform(0., 2.*np.pi, n_particles)
+
+  enclosed_masses = central_mass + total_mass*(radii/radius)**2.
+  speeds = np.sqrt(G*enclosed_masses/np.maximum(radii, np.finfo(float).tiny))
+
+  positions = np.zeros((n_particles, n_dimensions))
+  positions[:, 0] = radii*np.cos(angles)
+  positions[:, 1] = radii*np.sin(angles)
+
+  velocities = np.zeros((n_particles, n_dimensions))
+  velocities[:, 0] = -speeds*np.sin(angles)
+  velocities[:, 1] = speeds*np.cos(angles)
+
+  masses = np.full(n_particles, total_mass/n_particles)
+
+  if central_mass > 0.:
+    masses = np.concatenate([[central_mass], masses])
+    positions = np.concatenate([np.zeros((1, n_dimensions)), positions])
+    velocities = np.concatenate([np.zeros((1, n_dimensions)), velocities])
+
+  return _centre_of_mass_frame(masses, positions, velocities)
+
+########################################################################
+
+def sample_keplerian_system(n_planets, rng=None, G=1., n_dimensions=3, star_mass=1.,
+                            planet_masses=(1.e-7, 1.e-3), semi_major_axes=(0.5, 30.),
+                            max_eccentricity=0.1, max_inclination=0.05):
+  '''Sample a planetary system: a star with planets on Keplerian orbits about it.
+
+  The orbital elements are drawn independently: masses and semi-major axes log-uniformly,
+  eccentricities and inclinations uniformly, and the angles uniformly.
+
+  Args:
+  n_planets -- Number of planets
+  rng -- The random number generator. Defaults to a new, unseeded one.
+  G -- The gravitational constant
+  n_dimensions -- 2 or 3. In 2 dimensions the inclinations are ignored.
+  star_mass -- Mass of the star
+  planet_masses -- (smallest, largest) planet mass
+  semi_major_axes -- (smallest, largest) semi-major axis
+  max_eccentricity -- Largest eccentricity
+  max_inclination -- Largest inclination, in radians
+
+  Returns:
+  particles -- Dictionary of masses, positions and velocities, in the centre of mass frame, with
+    the star first
+  '''
+
+  if n_dimensions not in (2, 3):
+    raise ValueError('A planetary system needs 2 or 3 dimensions, not {}.'.format(n_dimensions))
+
+  if rng is None:
+    rng = np.random.default_rng()
+
+  masses = np.exp(rng.uniform(np.log(planet_masses[0]), np.log(planet_masses[1]), n_planets))
+  a = np.exp(rng.uniform(np.log(semi_major_axes[0]), np.log(semi_major_axes[1]), n_planets))
+  e = rng.uniform(0., max_eccentricity, n_planets)
+  inclinations = rng.uniform(0., max_inclination, n_planets)
+  nodes, periapses, true_anomalies = rng.uniform(0., 2.*np.pi, (3, n_planets))
+
+  # Position and velocity in the plane of the orbit, with periapsis along x.
+  semi_latus_rectum = a*(1. - e**2.)
+  r = semi_latus_rectum/(1. + e*np.cos(true_anomalies))
+  speed_scale = np.sqrt(G*(star_mass + masses)/semi_latus_rectum)
+
+  orbit_positions = np.array([r*np.cos(true_anomalies), r*np.sin(true_anomalies)])
+  orbit_velocities = np.array([-speed_scale*np.sin(true_anomalies), speed_scale*(e + np.cos(true_anomalies))])
+
+  # Rotate by the argument of periapsis, inclination and longitude of the ascending node.
+  cos_w, sin_w = np.cos(periapses), np.sin(periapses)
+  if n_dimensions == 2:
+    rotation = np.array([[cos_w, -sin_w],
+                         [sin_w, cos_w]])
+  else:
+    cos_i, sin_i = np.cos(inclinations), np.sin(inclinations)
+    cos_n, sin_n = np.cos(nodes), np.sin(nodes)
+    rotation = np.array([[cos_n*cos_w - sin_n*sin_w*cos_i, -cos_n*sin_w - sin_n*cos_w*cos_i],
+                         [sin_n*cos_w + cos_n*sin_w*cos_i, -sin_n*sin_w + cos_n*cos_w*cos_i],
+                         [sin_w*sin_i, cos_w*sin_i]])
+
+  positions = np.einsum('dkn,kn->nd', rotation, orbit_positions)
+  velocities = np.einsum('dkn,kn->nd', rotation, orbit_velocities)
+
+  masses = np.concatenate([[star_mass], masses])
+  positions = np.concatenate([np.zeros((1, n_dimensions)), positions])
+  velocities = np.concatenate([np.zeros((1, n_dimensions)), velocities])
+
+  return _centre_of_mass_frame(masses, positions, velocities)
+
+########################################################################
+
+def _random_directions(rng, n, n_dimensions):
+  '''Unit vectors pointing in uniformly random directions, shape (n, n_dimensions).'''
+
+  directions = rng.normal(0., 1., (n, n_dimensions))
+
+  return directions/np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+########################################################################
+
+def _centre_of_mass_frame(masses, positions, velocities):
+  '''Shift the particles so their centre of mass is at rest at the origin.'''
+
+  total_mass = masses.sum()
+
+  positions = positions - (masses[:, np.newaxis]*positions).sum(axis=0)/total_mass
+  velocities = velocities - (masses[:, np.newaxis]*velocities).sum(axis=0)/total_mass
+
+  return {'masses' : masses, 'positions' : positions, 'velocities' : velocities}
+
+########################################################################
+
+def _to_json(value):
+  '''Turn NumPy values in the initial conditions into something json.dumps() can hash.'''
+
+  if isinstance(value, (np.ndarray, np.generic)):
+    return value.tolist()
+
+  raise TypeError('Cannot use {!r} in initial_conditions.'.format(value))
+
+########################################################################
+
+# The samplers that can be named by initial_conditions['type']
+INITIAL_CONDITIONS = {
+  'plummer' : sample_plummer_sphere,
+  'uniform_disk' : sample_uniform_disk,
+  'keplerian' : sample_keplerian_system,
+}
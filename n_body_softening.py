@@ -0,0 +1,191 @@
+'''
+Gravitational softening, which caps the force between particles that pass very close to each other.
+
+parameters['softening'] is the softening length epsilon (0, the default, is plain Newtonian gravity)
+and parameters['softening_kernel'] chooses how gravity is softened inside it:
+  'plummer' -- Every pair interacts as if separated by sqrt(r^2 + epsilon^2). Never exactly Newtonian.
+  'spline' -- The cubic spline kernel of GADGET-2 (Springel 2005), which is exactly Newtonian beyond
+    2.8 epsilon. The factor 2.8 makes the potential at r = 0 the same as Plummer softening's.
+
+Every force path uses the functions here, written in terms of the squared distances between pairs,
+so they all soften in the same way.
+'''
+
+import numpy as np
+
+SOFTENING_KERNELS = ('plummer', 'spline')
+
+# The spline kernel is Newtonian beyond this many softening lengths.
+SPLINE_RADIUS_FACTOR = 2.8
+
+########################################################################
+
+def get_softening(parameters):
+  '''Get the softening length and kernel from the parameters, checking they make sense.
+
+  Args:
+  parameters -- The simulation parameter information
+
+  Returns:
+  softening -- The softening length
+  softening_kernel -- The name of the kernel
+  '''
+
+  softening = float(parameters.get('softening', 0.))
+  softening_kernel = parameters.get('softening_kernel', 'plummer')
+
+  if softening < 0.:
+    raise ValueError('softening must not be negative, got {}.'.format(softening))
+
+  if softening_kernel not in SOFTENING_KERNELS:
+    raise ValueError('Unknown softening_kernel: {}. Choose from {}.'.format(softening_kernel, SOFTENING_KERNELS))
+
+  return softening, softening_kernel
+
+########################################################################
+
+def calculate_newtonian_radius(softening=0., softening_kernel='plummer'):
+  '''Calculate the separation beyond which a pair feels exactly Newtonian gravity.
+
+  Args:
+  softening -- The softening length
+  softening_kernel -- 'plummer' or 'spline'
+
+  Returns:
+  radius -- 0 without softening, and infinite for Plummer softening, which is never exactly Newtonian
+  '''
+
+  if softening == 0.:
+    return 0.
+
+  if softening_kernel == 'plummer':
+    return np.inf
+
+  return SPLINE_RADIUS_FACTOR*softening
+
+########################################################################
+
+def calculate_inverse_cubes(distances_squared, softening=0., softening_kernel='plummer', dtype=float):
+  '''Calculate the softened version of 1/r^3, so the force on i due to j is
+  G*m_i*m_j*(x_j - x_i)*inverse_cube.
+
+  Without softening, pairs at zero distance (i.e. a particle and itself) get 0.
+
+  Args:
+  distances_squared -- Array of squared distances between pairs
+  softening -- The softening length
+  softening_kernel -- 'plummer' or 'spline'
+  dtype -- What precision to work in
+  '''
+
+  distances_squared = np.asarray(distances_squared, dtype=dtype)
+
+  if softening == 0.:
+    inverse_cubes = np.zeros(distances_squared.shape, dtype=dtype)
+    np.power(distances_squared, -1.5, out=inverse_cubes, where=distances_squared > 0.)
+    return inverse_cubes
+
+  if softening_kernel == 'plummer':
+    return (distances_squared + softening**2.)**-1.5
+
+  h, u, inner, outer, newtonian = _spline_regions(distances_squared, softening, softening_kernel)
+
+  inverse_cubes = np.empty(distances_squared.shape, dtype=dtype)
+  inverse_cubes[newtonian] = distances_squared[newtonian]**-1.5
+
+  u_inner = u[inner]
+  inverse_cubes[inner] = (32./3. + u_inner**2.*(32.*u_inner - 38.4))/h**3.
+
+  u_outer = u[outer]
+  inverse_cubes[outer] = (64./3. - 48.*u_outer + 38.4*u_outer**2. - 32./3.*u_outer**3. - 1./(15.*u_outer**3.))/h**3.
+
+  return inverse_cubes
+
+########################################################################
+
+def calculate_inverse_cube_derivatives(distances_squared, softening=0., softening_kernel='plummer'):
+  '''Calculate (1/r) d/dr of calculate_inverse_cubes(), which the jerks need. Unsoftened this is -3/r^5.
+
+  Args:
+  distances_squared -- Array of squared distances between pairs
+  softening -- The softening length
+  softening_kernel -- 'plummer' or 'spline'
+  '''
+
+  distances_squared = np.asarray(distances_squared, dtype=float)
+
+  if softening == 0.:
+    derivatives = np.zeros(distances_squared.shape)
+    np.power(distances_squared, -2.5, out=derivatives, where=distances_squared > 0.)
+    return -3.*derivatives
+
+  if softening_kernel == 'plummer':
+    return -3.*(distances_squared + softening**2.)**-2.5
+
+  h, u, inner, outer, newtonian = _spline_regions(distances_squared, softening, softening_kernel)
+
+  derivatives = np.empty(distances_squared.shape)
+  derivatives[newtonian] = -3.*distances_squared[newtonian]**-2.5
+
+  derivatives[inner] = (96.*u[inner] - 76.8)/h**5.
+
+  u_outer = u[outer]
+  derivatives[outer] = (-48./u_outer + 76.8 - 32.*u_outer + 0.2/u_outer**5.)/h**5.
+
+  return derivatives
+
+########################################################################
+
+def calculate_inverse_distances(distances_squared, softening=0., softening_kernel='plummer', dtype=float):
+  '''Calculate the softened version of 1/r, so the potential energy of a pair is
+  -G*m_i*m_j*inverse_distance.
+
+  Without softening, pairs at zero distance get 0.
+
+  Args:
+  distances_squared -- Array of squared distances between pairs
+  softening -- The softening length
+  softening_kernel -- 'plummer' or 'spline'
+  dtype -- What precision to work in
+  '''
+
+  distances_squared = np.asarray(distances_squared, dtype=dtype)
+
+  if softening == 0.:
+    inverse_distances = np.zeros(distances_squared.shape, dtype=dtype)
+    np.power(distances_squared, -0.5, out=inverse_distances, where=distances_squared > 0.)
+    return inverse_distances
+
+  if softening_kernel == 'plummer':
+    return (distances_squared + softening**2.)**-0.5
+
+  h, u, inner, outer, newtonian = _spline_regions(distances_squared, softening, softening_kernel)
+
+  inverse_distances = np.empty(distances_squared.shape, dtype=dtype)
+  inverse_distances[newtonian] = distances_squared[newtonian]**-0.5
+
+  u_inner = u[inner]
+  inverse_distances[inner] = (2.8 - u_inner**2.*(16./3. + u_inner**2.*(6.4*u_inner - 9.6)))/h
+
+  u_outer = u[outer]
+  inverse_distances[outer] = (3.2 - 1./(15.*u_outer)
+                              - u_outer**2.*(32./3. + u_outer*(-16. + u_outer*(9.6 - 32./15.*u_outer))))/h
+
+  return inverse_distances
+
+########################################################################
+
+def _spline_regions(distances_squared, softening, softening_kernel):
+  '''Split pairs into the inner and outer parts of the spline kernel, and the Newtonian part beyond it.'''
+
+  if softening_kernel != 'spline':
+    raise ValueError('Unknown softening_kernel: {}. Choose from {}.'.format(softening_kernel, SOFTENING_KERNELS))
+
+  h = SPLINE_RADIUS_FACTOR*softening
+  u = np.sqrt(distances_squared)/h
+
+  inner = u < 0.5
+  newtonian = u >= 1.
+  outer = ~inner & ~newtonian
+
+  return h, u, inner, outer, newtonian
@@ -0,0 +1,277 @@
+'''
+Barnes-Hut tree gravity. A quadtree in 2D, an octree in 3D, and in general a tree that splits
+each cell into 2**n_dimensions children.
+
+The tree is stored as a dictionary of arrays indexed by node number, rather than as node objects,
+and both building and walking it are vectorized over particles.
+'''
+
+import numpy as np
+
+import n_body_softening
+
+# Default opening angle. Cells with size/distance < theta are treated as a single point mass.
+DEFAULT_THETA = 0.5
+
+# Default maximum number of particles in a leaf cell.
+DEFAULT_LEAF_SIZE = 8
+
+# Default number of target particles walked through the tree at once.
+DEFAULT_BATCH_SIZE = 4096
+
+# Cells are not split below this depth, so coincident particles can't recurse forever.
+MAX_DEPTH = 48
+
+########################################################################
+
+def calculate_tree_forces(particles, parameters):
+  '''Calculate the forces on each particle with a Barnes-Hut tree.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information. Uses 'theta', 'leaf_size',
+    'tree_batch_size', 'softening' and 'softening_kernel' if they are given.
+  '''
+
+  masses = np.asarray(particles['masses'], dtype=float)
+  positions = np.asarray(particles['positions'], dtype=float)
+
+  softening, softening_kernel = n_body_softening.get_softening(parameters)
+
+  tree = build_tree(masses, positions, parameters.get('leaf_size', DEFAULT_LEAF_SIZE))
+
+  return evaluate_tree_forces(tree, masses, positions, parameters['G'],
+                              parameters.get('theta', DEFAULT_THETA),
+                              batch_size=parameters.get('tree_batch_size', DEFAULT_BATCH_SIZE),
+                              softening=softening, softening_kernel=softening_kernel)
+
+########################################################################
+# Building the tree
+########################################################################
+
+def build_tree(masses, positions, leaf_size=DEFAULT_LEAF_SIZE):
+  '''Build the tree, one level at a time.
+
+  Args:
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  leaf_size -- Cells with more particles than this are split
+
+  Returns:
+  tree -- Dictionary of node arrays:
+    'centers' -- Geometric center of each cell, shape (n_nodes, n_dimensions)
+    'half_widths' -- Half of the side length of each cell, shape (n_nodes,)
+    'children' -- Node number of each child, or -1, shape (n_nodes, 2**n_dimensions)
+    'masses' -- Total mass in each cell, shape (n_nodes,)
+    'centers_of_mass' -- Center of mass of each cell, shape (n_nodes, n_dimensions)
+    'leaf_starts', 'leaf_counts' -- Where each leaf's particles are in 'order'
+    'order' -- Particle indices sorted by leaf
+  '''
+
+  n_particles, n_dimensions = positions.shape
+  n_children = 2**n_dimensions
+
+  # Bit d of the child number says whether the child is in the upper half along dimension d.
+  child_offsets = ((np.arange(n_children)[:, np.newaxis] >> np.arange(n_dimensions)) & 1)*2. - 1.
+
+  # The root cell is a cube enclosing every particle.
+  lower = positions.min(axis=0)
+  upper = positions.max(axis=0)
+  root_half_width = 0.5*(upper - lower).max()*(1. + 1.e-10)
+  if root_half_width == 0.:
+    root_half_width = 1.
+
+  centers = [0.5*(lower + upper)[np.newaxis, :]]
+  half_widths = [np.array([root_half_width])]
+  parents = [np.array([-1])]
+  child_numbers = [np.array([-1])]
+  level_starts = [0]
+  n_nodes = 1
+
+  # Which node each particle currently sits in
+  particle_nodes = np.zeros(n_particles, dtype=int)
+
+  level_start = 0
+  for depth in range(MAX_DEPTH):
+
+    # Split the cells on this level that hold too many particles.
+    counts = np.bincount(particle_nodes, minlength=n_nodes)[level_start:n_nodes]
+    split = np.zeros(n_nodes, dtype=bool)
+    split[level_start:] = counts > leaf_size
+
+    moving = np.flatnonzero(split[particle_nodes])
+    if moving.size == 0:
+      break
+
+    nodes = particle_nodes[moving]
+    above_center = positions[moving] >= centers[-1][nodes - level_start]
+    child_number = (above_center.astype(int) << np.arange(n_dimensions)).sum(axis=1)
+
+    # Each occupied (node, child_number) combination becomes a new node.
+    keys, new_nodes = np.unique(nodes*n_children + child_number, return_inverse=True)
+    new_parents = keys//n_children
+    new_child_numbers = keys % n_children
+
+    new_half_widths = 0.5*half_widths[-1][new_parents - level_start]
+    new_centers = centers[-1][new_parents - level_start] + child_offsets[new_child_numbers]*new_half_widths[:, np.newaxis]
+
+    particle_nodes[moving] = n_nodes + new_nodes.ravel()
+
+    centers.append(new_centers)
+    half_widths.append(new_half_widths)
+    parents.append(new_parents)
+    child_numbers.append(new_child_numbers)
+
+    level_start = n_nodes
+    level_starts.append(level_start)
+    n_nodes += keys.size
+
+  tree = {}
+  tree['centers'] = np.concatenate(centers)
+  tree['half_widths'] = np.concatenate(half_widths)
+
+  parents = np.concatenate(parents)
+  child_numbers = np.concatenate(child_numbers)
+  tree['children'] = np.full((n_nodes, n_children), -1, dtype=int)
+  tree['children'][parents[1:], child_numbers[1:]] = np.arange(1, n_nodes)
+
+  # Every particle ends up in a leaf, so sorting by node groups the particles of each leaf.
+  tree['order'] = np.argsort(particle_nodes, kind='stable')
+  tree['leaf_counts'] = np.bincount(particle_nodes, minlength=n_nodes)
+  tree['leaf_starts'] = np.cumsum(tree['leaf_counts']) - tree['leaf_counts']
+
+  # Sum the masses and mass moments from the leaves up to the root, one level at a time.
+  node_masses = np.bincount(particle_nodes, masses, minlength=n_nodes)
+  node_moments = np.array([np.bincount(particle_nodes, masses*positions[:, d], minlength=n_nodes) for d in range(n_dimensions)]).transpose()
+  level_ends = level_starts[1:] + [n_nodes]
+  for level_start, level_end in list(zip(level_starts, level_ends))[:0:-1]:
+    level_parents = parents[level_start:level_end]
+    node_masses += np.bincount(level_parents, node_masses[level_start:level_end], minlength=n_nodes)
+    for d in range(n_dimensions):
+      node_moments[:, d] += np.bincount(level_parents, node_moments[level_start:level_end, d], minlength=n_nodes)
+
+  tree['masses'] = node_masses
+  tree['centers_of_mass'] = tree['centers'].copy()
+  occupied = node_masses > 0.
+  tree['centers_of_mass'][occupied] = node_moments[occupied]/node_masses[occupied, np.newaxis]
+
+  return tree
+
+########################################################################
+# Walking the tree
+########################################################################
+
+def evaluate_tree_forces(tree, masses, positions, G, theta=DEFAULT_THETA, targets=None, batch_size=DEFAULT_BATCH_SIZE,
+                         softening=0., softening_kernel='plummer'):
+  '''Calculate the forces on target particles by walking the tree.
+
+  A batch of targets walks the tree together as a list of (target, node) interactions. Each step,
+  cells that are far enough away are applied as a point mass, nearby leaves are summed directly,
+  and the remaining cells are replaced by their children.
+
+  Args:
+  tree -- The tree from build_tree()
+  masses -- Array of particle masses, shape (n_particles,)
+  positions -- Array of particle positions, shape (n_particles, n_dimensions)
+  G -- The gravitational constant
+  theta -- The opening angle
+  targets -- Indices of the particles to calculate forces on. Defaults to all of them.
+  batch_size -- Number of targets to walk the tree at once
+  softening -- The softening length, see n_body_softening. Cells far enough away to be accepted
+    are softened as point masses too.
+  softening_kernel -- How the softening is done, 'plummer' or 'spline'
+
+  Returns:
+  forces -- Array of forces on the targets, shape (n_targets, n_dimensions)
+  '''
+
+  if targets is None:
+    # Walking in leaf order keeps each batch spatially compact.
+    targets = tree['order']
+    forces = np.zeros(positions.shape)
+    forces[targets] = evaluate_tree_forces(tree, masses, positions, G, theta, targets, batch_size, softening, softening_kernel)
+    return forces
+
+  targets = np.asarray(targets, dtype=int)
+  n_dimensions = positions.shape[1]
+
+  is_leaf = (tree['children'] < 0).all(axis=1)
+
+  forces = np.zeros((targets.size, n_dimensions))
+
+  for batch_start in range(0, targets.size, batch_size):
+    batch = targets[batch_start:batch_start + batch_size]
+
+    # The interaction list, as positions in the batch and node numbers
+    walkers = np.arange(batch.size)
+    nodes = np.zeros(batch.size, dtype=int)
+
+    batch_forces = np.zeros((batch.size, n_dimensions))
+
+    while walkers.size > 0:
+
+      target_positions = positions[batch[walkers]]
+      displacements = tree['centers_of_mass'][nodes] - target_positions
+      distances_squared = (displacements**2.).sum(axis=1)
+
+      # A cell containing the target always has to be opened.
+      inside = (np.abs(target_positions - tree['centers'][nodes]) <= tree['half_widths'][nodes, np.newaxis]).all(axis=1)
+      widths = 2.*tree['half_widths'][nodes]
+      accept = ~inside & (widths**2. < theta**2.*distances_squared) & (tree['masses'][nodes] > 0.)
+
+      # Far away cells act as point masses.
+      factors = G*masses[batch[walkers[accept]]]*tree['masses'][nodes[accept]] \
+                *n_body_softening.calculate_inverse_cubes(distances_squared[accept], softening, softening_kernel)
+      _accumulate(batch_forces, walkers[accept], displacements[accept]*factors[:, np.newaxis])
+
+      # Nearby leaves are summed particle by particle.
+      direct = ~accept & is_leaf[nodes]
+      _accumulate_leaf_forces(batch_forces, tree, masses, positions, G, batch, walkers[direct], nodes[direct],
+                              softening, softening_kernel)
+
+      # Everything else is opened.
+      opened = ~accept & ~is_leaf[nodes]
+      children = tree['children'][nodes[opened]]
+      has_child = children >= 0
+      walkers = np.repeat(walkers[opened], has_child.sum(axis=1))
+      nodes = children[has_child]
+
+    forces[batch_start:batch_start + batch.size] = batch_forces
+
+  return forces
+
+########################################################################
+
+def _accumulate(forces, rows, contributions):
+  '''Add contributions to the given rows of forces, allowing repeated rows.'''
+
+  for d in range(forces.shape[1]):
+    forces[:, d] += np.bincount(rows, contributions[:, d], minlength=forces.shape[0])
+
+########################################################################
+
+def _accumulate_leaf_forces(forces, tree, masses, positions, G, batch, walkers, nodes, softening=0., softening_kernel='plummer'):
+  '''Add the direct forces from every particle in the given leaves.'''
+
+  counts = tree['leaf_counts'][nodes]
+  total = counts.sum()
+  if total == 0:
+    return
+
+  # Expand each (walker, leaf) into one (walker, particle) pair per particle in the leaf.
+  pair_walkers = np.repeat(walkers, counts)
+  offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+  sources = tree['order'][np.repeat(tree['leaf_starts'][nodes], counts) + offsets]
+  targets = batch[pair_walkers]
+
+  # A particle doesn't pull on itself.
+  keep = sources != targets
+  pair_walkers = pair_walkers[keep]
+  sources = sources[keep]
+  targets = targets[keep]
+
+  displacements = positions[sources] - positions[targets]
+  distances_squared = (displacements**2.).sum(axis=1)
+
+  factors = G*masses[targets]*masses[sources]*n_body_softening.calculate_inverse_cubes(distances_squared, softening, softening_kernel)
+  _accumulate(forces, pair_walkers, displacements*factors[:, np.newaxis])
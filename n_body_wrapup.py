@@ -1,8 +1,45 @@
 '''Functions that wrap up the information in the simulation.
 '''
 
+import numpy as np
+
+import n_body_diagnostics
+
+########################################################################
+
 def check_if_finished(particles, parameters):
-  '''Check if the simulation is finished.
+  '''Check if the simulation is finished, and set parameters['finished'] if it is.
+
+  The simulation stops at the first of these that are given:
+  'max_steps' -- After this many steps
+  't_end' -- Once the time reaches t_end
+  'max_energy_drift' -- Once the energy has drifted by more than this fraction of the initial
+    energy, see n_body_diagnostics. Only checked when the diagnostics are measured.
+  parameters['finish_reason'] says which it was.
+
+  Args:
+  particles -- The particle information
+  parameters -- The simulation parameter information
   '''
 
-  pass
+  diagnostics = n_body_diagnostics.update_diagnostics(particles, parameters)
+
+  step = parameters.get('step', 0)
+  time = parameters.get('time', 0.)
+
+  max_steps = parameters.get('max_steps')
+  t_end = parameters.get('t_end')
+  max_energy_drift = parameters.get('max_energy_drift')
+
+  if max_steps is not None and step >= max_steps:
+    finish_reason = 'max_steps'
+  # Allow for rounding in the sum of the timesteps.
+  elif t_end is not None and (time >= t_end or np.isclose(time, t_end, rtol=1e-12, atol=0.)):
+    finish_reason = 't_end'
+  elif max_energy_drift and diagnostics is not None and abs(diagnostics['energy_drift']) > max_energy_drift:
+    finish_reason = 'energy_drift'
+  else:
+    return
+
+  parameters['finished'] = True
+  parameters['finish_reason'] = finish_reason
@@ -0,0 +1,50 @@
+'''Testing for n_body.py
+'''
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import unittest
+from unittest import mock
+
+import n_body
+import n_body_data_handling
+import n_body_setup
+
+########################################################################
+
+class TestRun(unittest.TestCase):
+  '''Testing for n_body.run()'''
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+
+    rng = np.random.default_rng(1)
+
+    self.particles = {
+      'masses' : rng.uniform(1., 2., 5),
+      'positions' : rng.normal(0., 1., (5, 3)),
+      'velocities' : rng.normal(0., 0.1, (5, 3)),
+    }
+    self.parameters = {'G' : 1., 'dt' : 1.e-3, 'max_steps' : 3, 'finished' : False,
+                       'output_dir' : os.path.join(self.directory, 'output')}
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def test_saves_initial_conditions(self):
+
+    initial_positions = self.particles['positions'].copy()
+
+    with mock.patch.object(n_body_setup, 'load_settings', return_value=(self.particles, self.parameters)):
+      n_body.run()
+
+    trajectory = n_body_data_handling.load_trajectory(self.parameters['output_dir'])
+
+    npt.assert_array_equal([0, 1, 2, 3], trajectory.steps)
+    npt.assert_array_equal(initial_positions, trajectory[0])
+    npt.assert_array_equal(self.particles['positions'], trajectory[-1])
@@ -0,0 +1,117 @@
+'''Testing for benchmarks/force_backends.py
+'''
+
+import unittest
+
+import n_body_integrators
+from benchmarks import force_backends
+
+########################################################################
+
+def make_result(force_seconds, force_spread_seconds=0., peak_memory_bytes=1000, backend='tree', integrators=('leapfrog',)):
+
+  return {
+    'backend' : backend,
+    'n_particles' : 1000,
+    'n_dimensions' : 3,
+    'force_seconds' : force_seconds,
+    'force_spread_seconds' : force_spread_seconds,
+    'peak_memory_bytes' : peak_memory_bytes,
+    'integrators' : dict((integrator, {'step_seconds' : force_seconds, 'step_spread_seconds' : force_spread_seconds})
+                         for integrator in integrators),
+  }
+
+########################################################################
+
+class TestFindRegressions(unittest.TestCase):
+  '''Testing for force_backends.find_regressions()'''
+
+  def test_slowdown(self):
+
+    regressions = force_backends.find_regressions([make_result(0.2)], [make_result(0.1)], 0.2)
+
+    self.assertEqual(2, len(regressions))
+    self.assertIn('tree N=1000 D=3: force_seconds', regressions[0])
+
+  def test_within_threshold(self):
+
+    self.assertEqual([], force_backends.find_regressions([make_result(0.11)], [make_result(0.1)], 0.2))
+
+  def test_within_spread(self):
+
+    # 50% slower, but the repeats of both runs varied by more than that.
+    self.assertEqual([], force_backends.find_regressions([make_result(0.15, 0.02)], [make_result(0.1, 0.02)], 0.2))
+
+  def test_short_timings_ignored(self):
+
+    fast = force_backends.MIN_COMPARABLE_SECONDS/2.
+    self.assertEqual([], force_backends.find_regressions([make_result(fast)], [make_result(fast/2.)], 0.2))
+
+  def test_memory(self):
+
+    regressions = force_backends.find_regressions([make_result(0.1, peak_memory_bytes=2000)], [make_result(0.1)], 0.2)
+
+    self.assertEqual(1, len(regressions))
+    self.assertIn('peak_memory_bytes', regressions[0])
+
+  def test_missing_from_baseline(self):
+
+    self.assertEqual([], force_backends.find_regressions([make_result(1.)], [make_result(0.1, backend='fmm')], 0.2))
+
+  def test_baseline_without_spreads(self):
+
+    baseline = make_result(0.1)
+    del baseline['force_spread_seconds'], baseline['integrators']['leapfrog']['step_spread_seconds']
+
+    self.assertEqual(2, len(force_backends.find_regressions([make_result(0.2)], [baseline], 0.2)))
+
+  def test_baseline_with_leapfrog_steps_only(self):
+
+    # Older results files timed a leapfrog step, without the integrators.
+    baseline = make_result(0.1)
+    baseline.update(baseline.pop('integrators')['leapfrog'])
+
+    regressions = force_backends.find_regressions([make_result(0.2, integrators=('leapfrog', 'hermite'))], [baseline], 0.2)
+
+    self.assertEqual(2, len(regressions))
+    self.assertIn('leapfrog step_seconds', regressions[1])
+
+  def test_each_integrator(self):
+
+    regressions = force_backends.find_regressions([make_result(0.2, integrators=('leapfrog', 'yoshida6'))],
+                                                  [make_result(0.1, integrators=('yoshida6',))], 0.2)
+
+    self.assertEqual(2, len(regressions))
+    self.assertIn('yoshida6 step_seconds', regressions[1])
+
+  def test_unmeasured_memory(self):
+
+    self.assertEqual([], force_backends.find_regressions([make_result(0.1, peak_memory_bytes=None)], [make_result(0.1)], 0.2))
+
+########################################################################
+
+class TestMeasure(unittest.TestCase):
+  '''Testing for force_backends.measure()'''
+
+  def test_integrators(self):
+
+    result = force_backends.measure('direct_numpy', 20, 3, ['leapfrog', 'hermite'])
+
+    self.assertEqual(['hermite', 'leapfrog'], sorted(result['integrators']))
+    self.assertEqual(20*19/2./result['force_seconds'], result['pair_interactions_per_second'])
+
+    # The Hermite integrators can't use the other backends.
+    result = force_backends.measure('pm', 20, 3, ['leapfrog', 'hermite'])
+
+    self.assertEqual(['leapfrog'], list(result['integrators']))
+
+  def test_untraced_memory(self):
+
+    self.assertIsNone(force_backends.measure('parallel', 20, 3, ['leapfrog'])['peak_memory_bytes'])
+
+  def test_default_integrators(self):
+
+    integrators = force_backends.default_integrators()
+
+    self.assertIn('leapfrog', integrators)
+    self.assertEqual(len(set(n_body_integrators.INTEGRATORS.values())), len(integrators))
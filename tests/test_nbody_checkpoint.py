@@ -0,0 +1,173 @@
+'''Testing for n_body_checkpoint.py
+'''
+
+import copy
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_checkpoint
+import n_body_data_handling
+import n_body_particles
+import n_body_physics
+
+########################################################################
+
+class TestCheckpoint(unittest.TestCase):
+  '''Testing for n_body_checkpoint.save_checkpoint() and load_checkpoint()'''
+
+  def setUp(self):
+
+    self.n_particles = 6
+    self.n_dimensions = 3
+
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'checkpoint.nbody')
+
+    self.parameters = {'G': 1.,
+                       'dt' : 1.e-3,
+                       'n_dimensions' : self.n_dimensions,
+                       'checkpoint_file' : self.filename,
+                       'rng' : np.random.default_rng(3),
+                      }
+
+    masses = np.random.uniform(1., 3., self.n_particles)
+    positions = np.random.uniform(0., 3., (self.n_particles, self.n_dimensions))
+    velocities = np.random.uniform(-1., 1., (self.n_particles, self.n_dimensions))
+    self.particles = n_body_particles.ParticleSet(masses, positions, velocities)
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def run_steps(self, particles, parameters, n_steps):
+
+    for step in range(n_steps):
+      n_body_physics.update_system(particles, parameters)
+
+  def test_restart_bit_for_bit(self):
+
+    particles = self.particles.copy()
+    parameters = copy.copy(self.parameters)
+    self.run_steps(particles, parameters, 10)
+
+    self.run_steps(self.particles, self.parameters, 5)
+    n_body_checkpoint.save_checkpoint(self.particles, self.parameters)
+    restarted_particles, restarted_parameters = n_body_checkpoint.load_checkpoint(self.filename)
+    self.run_steps(restarted_particles, restarted_parameters, 5)
+
+    npt.assert_array_equal(particles['positions'], restarted_particles['positions'])
+    npt.assert_array_equal(particles['velocities'], restarted_particles['velocities'])
+    self.assertEqual(parameters['step'], restarted_parameters['step'])
+    self.assertEqual(parameters['time'], restarted_parameters['time'])
+
+  def test_cached_accelerations_restored(self):
+
+    self.run_steps(self.particles, self.parameters, 2)
+    n_body_checkpoint.save_checkpoint(self.particles, self.parameters)
+
+    particles, parameters = n_body_checkpoint.load_checkpoint(self.filename)
+
+    integrator = parameters['integrator_state']
+    assert integrator.is_cache_valid(particles, parameters)
+    npt.assert_array_equal(self.parameters['integrator_state'].accelerations, integrator.accelerations)
+
+  def test_rng_restored(self):
+
+    n_body_checkpoint.save_checkpoint(self.particles, self.parameters)
+    expected = self.parameters['rng'].uniform(size=3)
+    expected_global = np.random.uniform(size=3)
+
+    particles, parameters = n_body_checkpoint.load_checkpoint(self.filename)
+
+    npt.assert_array_equal(expected, parameters['rng'].uniform(size=3))
+    npt.assert_array_equal(expected_global, np.random.uniform(size=3))
+
+  def test_rng_with_array_state(self):
+
+    # MT19937 keeps its state in an array.
+    self.parameters['rng'] = np.random.Generator(np.random.MT19937(3))
+
+    n_body_checkpoint.save_checkpoint(self.particles, self.parameters)
+    expected = self.parameters['rng'].uniform(size=3)
+
+    particles, parameters = n_body_checkpoint.load_checkpoint(self.filename)
+
+    npt.assert_array_equal(expected, parameters['rng'].uniform(size=3))
+
+  def test_plain_dict_particles(self):
+
+    particles = dict((key, np.array(value)) for key, value in self.particles.items())
+
+    n_body_checkpoint.save_checkpoint(particles, self.parameters)
+    loaded, parameters = n_body_checkpoint.load_checkpoint(self.filename)
+
+    assert isinstance(loaded, dict)
+    for key in particles:
+      npt.assert_array_equal(particles[key], loaded[key])
+
+  def test_overwrite_leaves_no_temporary_file(self):
+
+    n_body_checkpoint.save_checkpoint(self.particles, self.parameters)
+    n_body_checkpoint.save_checkpoint(self.particles, self.parameters)
+
+    self.assertEqual(['checkpoint.nbody'], os.listdir(self.directory))
+
+  def test_periodic(self):
+
+    self.parameters['checkpoint_every'] = 3
+
+    for step in range(4):
+      n_body_physics.update_system(self.particles, self.parameters)
+      n_body_checkpoint.maybe_save_checkpoint(self.particles, self.parameters)
+
+    particles, parameters = n_body_checkpoint.load_checkpoint(self.filename)
+
+    self.assertEqual(3, parameters['step'])
+
+  def test_output_resumes(self):
+
+    output_dir = os.path.join(self.directory, 'output')
+    self.parameters['output_dir'] = output_dir
+    self.parameters['output_chunk_size'] = 4
+
+    for step in range(6):
+      n_body_physics.update_system(self.particles, self.parameters)
+      n_body_data_handling.save_data(self.particles, self.parameters)
+      if step == 2:
+        n_body_checkpoint.save_checkpoint(self.particles, self.parameters)
+    n_body_data_handling.close_data(self.parameters)
+
+    particles, parameters = n_body_checkpoint.load_checkpoint(self.filename)
+    for step in range(3):
+      n_body_physics.update_system(particles, parameters)
+      n_body_data_handling.save_data(particles, parameters)
+    n_body_data_handling.close_data(parameters)
+
+    trajectory = n_body_data_handling.load_trajectory(output_dir)
+
+    npt.assert_array_equal(np.arange(1, 7), trajectory.steps)
+    npt.assert_array_equal(self.particles['positions'], trajectory[-1])
+
+  def test_output_survives_killed_run(self):
+
+    output_dir = os.path.join(self.directory, 'output')
+    self.parameters['output_dir'] = output_dir
+    self.parameters['checkpoint_every'] = 10
+
+    # Killed after step 35, without closing the output
+    for step in range(35):
+      n_body_physics.update_system(self.particles, self.parameters)
+      n_body_data_handling.save_data(self.particles, self.parameters)
+      n_body_checkpoint.maybe_save_checkpoint(self.particles, self.parameters)
+
+    particles, parameters = n_body_checkpoint.load_checkpoint(self.filename)
+    for step in range(10):
+      n_body_physics.update_system(particles, parameters)
+      n_body_data_handling.save_data(particles, parameters)
+    n_body_data_handling.close_data(parameters)
+
+    npt.assert_array_equal(np.arange(1, 41), n_body_data_handling.load_trajectory(output_dir).steps)
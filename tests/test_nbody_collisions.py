@@ -0,0 +1,144 @@
+'''Testing for n_body_collisions.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_collisions
+import n_body_particles
+import n_body_physics
+import n_body_setup
+
+########################################################################
+
+class TestFindCollisions(unittest.TestCase):
+  '''Testing for n_body_collisions.find_collisions() and find_groups()'''
+
+  def test_matches_every_pair(self):
+
+    rng = np.random.default_rng(12)
+    positions = rng.uniform(0., 10., (400, 3))
+    radii = rng.uniform(0., 0.5, 400)
+
+    for box_size in [None, 10.]:
+      displacements = positions[np.newaxis, :, :] - positions[:, np.newaxis, :]
+      if box_size is not None:
+        displacements -= box_size*np.round(displacements/box_size)
+      touching = (displacements**2.).sum(axis=2) < (radii[:, np.newaxis] + radii[np.newaxis, :])**2.
+      i, j = np.nonzero(np.triu(touching, 1))
+
+      pairs = n_body_collisions.find_collisions(positions, radii, box_size)
+
+      npt.assert_array_equal(np.array([i, j]).T, pairs[np.lexsort(pairs.T[::-1])])
+
+  def test_no_radii(self):
+
+    self.assertEqual((0, 2), n_body_collisions.find_collisions(np.zeros((3, 2)), np.zeros(3)).shape)
+
+  def test_groups(self):
+
+    # A chain 5-1-3, a pair 2-6, and 0 and 4 on their own
+    groups = n_body_collisions.find_groups(7, np.array([[3, 5], [1, 3], [2, 6]]))
+
+    npt.assert_array_equal([0, 1, 2, 1, 4, 1, 2], groups)
+
+########################################################################
+
+class TestMergeCollisions(unittest.TestCase):
+  '''Testing for n_body_collisions.merge_collisions()'''
+
+  def setUp(self):
+
+    # Bodies 1, 2 and 3 touch in a chain, 0 and 4 are far away.
+    self.particles = {
+      'masses' : np.array([1., 2., 3., 4., 5.]),
+      'positions' : np.array([[-10., 0.], [0., 0.], [0.9, 0.], [1.8, 0.], [10., 0.]]),
+      'velocities' : np.array([[0., 1.], [1., 0.], [-1., 0.], [0., 2.], [0., -1.]]),
+      'radii' : np.array([0.5, 0.5, 0.5, 0.5, 0.5]),
+    }
+    self.parameters = {'G' : 1., 'collisions' : True}
+
+  def check_merged(self, particles):
+
+    npt.assert_allclose([1., 9., 5.], particles['masses'])
+    npt.assert_allclose([[-10., 0.], [(2.*0. + 3.*0.9 + 4.*1.8)/9., 0.], [10., 0.]], particles['positions'])
+    npt.assert_allclose([[0., 1.], [(2. - 3.)/9., 8./9.], [0., -1.]], particles['velocities'])
+    npt.assert_allclose([0.5, np.sqrt(3.)*0.5, 0.5], particles['radii'])
+
+  def test_conserves_mass_and_momentum(self):
+
+    momentum = (self.particles['masses'][:, np.newaxis]*self.particles['velocities']).sum(axis=0)
+
+    self.assertEqual(2, n_body_collisions.merge_collisions(self.particles, self.parameters))
+    self.assertEqual(2, self.parameters['n_merged'])
+
+    self.check_merged(self.particles)
+    npt.assert_allclose(momentum, (self.particles['masses'][:, np.newaxis]*self.particles['velocities']).sum(axis=0))
+
+  def test_in_place(self):
+
+    positions = self.particles['positions']
+
+    n_body_collisions.merge_collisions(self.particles, self.parameters)
+
+    self.assertTrue(np.shares_memory(positions, self.particles['positions']))
+
+  def test_particle_set(self):
+
+    particles = n_body_particles.ParticleSet.from_dict(self.particles)
+    capacity = particles.capacity
+
+    n_body_collisions.merge_collisions(particles, self.parameters)
+
+    self.check_merged(particles)
+    self.assertEqual(capacity, particles.capacity)
+
+  def test_periodic(self):
+
+    # Touching across the edge of the box
+    particles = {'masses' : np.ones(2), 'positions' : np.array([[0.1, 5.], [9.9, 5.]]), 'velocities' : np.zeros((2, 2)),
+                 'radii' : np.full(2, 0.2)}
+
+    n_body_collisions.merge_collisions(particles, dict(self.parameters, box_size=10.))
+
+    npt.assert_allclose([[0., 5.]], particles['positions'] % 10., atol=1.e-12)
+
+  def test_off_without_collisions(self):
+
+    self.assertEqual(0, n_body_collisions.merge_collisions(self.particles, {'G' : 1.}))
+    self.assertEqual(5, len(self.particles['masses']))
+
+    with self.assertRaises(ValueError):
+      n_body_collisions.merge_collisions({'masses' : np.ones(2), 'positions' : np.zeros((2, 2))}, self.parameters)
+
+########################################################################
+
+class TestCollisionsInSimulation(unittest.TestCase):
+  '''Testing collisions in n_body_physics.update_system()'''
+
+  def test_cluster_collapses(self):
+
+    particles = n_body_setup.sample_plummer_sphere(200, np.random.default_rng(13))
+    particles['radii'] = np.full(200, 0.05)
+    parameters = {'G' : 1., 'dt' : 0.01, 'collisions' : True}
+
+    total_mass = particles['masses'].sum()
+    momentum = (particles['masses'][:, np.newaxis]*particles['velocities']).sum(axis=0)
+
+    for i in range(20):
+      n_body_physics.update_system(particles, parameters)
+
+    self.assertGreater(parameters['n_merged'], 0)
+    self.assertEqual(200 - parameters['n_merged'], len(particles['masses']))
+    self.assertEqual(len(particles['masses']), len(particles['velocities']))
+
+    self.assertAlmostEqual(total_mass, particles['masses'].sum())
+    npt.assert_allclose(momentum, (particles['masses'][:, np.newaxis]*particles['velocities']).sum(axis=0), atol=1.e-12)
+
+  def test_radii_from_config(self):
+
+    particles, parameters = n_body_setup.parse_config({'masses' : [1., 2.], 'positions' : [[0., 0.], [1., 0.]], 'radii' : 0.1})
+
+    npt.assert_array_equal([0.1, 0.1], particles['radii'])
+    self.assertNotIn('radii', parameters)
@@ -0,0 +1,264 @@
+'''Testing for n_body_data_handling.py
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_data_handling
+import n_body_profiling
+
+########################################################################
+
+class TestSaveData(unittest.TestCase):
+  '''Testing for n_body_data_handling.save_data()'''
+
+  def setUp(self):
+
+    self.n_particles = 4
+    self.n_dimensions = 2
+
+    self.output_dir = tempfile.mkdtemp()
+
+    self.parameters = {'output_dir' : self.output_dir,
+                       'output_chunk_size' : 3,
+                      }
+
+    self.particles = {}
+    self.particles['masses'] = np.random.uniform(1., 3., self.n_particles)
+    self.particles['positions'] = np.random.uniform(0., 3., (self.n_particles, self.n_dimensions))
+    self.particles['velocities'] = np.random.uniform(-3., 3., (self.n_particles, self.n_dimensions))
+
+    # What function to run
+    self.fn = n_body_data_handling.save_data
+
+  def tearDown(self):
+
+    shutil.rmtree(self.output_dir)
+
+  def run_steps(self, n_steps):
+
+    snapshots = []
+    for step in range(n_steps):
+      self.particles['positions'] += 1.
+      snapshots.append(self.particles['positions'].copy())
+      self.fn(self.particles, self.parameters)
+
+    return np.array(snapshots)
+
+  def load(self, field):
+
+    with open(os.path.join(self.output_dir, 'index.json')) as f:
+      index = json.load(f)
+
+    return np.concatenate([np.load(os.path.join(self.output_dir, '{}_{:06d}.npy'.format(field, i))) for i in range(len(index['chunks']))])
+
+  def test_buffers_until_chunk_full(self):
+
+    self.run_steps(2)
+
+    assert not os.path.exists(os.path.join(self.output_dir, 'positions_000000.npy'))
+
+    self.run_steps(1)
+
+    assert os.path.exists(os.path.join(self.output_dir, 'positions_000000.npy'))
+
+  def test_saved_snapshots_match(self):
+
+    expected = self.run_steps(7)
+    n_body_data_handling.close_data(self.parameters)
+
+    npt.assert_array_equal(expected, self.load('positions'))
+    npt.assert_array_equal(np.arange(7), self.load('steps'))
+
+  def test_flush(self):
+
+    expected = self.run_steps(2)
+    n_body_data_handling.flush_data(self.parameters)
+
+    npt.assert_array_equal(expected, self.load('positions'))
+
+    expected = np.concatenate([expected, self.run_steps(4)])
+    n_body_data_handling.close_data(self.parameters)
+
+    npt.assert_array_equal(expected, self.load('positions'))
+    npt.assert_array_equal(np.arange(6), self.load('steps'))
+
+  def test_counts_bytes_once_written(self):
+
+    profiler = n_body_profiling.Profiler(report_every=0)
+    self.parameters['profiler_state'] = profiler
+
+    self.run_steps(2)
+    self.assertEqual(0, profiler.counters.get('bytes_written', 0))
+
+    self.run_steps(1)
+    n_body_data_handling.flush_data(self.parameters)
+
+    snapshot_bytes = 2*self.n_particles*self.n_dimensions*8 + 16
+    self.assertEqual(3*snapshot_bytes, profiler.counters['bytes_written'])
+
+  def test_cadence(self):
+
+    self.parameters['output_every'] = 3
+
+    expected = self.run_steps(7)
+    n_body_data_handling.close_data(self.parameters)
+
+    npt.assert_array_equal(expected[::3], self.load('positions'))
+    npt.assert_array_equal([0, 3, 6], self.load('steps'))
+
+  def test_float32(self):
+
+    self.parameters['output_float32'] = True
+
+    expected = self.run_steps(3)
+
+    actual = self.load('velocities')
+
+    self.assertEqual(np.float32, actual.dtype)
+    npt.assert_allclose(expected, self.load('positions'), rtol=1.e-6)
+
+  def test_new_chunk_when_particles_change(self):
+
+    self.run_steps(2)
+
+    for key in ['masses', 'positions', 'velocities']:
+      self.particles[key] = self.particles[key][:-1]
+
+    self.run_steps(1)
+    n_body_data_handling.close_data(self.parameters)
+
+    with open(os.path.join(self.output_dir, 'index.json')) as f:
+      index = json.load(f)
+
+    self.assertEqual([self.n_particles, self.n_particles - 1], [chunk['n_particles'] for chunk in index['chunks']])
+
+########################################################################
+
+class TestAsyncSaveData(TestSaveData):
+  '''Testing for n_body_data_handling.save_data() with a background writer'''
+
+  def setUp(self):
+
+    TestSaveData.setUp(self)
+
+    self.parameters['output_async'] = True
+
+  def tearDown(self):
+
+    n_body_data_handling.close_data(self.parameters)
+
+    TestSaveData.tearDown(self)
+
+  def test_buffers_until_chunk_full(self):
+
+    self.run_steps(2)
+
+    assert not os.path.exists(os.path.join(self.output_dir, 'positions_000000.npy'))
+
+  def test_many_chunks(self):
+
+    expected = self.run_steps(50)
+    n_body_data_handling.close_data(self.parameters)
+
+    npt.assert_array_equal(expected, self.load('positions'))
+
+  def test_writer_error_raised(self):
+
+    self.run_steps(2)
+    shutil.rmtree(self.output_dir)
+
+    with self.assertRaises(IOError):
+      self.run_steps(4)
+      n_body_data_handling.close_data(self.parameters)
+
+    os.makedirs(self.output_dir)
+    del self.parameters['writer_state']
+
+  def test_float32(self):
+
+    self.parameters['output_float32'] = True
+
+    expected = self.run_steps(3)
+    n_body_data_handling.close_data(self.parameters)
+
+    actual = self.load('velocities')
+
+    self.assertEqual(np.float32, actual.dtype)
+    npt.assert_allclose(expected, self.load('positions'), rtol=1.e-6)
+
+########################################################################
+
+class TestTrajectory(unittest.TestCase):
+  '''Testing for n_body_data_handling.Trajectory'''
+
+  def setUp(self):
+
+    self.n_particles = 5
+    self.n_dimensions = 3
+    self.n_steps = 10
+
+    self.output_dir = tempfile.mkdtemp()
+
+    parameters = {'output_dir' : self.output_dir,
+                  'output_chunk_size' : 4,
+                 }
+
+    particles = {}
+    particles['masses'] = np.ones(self.n_particles)
+    particles['velocities'] = np.zeros((self.n_particles, self.n_dimensions))
+
+    self.expected = np.random.uniform(0., 3., (self.n_steps, self.n_particles, self.n_dimensions))
+    for step in range(self.n_steps):
+      particles['positions'] = self.expected[step]
+      n_body_data_handling.save_data(particles, parameters)
+    n_body_data_handling.close_data(parameters)
+
+    self.trajectory = n_body_data_handling.load_trajectory(self.output_dir)
+
+  def tearDown(self):
+
+    shutil.rmtree(self.output_dir)
+
+  def test_shape(self):
+
+    self.assertEqual(self.expected.shape, self.trajectory.shape)
+    self.assertEqual(self.n_steps, len(self.trajectory))
+    npt.assert_array_equal(np.arange(self.n_steps), self.trajectory.steps)
+
+  def test_slicing(self):
+
+    keys = [
+      3,
+      -1,
+      (slice(2, 9), [0, 3]),
+      (slice(1, 3), slice(None), 0),
+      (slice(None, None, 3), 2),
+      (slice(None, None, -1),),
+      ([7, 1, 1, 5],),
+      (slice(5, 5),),
+    ]
+
+    for key in keys:
+      npt.assert_array_equal(self.expected[key], self.trajectory[key])
+
+    # Lists of snapshots and of particles select every combination.
+    npt.assert_array_equal(self.expected[[7, 1, 5]][:, [4, 0]], self.trajectory[[7, 1, 5], [4, 0]])
+
+  def test_zero_copy_inside_block(self):
+
+    actual = self.trajectory[4:7, 1:3]
+
+    assert isinstance(actual, np.memmap)
+
+  def test_iter_chunks(self):
+
+    for n_snapshots in [None, 3]:
+      pieces = [data for steps, data in self.trajectory.iter_chunks(n_snapshots, particles=[2])]
+
+      npt.assert_array_equal(self.expected[:, [2]], np.concatenate(pieces))
@@ -0,0 +1,144 @@
+'''Testing for n_body_diagnostics.py and n_body_wrapup.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_diagnostics
+import n_body_physics
+import n_body_wrapup
+
+########################################################################
+
+class TestPotentialsInForcePass(unittest.TestCase):
+  '''Testing the potentials worked out alongside the direct forces'''
+
+  def setUp(self):
+
+    rng = np.random.default_rng(11)
+
+    self.particles = {}
+    self.particles['masses'] = rng.uniform(1., 2., 50)
+    self.particles['positions'] = rng.normal(0., 1., (50, 3))
+    self.particles['velocities'] = rng.normal(0., 0.5, (50, 3))
+
+  def test_every_direct_path(self):
+
+    for softening_parameters in [{}, {'softening' : 0.3}, {'softening' : 0.3, 'softening_kernel' : 'spline'}]:
+
+      parameters = dict({'G' : 2.}, **softening_parameters)
+      expected = n_body_physics.calculate_potential_energy(self.particles, parameters)
+
+      for candidate in [dict(parameters, use_numba=False), dict(parameters, use_numba=False, tile_size=7), parameters]:
+        potentials = np.zeros(50)
+        n_body_physics.calculate_direct_forces(self.particles, candidate, potentials)
+
+        self.assertAlmostEqual(expected, 0.5*np.dot(self.particles['masses'], potentials), places=10)
+
+  def test_reused_by_diagnostics(self):
+
+    parameters = {'G' : 1., 'dt' : 1.e-3, 'diagnostics_every' : 5}
+
+    for i in range(5):
+      n_body_physics.update_system(self.particles, parameters)
+
+    # The last force evaluation was at the final positions, so its potential energy is used.
+    self.assertTrue(np.array_equal(parameters['potential_state']['positions'], self.particles['positions']))
+
+    diagnostics = n_body_diagnostics.update_diagnostics(self.particles, parameters)
+
+    self.assertAlmostEqual(n_body_physics.calculate_total_energy(self.particles, parameters), diagnostics['energy'], places=10)
+
+    # After moving, the potential energy is recalculated.
+    self.particles['positions'] += 0.1
+    self.assertAlmostEqual(n_body_physics.calculate_potential_energy(self.particles, parameters),
+                           n_body_diagnostics.get_potential_energy(self.particles, parameters), places=10)
+
+########################################################################
+
+class TestMomenta(unittest.TestCase):
+  '''Testing for n_body_diagnostics.calculate_momentum() and calculate_angular_momentum()'''
+
+  def test_three_dimensions(self):
+
+    rng = np.random.default_rng(12)
+    particles = {'masses' : rng.uniform(1., 2., 20), 'positions' : rng.normal(0., 1., (20, 3)), 'velocities' : rng.normal(0., 1., (20, 3))}
+
+    npt.assert_allclose((particles['masses'][:, np.newaxis]*particles['velocities']).sum(axis=0),
+                        n_body_diagnostics.calculate_momentum(particles))
+    npt.assert_allclose((particles['masses'][:, np.newaxis]*np.cross(particles['positions'], particles['velocities'])).sum(axis=0),
+                        n_body_diagnostics.calculate_angular_momentum(particles))
+
+  def test_two_dimensions(self):
+
+    particles = {'masses' : np.array([1., 2.]), 'positions' : np.array([[1., 0.], [0., 2.]]), 'velocities' : np.array([[0., 3.], [1., 0.]])}
+
+    npt.assert_allclose([3. - 4.], n_body_diagnostics.calculate_angular_momentum(particles))
+
+  def test_drift(self):
+
+    particles = {'masses' : np.ones(2), 'positions' : np.array([[-1., 0.], [1., 0.]]), 'velocities' : np.array([[0., -0.5], [0., 0.5]])}
+    parameters = {'G' : 1., 'diagnostics_every' : 1}
+
+    self.assertEqual(0., n_body_diagnostics.update_diagnostics(particles, parameters)['energy_drift'])
+
+    particles['velocities'][0, 0] = 1.
+    diagnostics = n_body_diagnostics.update_diagnostics(particles, parameters)
+
+    self.assertAlmostEqual(0.5/0.25, diagnostics['energy_drift'])
+    self.assertAlmostEqual(1., diagnostics['momentum_drift'])
+
+########################################################################
+
+class TestCheckIfFinished(unittest.TestCase):
+  '''Testing for n_body_wrapup.check_if_finished()'''
+
+  def setUp(self):
+
+    self.particles = {'masses' : np.ones(2), 'positions' : np.array([[-1., 0.], [1., 0.]]), 'velocities' : np.array([[0., -0.5], [0., 0.5]])}
+
+  def run_until_finished(self, parameters, max_iterations=1000):
+
+    parameters.update({'G' : 1., 'finished' : False})
+
+    n_body_wrapup.check_if_finished(self.particles, parameters)
+    for i in range(max_iterations):
+      if parameters['finished']:
+        break
+      n_body_physics.update_system(self.particles, parameters)
+      n_body_wrapup.check_if_finished(self.particles, parameters)
+
+    return parameters
+
+  def test_max_steps(self):
+
+    parameters = self.run_until_finished({'dt' : 0.01, 'max_steps' : 17})
+
+    self.assertEqual(17, parameters['step'])
+    self.assertEqual('max_steps', parameters['finish_reason'])
+
+  def test_t_end(self):
+
+    parameters = self.run_until_finished({'dt' : 0.1, 't_end' : 3.})
+
+    self.assertEqual(30, parameters['step'])
+    self.assertEqual('t_end', parameters['finish_reason'])
+
+  def test_energy_drift(self):
+
+    # A timestep far too long for the orbit
+    parameters = self.run_until_finished({'dt' : 1., 'max_energy_drift' : 0.01, 'diagnostics_every' : 2})
+
+    self.assertEqual('energy_drift', parameters['finish_reason'])
+    self.assertGreater(abs(parameters['diagnostics']['energy_drift']), 0.01)
+    self.assertEqual(0, parameters['step'] % 2)
+
+  def test_not_finished(self):
+
+    parameters = {'G' : 1., 'finished' : False, 'max_energy_drift' : 0.01}
+
+    n_body_wrapup.check_if_finished(self.particles, parameters)
+
+    self.assertFalse(parameters['finished'])
+    self.assertIn('initial_diagnostics', parameters)
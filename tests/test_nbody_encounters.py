@@ -0,0 +1,180 @@
+'''Testing for n_body_encounters.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_encounters
+import n_body_physics
+
+########################################################################
+
+class TestSolveKepler(unittest.TestCase):
+  '''Testing for n_body_encounters.solve_kepler()'''
+
+  def test_circular_orbit(self):
+
+    positions, velocities = n_body_encounters.solve_kepler([[2., 0.]], [[0., np.sqrt(0.5)]], [1.], 0.7)
+
+    angle = 0.7*np.sqrt(0.5)/2.
+
+    npt.assert_allclose([[2.*np.cos(angle), 2.*np.sin(angle)]], positions, rtol=1e-12)
+    npt.assert_allclose([[-np.sqrt(0.5)*np.sin(angle), np.sqrt(0.5)*np.cos(angle)]], velocities, rtol=1e-12)
+
+  def test_eccentric_orbits(self):
+
+    rng = np.random.default_rng(2)
+
+    positions = rng.normal(0., 1., (50, 3))
+    velocities = rng.normal(0., 0.3, (50, 3))
+    mu = rng.uniform(1., 2., 50)
+
+    new_positions, new_velocities = n_body_encounters.solve_kepler(positions, velocities, mu, 13.7)
+
+    def energies(x, v):
+      return 0.5*(v**2.).sum(axis=1) - mu/np.linalg.norm(x, axis=1)
+
+    npt.assert_allclose(energies(positions, velocities), energies(new_positions, new_velocities), rtol=1e-10)
+    npt.assert_allclose(np.cross(positions, velocities), np.cross(new_positions, new_velocities), rtol=1e-9, atol=1e-12)
+
+    # Going back again
+    old_positions, old_velocities = n_body_encounters.solve_kepler(new_positions, new_velocities, mu, -13.7)
+
+    npt.assert_allclose(positions, old_positions, rtol=1e-8, atol=1e-10)
+    npt.assert_allclose(velocities, old_velocities, rtol=1e-8, atol=1e-10)
+
+  def test_unbound_orbits(self):
+
+    # Hyperbolic, nearly parabolic and bound orbits together
+    positions = np.array([[1., 0.], [1., 0.], [0.5, 0.3], [1., 0.]])
+    velocities = np.array([[0., 2.], [-0.3, np.sqrt(2.) - 1e-9], [1., 1.5], [0., 0.9]])
+    mu = np.ones(4)
+
+    new_positions, new_velocities = n_body_encounters.solve_kepler(positions, velocities, mu, 3.1)
+
+    def energies(x, v):
+      return 0.5*(v**2.).sum(axis=1) - mu/np.linalg.norm(x, axis=1)
+
+    npt.assert_allclose(energies(positions, velocities), energies(new_positions, new_velocities), rtol=1e-10, atol=1e-12)
+    def angular_momenta(x, v):
+      return x[:, 0]*v[:, 1] - x[:, 1]*v[:, 0]
+
+    npt.assert_allclose(angular_momenta(positions, velocities), angular_momenta(new_positions, new_velocities), rtol=1e-10)
+
+    # The first orbit, compared with a finely stepped leapfrog
+    x, v = positions[0].copy(), velocities[0].copy()
+    dt = 3.1/20000
+    for step in range(20000):
+      v -= 0.5*dt*x/np.linalg.norm(x)**3.
+      x += dt*v
+      v -= 0.5*dt*x/np.linalg.norm(x)**3.
+
+    npt.assert_allclose(x, new_positions[0], rtol=1e-6)
+    npt.assert_allclose(v, new_velocities[0], rtol=1e-6)
+
+  def test_pericentres(self):
+
+    # Starting at apocentre and at pericentre of an orbit with a = 1, e = 0.5
+    pericentres = n_body_encounters.calculate_pericentres(np.array([[1.5, 0.], [0., 0.5]]),
+                                                          np.array([[0., np.sqrt(1./3.)], [-np.sqrt(3.), 0.]]),
+                                                          np.ones(2))
+
+    npt.assert_allclose([0.5, 0.5], pericentres)
+
+########################################################################
+
+class TestEncounters(unittest.TestCase):
+  '''Testing for close encounters in the leapfrog integrator'''
+
+  def setUp(self):
+
+    # A tight binary orbiting a heavier body, with a period much shorter than dt
+    separation = 0.01
+    binary_speed = np.sqrt(1./separation)
+
+    self.particles = {
+      'masses' : np.array([0.5, 0.5, 2.]),
+      'positions' : np.array([[1. - 0.5*separation, 0.], [1. + 0.5*separation, 0.], [0., 0.]]),
+      'velocities' : np.array([[0., np.sqrt(3.) - 0.5*binary_speed], [0., np.sqrt(3.) + 0.5*binary_speed], [0., 0.]]),
+    }
+    self.particles['velocities'][2] = -0.5*(self.particles['velocities'][0] + self.particles['velocities'][1])
+
+    self.parameters = {'G' : 1., 'dt' : 0.01, 'encounter_factor' : 10.}
+
+  def test_finds_binary(self):
+
+    pairs = n_body_encounters.find_encounter_pairs(self.particles, self.parameters, 0.01)
+
+    npt.assert_array_equal([[0, 1]], pairs)
+
+  def test_ignores_unbound_and_wide_pairs(self):
+
+    self.particles['velocities'][1, 1] += 100.
+    self.assertEqual(0, len(n_body_encounters.find_encounter_pairs(self.particles, self.parameters, 0.01)))
+
+    self.assertEqual(0, len(n_body_encounters.find_encounter_pairs(self.particles, {'G' : 1.}, 0.01)))
+
+  def test_ignores_softened_pairs(self):
+
+    self.assertEqual(0, len(n_body_encounters.find_encounter_pairs(self.particles, dict(self.parameters, softening=1e-4), 0.01)))
+
+    parameters = dict(self.parameters, softening_kernel='spline')
+    npt.assert_array_equal([[0, 1]], n_body_encounters.find_encounter_pairs(self.particles, dict(parameters, softening=1e-3), 0.01))
+    self.assertEqual(0, len(n_body_encounters.find_encounter_pairs(self.particles, dict(parameters, softening=1e-2), 0.01)))
+
+  def test_pair_unbound_by_kick(self):
+
+    # A binary close to escape speed, falling towards a heavy perturber whose tidal pull unbinds it
+    # during the first kick of a step
+    separation = 0.01
+    speed = 0.99*np.sqrt(2.*2./separation)
+
+    particles = {
+      'masses' : np.array([1., 1., 50.]),
+      'positions' : np.array([[-0.5*separation, 0.], [0.5*separation, 0.], [0.2, 0.]]),
+      'velocities' : np.array([[0., -0.5*speed], [0., 0.5*speed], [0., 0.]]),
+    }
+    parameters = {'G' : 1., 'dt' : 1e-3, 'encounter_factor' : 100.}
+
+    for i in range(50):
+      n_body_physics.update_system(particles, parameters)
+
+    assert np.all(np.isfinite(particles['positions']))
+    assert np.all(np.isfinite(particles['velocities']))
+
+  def test_pairs_are_disjoint(self):
+
+    rng = np.random.default_rng(4)
+    particles = {
+      'masses' : np.ones(200),
+      'positions' : rng.uniform(0., 1., (200, 2)),
+      'velocities' : np.zeros((200, 2)),
+    }
+
+    pairs = n_body_encounters.find_encounter_pairs(particles, {'G' : 1., 'encounter_factor' : 100.}, 0.01)
+
+    self.assertGreater(len(pairs), 0)
+    self.assertEqual(pairs.size, np.unique(pairs).size)
+
+  def test_find_pairs_within(self):
+
+    positions = np.random.default_rng(5).uniform(0., 1., (300, 3))
+
+    distances = np.linalg.norm(positions[:, np.newaxis] - positions[np.newaxis, :], axis=2)
+    i, j = np.nonzero(np.triu(distances <= 0.1, k=1))
+
+    pairs = n_body_encounters.find_pairs_within(positions, 0.1)
+
+    self.assertEqual(sorted(zip(i, j)), sorted(map(tuple, pairs)))
+
+  def test_large_timestep_conserves_energy(self):
+
+    initial = n_body_physics.calculate_total_energy(self.particles, self.parameters)
+
+    for i in range(200):
+      n_body_physics.update_system(self.particles, self.parameters)
+
+    final = n_body_physics.calculate_total_energy(self.particles, self.parameters)
+
+    self.assertLess(abs(final/initial - 1.), 1e-3)
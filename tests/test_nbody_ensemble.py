@@ -0,0 +1,93 @@
+'''Testing for n_body_ensemble.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_ensemble
+import n_body_physics
+
+########################################################################
+
+class TestEnsemble(unittest.TestCase):
+  '''Testing for n_body_ensemble.Ensemble'''
+
+  def setUp(self):
+
+    rng = np.random.default_rng(5)
+
+    self.systems = []
+    for n_particles in (3, 7, 5, 12):
+      self.systems.append({
+        'masses' : rng.uniform(1., 2., n_particles),
+        'positions' : rng.uniform(-1., 1., (n_particles, 2)),
+        'velocities' : rng.normal(0., 0.3, (n_particles, 2)),
+      })
+
+    self.dt = np.array([1e-3, 2e-3, 5e-4, 1e-3])
+    self.G = np.array([1., 0.5, 2., 1.])
+
+  def test_consistent_with_update_system(self):
+
+    ensemble = n_body_ensemble.Ensemble(self.systems, self.dt, self.G, max_steps=20)
+    ensemble.run()
+
+    for b, system in enumerate(self.systems):
+
+      particles = dict((key, value.copy()) for key, value in system.items())
+      parameters = {'dt' : self.dt[b], 'G' : self.G[b]}
+      for i in range(20):
+        n_body_physics.update_system(particles, parameters)
+
+      actual = ensemble.get_system(b)
+
+      npt.assert_allclose(particles['positions'], actual['positions'], rtol=1e-10, atol=1e-12)
+      npt.assert_allclose(particles['velocities'], actual['velocities'], rtol=1e-10, atol=1e-12)
+
+  def test_padding_does_not_move(self):
+
+    ensemble = n_body_ensemble.Ensemble(self.systems, 1e-3, max_steps=5)
+    ensemble.run()
+
+    npt.assert_array_equal(0., ensemble.positions[~ensemble.mask])
+    npt.assert_array_equal(0., ensemble.velocities[~ensemble.mask])
+
+  def test_per_system_termination(self):
+
+    ensemble = n_body_ensemble.Ensemble(self.systems, self.dt, self.G, max_steps=[3, 100, 100, 100], t_end=[1., 0.015, 1., 0.0105])
+    ensemble.run()
+
+    npt.assert_array_equal([3, 8, 100, 11], ensemble.steps)
+    npt.assert_allclose([0.003, 0.015, 0.05, 0.0105], ensemble.time)
+    self.assertTrue(ensemble.finished)
+
+  def test_energies(self):
+
+    ensemble = n_body_ensemble.Ensemble(self.systems, self.dt, self.G)
+
+    expected = [n_body_physics.calculate_total_energy(system, {'G' : G}) for system, G in zip(self.systems, self.G)]
+
+    npt.assert_allclose(expected, ensemble.calculate_energies())
+
+  def test_batches_give_same_result(self):
+
+    ensemble = n_body_ensemble.Ensemble(self.systems, self.dt, self.G)
+    batched = n_body_ensemble.Ensemble(self.systems, self.dt, self.G, batch_size=3)
+
+    npt.assert_allclose(ensemble.calculate_accelerations(), batched.calculate_accelerations())
+
+  def test_from_parameters(self):
+
+    parameters = [{'dt' : dt, 'G' : G, 't_end' : 0.01} for dt, G in zip(self.dt, self.G)]
+
+    ensemble = n_body_ensemble.Ensemble.from_parameters(self.systems, parameters)
+
+    npt.assert_array_equal(self.dt, ensemble.dt)
+    npt.assert_array_equal(0.01, ensemble.t_end)
+
+  def test_mismatched_dimensions(self):
+
+    self.systems[0]['positions'] = np.zeros((3, 3))
+
+    self.assertRaises(ValueError, n_body_ensemble.Ensemble, self.systems, 1e-3)
@@ -0,0 +1,132 @@
+'''Testing for n_body_fmm.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_fmm
+import n_body_integrators
+import n_body_physics
+import n_body_setup
+import n_body_tree
+
+########################################################################
+
+def relative_errors(forces, expected):
+
+  return np.sqrt(((forces - expected)**2.).sum(axis=1))/np.sqrt((expected**2.).sum(axis=1))
+
+########################################################################
+
+class TestFMMForces(unittest.TestCase):
+  '''Testing for n_body_fmm.evaluate_fmm_forces()'''
+
+  def setUp(self):
+
+    self.particles = n_body_setup.sample_plummer_sphere(1500, np.random.default_rng(3))
+    self.expected = n_body_physics.calculate_direct_forces(self.particles, {'G' : 2., 'use_numba' : False})
+
+  def test_converges_with_order(self):
+
+    medians = []
+    for order in [1, 3, 5]:
+      forces = n_body_fmm.evaluate_fmm_forces(self.particles['masses'], self.particles['positions'], 2., order=order, leaf_size=16)
+      medians.append(np.median(relative_errors(forces, self.expected)))
+
+    self.assertLess(medians[1], 0.2*medians[0])
+    self.assertLess(medians[2], 0.2*medians[1])
+    self.assertLess(medians[2], 1.e-3)
+
+  def test_exact_when_nothing_is_accepted(self):
+
+    # With theta = 0 every pair of leaves is summed directly.
+    forces = n_body_fmm.evaluate_fmm_forces(self.particles['masses'], self.particles['positions'], 2., theta=0., leaf_size=16)
+
+    npt.assert_allclose(self.expected, forces, rtol=1.e-10, atol=1.e-10*np.abs(self.expected).max())
+
+  def test_two_dimensions(self):
+
+    rng = np.random.default_rng(4)
+    masses = rng.uniform(1., 2., 800)
+    positions = rng.normal(0., 1., (800, 2))
+
+    expected = n_body_physics.calculate_direct_forces({'masses' : masses, 'positions' : positions}, {'G' : 1., 'use_numba' : False})
+    forces = n_body_fmm.evaluate_fmm_forces(masses, positions, 1., order=6, leaf_size=16)
+
+    self.assertLess(np.median(relative_errors(forces, expected)), 1.e-4)
+
+  def test_momentum_conserved(self):
+
+    # The mutual interactions give equal and opposite forces, up to the expansion error.
+    forces = n_body_fmm.evaluate_fmm_forces(self.particles['masses'], self.particles['positions'], 2.)
+
+    self.assertLess(np.abs(forces.sum(axis=0)).max(), 1.e-3*np.abs(forces).max())
+
+  def test_spline_softening(self):
+
+    parameters = {'G' : 2., 'softening' : 0.05, 'softening_kernel' : 'spline', 'use_numba' : False}
+    expected = n_body_physics.calculate_direct_forces(self.particles, parameters)
+
+    forces = n_body_physics.calculate_net_force_on_all_particles(self.particles, dict(parameters, force_method='fmm', fmm_order=5))
+
+    self.assertLess(np.median(relative_errors(forces, expected)), 1.e-3)
+
+  def test_invalid_options(self):
+
+    with self.assertRaises(ValueError):
+      n_body_fmm.evaluate_fmm_forces(self.particles['masses'], self.particles['positions'], 1., order=0)
+
+    with self.assertRaises(ValueError):
+      n_body_fmm.evaluate_fmm_forces(self.particles['masses'], self.particles['positions'], 1., softening=0.1)
+
+########################################################################
+
+class TestFindInteractions(unittest.TestCase):
+  '''Testing for n_body_fmm.find_interactions()'''
+
+  def test_every_pair_once(self):
+
+    rng = np.random.default_rng(5)
+    positions = rng.normal(0., 1., (400, 3))
+
+    tree = n_body_tree.build_tree(np.ones(400), positions, 8)
+    tree['is_leaf'] = (tree['children'] < 0).all(axis=1)
+    tree['radii'] = n_body_fmm.calculate_radii(tree, positions)
+    accepted, leaf_pairs = n_body_fmm.find_interactions(tree, 0.5)
+
+    # Count the particle pairs each interaction covers, expanding the nodes down to their particles.
+    parents = n_body_fmm._get_parents(tree)
+    leaves = np.repeat(np.arange(len(tree['half_widths'])), tree['leaf_counts'])
+    particle_nodes = np.zeros((len(positions), len(tree['half_widths'])), dtype=bool)
+    particle_nodes[tree['order'], leaves] = True
+    for level in reversed(n_body_fmm._get_levels(tree)[1:]):
+      for node in level:
+        particle_nodes[:, parents[node]] |= particle_nodes[:, node]
+
+    counts = np.zeros((len(positions), len(positions)), dtype=int)
+    for a, b in np.concatenate([accepted, leaf_pairs]):
+      block = np.outer(particle_nodes[:, a], particle_nodes[:, b]).astype(int)
+      counts += block + block.T if a != b else block
+
+    off_diagonal = ~np.eye(len(positions), dtype=bool)
+    npt.assert_array_equal(np.ones(off_diagonal.sum(), dtype=int), counts[off_diagonal])
+
+########################################################################
+
+class TestDispatcher(unittest.TestCase):
+  '''Testing the 'fmm' force method'''
+
+  def test_force_method(self):
+
+    particles = n_body_setup.sample_plummer_sphere(300, np.random.default_rng(6))
+
+    expected = n_body_physics.calculate_direct_forces(particles, {'G' : 1., 'use_numba' : False})
+    forces = n_body_physics.calculate_net_force_on_all_particles(particles, {'G' : 1., 'force_method' : 'fmm', 'fmm_order' : 6})
+
+    self.assertLess(np.median(relative_errors(forces, expected)), 1.e-4)
+
+  def test_invalidates_cached_accelerations(self):
+
+    for name in ['fmm_order', 'fmm_theta', 'fmm_leaf_size']:
+      self.assertIn(name, n_body_integrators.FORCE_PARAMETERS)
@@ -0,0 +1,245 @@
+'''Testing for n_body_integrators.py
+'''
+
+import copy
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_integrators
+import n_body_physics
+
+########################################################################
+
+class TestLeapfrogIntegrator(unittest.TestCase):
+  '''Testing for n_body_integrators.LeapfrogIntegrator'''
+
+  def setUp(self):
+
+    self.n_particles = 5
+    self.n_dimensions = 3
+
+    self.parameters = {'G': 1.,
+                       'dt' : 1.e-3,
+                       'n_dimensions' : self.n_dimensions,
+                      }
+
+    self.particles = {}
+    self.particles['masses'] = np.random.uniform(1., 3., self.n_particles)
+    self.particles['positions'] = np.random.uniform(0., 3., (self.n_particles, self.n_dimensions))
+    self.particles['velocities'] = np.random.uniform(-1., 1., (self.n_particles, self.n_dimensions))
+
+    self.integrator = n_body_integrators.LeapfrogIntegrator()
+
+  def test_one_force_evaluation_per_step(self):
+
+    n_steps = 5
+    for step in range(n_steps):
+      self.integrator.step(self.particles, self.parameters)
+
+    self.assertEqual(n_steps + 1, self.integrator.n_force_evaluations)
+
+  def test_matches_two_evaluation_scheme(self):
+
+    particles = copy.deepcopy(self.particles)
+
+    for step in range(3):
+      forces = n_body_physics.calculate_net_force_on_all_particles(particles, self.parameters)
+      n_body_physics.update_positions(particles, self.parameters, forces)
+      forces_new = n_body_physics.calculate_net_force_on_all_particles(particles, self.parameters)
+      n_body_physics.update_velocities(particles, self.parameters, forces, forces_new)
+
+      self.integrator.step(self.particles, self.parameters)
+
+    npt.assert_allclose(particles['positions'], self.particles['positions'])
+    npt.assert_allclose(particles['velocities'], self.particles['velocities'])
+
+  def test_cache_invalidated_by_changed_positions(self):
+
+    self.integrator.step(self.particles, self.parameters)
+    assert self.integrator.is_cache_valid(self.particles, self.parameters)
+
+    self.particles['positions'][0] += 1.
+    assert not self.integrator.is_cache_valid(self.particles, self.parameters)
+
+    self.integrator.step(self.particles, self.parameters)
+    self.assertEqual(4, self.integrator.n_force_evaluations)
+
+  def test_cache_invalidated_by_changed_parameters(self):
+
+    self.integrator.step(self.particles, self.parameters)
+
+    self.parameters['G'] = 2.
+    assert not self.integrator.is_cache_valid(self.particles, self.parameters)
+
+  def test_update_system_keeps_integrator(self):
+
+    n_body_physics.update_system(self.particles, self.parameters)
+    n_body_physics.update_system(self.particles, self.parameters)
+
+    self.assertEqual(3, self.parameters['integrator_state'].n_force_evaluations)
+
+########################################################################
+
+class TestBlockHermiteIntegrator(unittest.TestCase):
+  '''Testing for n_body_integrators.BlockHermiteIntegrator'''
+
+  def setUp(self):
+
+    self.parameters = {'G': 1.,
+                       'dt' : 0.05,
+                       'integrator' : 'block_hermite',
+                       'eta' : 0.01,
+                      }
+
+    # A tight binary orbited by a few distant, light particles
+    self.particles = {}
+    self.particles['masses'] = np.array([1., 1., 1.e-3, 1.e-3, 1.e-3, 1.e-3])
+    self.particles['positions'] = np.array([[0.05, 0., 0.], [-0.05, 0., 0.], [10., 0., 0.], [-10., 0., 0.], [0., 12., 0.], [0., -14., 0.]])
+    self.particles['velocities'] = np.zeros((6, 3))
+    self.particles['velocities'][0, 1] = np.sqrt(0.5/0.1)
+    self.particles['velocities'][1, 1] = -np.sqrt(0.5/0.1)
+    for i in range(2, 6):
+      r = np.linalg.norm(self.particles['positions'][i])
+      self.particles['velocities'][i] = np.sqrt(2./r)*np.cross([0., 0., 1.], self.particles['positions'][i])/r
+
+  def test_energy_conserved(self):
+
+    energy_before = n_body_physics.calculate_total_energy(self.particles, self.parameters)
+
+    for step in range(10):
+      n_body_physics.update_system(self.particles, self.parameters)
+
+    energy_after = n_body_physics.calculate_total_energy(self.particles, self.parameters)
+
+    npt.assert_allclose(energy_before, energy_after, rtol=1.e-5)
+
+  def test_saves_force_evaluations(self):
+
+    for step in range(3):
+      n_body_physics.update_system(self.particles, self.parameters)
+
+    integrator = self.parameters['integrator_state']
+
+    assert integrator.savings() > 2.
+    assert integrator.levels[0] > integrator.levels[2]
+
+  def test_matches_small_global_timestep(self):
+
+    particles = copy.deepcopy(self.particles)
+
+    n_body_physics.update_system(self.particles, self.parameters)
+
+    # The same system with a single small timestep
+    self.parameters['integrator_state'] = None
+    self.parameters['max_level'] = 0
+    self.parameters['dt'] = 0.05/64.
+    for step in range(64):
+      n_body_physics.update_system(particles, self.parameters)
+
+    npt.assert_allclose(particles['positions'], self.particles['positions'], atol=1.e-6)
+
+  def test_rejects_other_force_methods(self):
+
+    positions = self.particles['positions'].copy()
+
+    for changes in [{'force_method' : 'tree'}, {'force_method' : 'parallel'}, {'mixed_precision' : True}]:
+      parameters = dict(self.parameters, **changes)
+      with self.assertRaises(ValueError):
+        n_body_physics.update_system(self.particles, parameters)
+
+    npt.assert_array_equal(positions, self.particles['positions'])
+
+########################################################################
+
+class TestIntegratorRegistry(unittest.TestCase):
+  '''Testing for the integrators in n_body_integrators.INTEGRATORS'''
+
+  def setUp(self):
+
+    # An eccentric two-body orbit
+    self.particles = {}
+    self.particles['masses'] = np.array([1., 1.e-3])
+    self.particles['positions'] = np.array([[0., 0.], [1., 0.]])
+    self.particles['velocities'] = np.array([[0., 0.], [0., 1.2]])
+
+    self.duration = 1.
+
+  def integrate(self, name, n_steps, **kwargs):
+
+    particles = copy.deepcopy(self.particles)
+
+    parameters = {'G': 1.,
+                  'dt' : self.duration/n_steps,
+                  'integrator' : name,
+                 }
+    parameters.update(kwargs)
+
+    for step in range(n_steps):
+      n_body_physics.update_system(particles, parameters)
+
+    return particles, parameters['integrator_state']
+
+  def reference(self):
+
+    particles, integrator = self.integrate('yoshida6', 400)
+
+    return particles['positions']
+
+  def test_unknown_integrator(self):
+
+    with self.assertRaises(ValueError):
+      n_body_integrators.make_integrator({'integrator' : 'euler'})
+
+  def test_hermite_needs_direct_forces(self):
+
+    for name in ['hermite', 'block_hermite']:
+      for changes in [{'force_method' : 'fmm'}, {'mixed_precision' : True}]:
+        with self.assertRaises(ValueError):
+          self.integrate(name, 1, **changes)
+
+  def test_orders(self):
+
+    reference = self.reference()
+
+    expected_orders = {
+      'leapfrog' : 2,
+      'hermite' : 4,
+      'forest_ruth' : 4,
+      'yoshida6' : 6,
+    }
+
+    for name, order in expected_orders.items():
+      errors = []
+      for n_steps in [50, 100]:
+        particles, integrator = self.integrate(name, n_steps)
+        errors.append(np.abs(particles['positions'] - reference).max())
+
+      measured_order = np.log2(errors[0]/errors[1])
+
+      assert abs(measured_order - order) < 0.5, (name, measured_order)
+
+  def test_force_evaluations_per_step(self):
+
+    expected = {
+      'leapfrog' : 1,
+      'hermite' : 1,
+      'forest_ruth' : 3,
+      'yoshida6' : 7,
+    }
+
+    for name, per_step in expected.items():
+      particles, integrator = self.integrate(name, 10)
+
+      self.assertEqual(1 + 10*per_step, integrator.n_force_evaluations)
+
+  def test_dormand_prince_meets_tolerance(self):
+
+    reference = self.reference()
+
+    particles, integrator = self.integrate('dormand_prince', 5, tolerance=1.e-10)
+
+    npt.assert_allclose(reference, particles['positions'], atol=1.e-8)
+
+    # Several substeps are needed for each step.
+    assert integrator.n_force_evaluations > 6*5
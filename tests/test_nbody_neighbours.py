@@ -0,0 +1,102 @@
+'''Testing for n_body_neighbours.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_neighbours
+
+########################################################################
+
+def find_every_pair(positions, radius, box_size=None):
+
+  displacements = positions[np.newaxis, :, :] - positions[:, np.newaxis, :]
+  if box_size is not None:
+    displacements -= box_size*np.round(displacements/box_size)
+
+  i, j = np.nonzero(np.triu((displacements**2.).sum(axis=2) <= radius**2., 1))
+
+  return np.array([i, j]).T
+
+def sort_pairs(pairs):
+
+  return pairs[np.lexsort(pairs.T[::-1])]
+
+########################################################################
+
+class TestFindPairs(unittest.TestCase):
+  '''Testing for n_body_neighbours.find_pairs()'''
+
+  def test_matches_every_pair(self):
+
+    rng = np.random.default_rng(7)
+
+    for n_dimensions in [1, 2, 3]:
+      positions = rng.uniform(-5., 15., (300, n_dimensions))
+
+      # A few far away, so most of the open box is empty
+      positions[:3] *= 100.
+
+      for box_size in [None, 10.]:
+        for radius in [0., 1., 4., 5.]:
+          expected = find_every_pair(positions, radius, box_size)
+          npt.assert_array_equal(expected, sort_pairs(n_body_neighbours.find_pairs(positions, radius, box_size)))
+
+  def test_no_particles(self):
+
+    self.assertEqual((0, 2), n_body_neighbours.find_pairs(np.zeros((0, 3)), 1.).shape)
+
+  def test_radius_too_large(self):
+
+    with self.assertRaises(ValueError):
+      n_body_neighbours.find_pairs(np.zeros((2, 3)), 6., 10.)
+
+########################################################################
+
+class TestNeighbourIndex(unittest.TestCase):
+  '''Testing for n_body_neighbours.NeighbourIndex'''
+
+  def setUp(self):
+
+    rng = np.random.default_rng(8)
+    self.positions = rng.uniform(0., 10., (500, 3))
+    self.velocities = rng.normal(0., 1., (500, 3))
+
+  def test_csr(self):
+
+    index = n_body_neighbours.NeighbourIndex(1., 0.5)
+    offsets, neighbours = index.get_pairs(self.positions)
+
+    self.assertEqual((501,), offsets.shape)
+    self.assertEqual(index.n_pairs, offsets[-1])
+
+    rows = n_body_neighbours.get_rows(offsets)
+    self.assertTrue(np.all(rows < neighbours))
+
+    npt.assert_array_equal(find_every_pair(self.positions, 1.5), sort_pairs(np.array([rows, neighbours]).T))
+
+  def test_reused_within_skin(self):
+
+    for box_size in [None, 10.]:
+      index = n_body_neighbours.NeighbourIndex(1., 0.4, box_size)
+
+      positions = self.positions.copy()
+      for step in range(20):
+        npt.assert_array_equal(find_every_pair(positions, 1., box_size), sort_pairs(index.find_pairs(positions)))
+
+        positions += 0.01*self.velocities
+        if box_size is not None:
+          positions %= box_size
+
+      # The fastest particles move about 0.04 a step, so the list lasts several steps.
+      self.assertLess(index.n_builds, 10)
+      self.assertGreater(index.n_builds, 1)
+
+  def test_rebuilt_for_new_particles(self):
+
+    index = n_body_neighbours.NeighbourIndex(1., 0.4)
+    index.update(self.positions)
+
+    self.assertFalse(index.update(self.positions))
+    self.assertTrue(index.update(self.positions[:100]))
@@ -0,0 +1,130 @@
+'''Testing for n_body_numba.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+from unittest import mock
+
+import n_body_integrators
+import n_body_numba
+import n_body_physics
+
+########################################################################
+
+@unittest.skipUnless(n_body_numba.NUMBA_AVAILABLE, 'Numba is not installed')
+class TestNumbaKernels(unittest.TestCase):
+  '''Testing the compiled kernels against the NumPy ones'''
+
+  def setUp(self):
+
+    self.n_particles = 60
+    self.n_dimensions = 3
+
+    self.rng = np.random.default_rng(3)
+
+    self.particles = {}
+    self.particles['masses'] = self.rng.uniform(1., 3., self.n_particles)
+    self.particles['positions'] = self.rng.uniform(0., 3., (self.n_particles, self.n_dimensions))
+    self.particles['velocities'] = self.rng.normal(0., 1., (self.n_particles, self.n_dimensions))
+
+    self.parameters = {'G' : 1., 'dt' : 0.001}
+
+  def test_forces_consistent_with_numpy(self):
+
+    expected = n_body_physics.calculate_direct_forces(self.particles, dict(self.parameters, use_numba=False))
+
+    actual = n_body_physics.calculate_direct_forces(self.particles, self.parameters)
+
+    npt.assert_allclose(expected, actual, rtol=1e-12, atol=1e-12*np.abs(expected).max())
+
+  def test_forces_two_dimensions(self):
+
+    positions = self.particles['positions'][:, :2]
+
+    expected = n_body_physics.calculate_pairwise_forces(self.particles['masses'], positions, 2.)
+
+    actual = n_body_numba.calculate_numba_forces(self.particles['masses'], positions, 2.)
+
+    npt.assert_allclose(expected, actual, rtol=1e-12, atol=1e-12*np.abs(expected).max())
+
+  def test_kick_and_drift_match_numpy(self):
+
+    accelerations = self.rng.normal(0., 1., (self.n_particles, self.n_dimensions))
+
+    expected_velocities = self.particles['velocities'] + 0.05*accelerations
+    expected_positions = self.particles['positions'] + 0.1*expected_velocities
+
+    n_body_physics.kick(self.particles, self.parameters, accelerations, 0.05)
+    n_body_physics.drift(self.particles, self.parameters, 0.1)
+
+    npt.assert_array_equal(expected_velocities, self.particles['velocities'])
+    npt.assert_array_equal(expected_positions, self.particles['positions'])
+
+  def test_leapfrog_consistent_with_numpy(self):
+
+    particles = dict((key, value.copy()) for key, value in self.particles.items())
+    parameters = dict(self.parameters, use_numba=False)
+
+    for i in range(10):
+      n_body_physics.update_system(self.particles, self.parameters)
+      n_body_physics.update_system(particles, parameters)
+
+    npt.assert_allclose(particles['positions'], self.particles['positions'], rtol=1e-10)
+    npt.assert_allclose(particles['velocities'], self.particles['velocities'], rtol=1e-10)
+    self.assertIsInstance(self.parameters['integrator_state'], n_body_integrators.LeapfrogIntegrator)
+
+  def test_compile_options(self):
+
+    expected = n_body_physics.calculate_direct_forces(self.particles, self.parameters)
+
+    for parallel, fastmath in [(False, False), (True, True)]:
+      parameters = dict(self.parameters, numba_parallel=parallel, numba_fastmath=fastmath)
+      actual = n_body_physics.calculate_direct_forces(self.particles, parameters)
+
+      npt.assert_allclose(expected, actual, rtol=1e-10, atol=1e-12*np.abs(expected).max())
+
+    self.assertIsNot(n_body_numba.get_kernel('direct_forces', True), n_body_numba.get_kernel('direct_forces', False))
+    self.assertIs(n_body_numba.get_kernel('kick', True), n_body_numba.get_kernel('kick', False))
+
+########################################################################
+
+class TestNumPyFallback(unittest.TestCase):
+  '''Testing that everything falls back to NumPy without Numba, whether or not it is installed'''
+
+  def setUp(self):
+
+    rng = np.random.default_rng(8)
+
+    self.particles = {}
+    self.particles['masses'] = rng.uniform(1., 3., 30)
+    self.particles['positions'] = rng.uniform(0., 3., (30, 3))
+    self.particles['velocities'] = rng.normal(0., 1., (30, 3))
+
+    self.parameters = {'G' : 1., 'dt' : 0.001}
+
+  def test_fallback(self):
+
+    particles = dict((key, value.copy()) for key, value in self.particles.items())
+
+    expected = n_body_physics.calculate_pairwise_forces(self.particles['masses'], self.particles['positions'], 1.)
+
+    # Any call into a compiled kernel would fail.
+    with mock.patch.object(n_body_numba, 'NUMBA_AVAILABLE', False), \
+         mock.patch.object(n_body_numba, 'calculate_numba_forces', side_effect=AssertionError), \
+         mock.patch.object(n_body_numba, 'kick', side_effect=AssertionError), \
+         mock.patch.object(n_body_numba, 'drift', side_effect=AssertionError):
+
+      self.assertFalse(n_body_numba.use_numba(self.parameters))
+
+      npt.assert_allclose(expected, n_body_physics.calculate_direct_forces(self.particles, self.parameters), rtol=1e-12)
+
+      for i in range(3):
+        n_body_physics.update_system(self.particles, self.parameters)
+
+    parameters = dict(self.parameters, use_numba=False)
+    for i in range(3):
+      n_body_physics.update_system(particles, parameters)
+
+    npt.assert_array_equal(particles['positions'], self.particles['positions'])
+    npt.assert_array_equal(particles['velocities'], self.particles['velocities'])
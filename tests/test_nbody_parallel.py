@@ -0,0 +1,91 @@
+'''Testing for n_body_parallel.py
+'''
+
+import gc
+import numpy as np
+import numpy.testing as npt
+import unittest
+import weakref
+
+import n_body_parallel
+import n_body_physics
+
+########################################################################
+
+class TestCalculateParallelForces(unittest.TestCase):
+  '''Testing for n_body_parallel.calculate_parallel_forces()'''
+
+  def setUp(self):
+
+    self.n_particles = 50
+    self.n_dimensions = 3
+
+    self.parameters = {'G': 6.67e-11,
+                       'force_method' : 'parallel',
+                       'n_workers' : 2,
+                      }
+
+    self.particles = {}
+    self.particles['masses'] = np.random.uniform(1., 3., self.n_particles)
+    self.particles['positions'] = np.random.uniform(0., 3., (self.n_particles, self.n_dimensions))
+
+  def tearDown(self):
+
+    if self.parameters.get('parallel_state') is not None:
+      self.parameters['parallel_state'].close()
+
+  def test_consistent_with_direct(self):
+
+    expected = n_body_physics.calculate_direct_forces(self.particles, self.parameters)
+
+    actual = n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters)
+
+    npt.assert_allclose(expected, actual)
+
+  def test_pool_reused(self):
+
+    n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters)
+    pool = self.parameters['parallel_state']
+
+    self.particles['positions'] += 1.
+    n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters)
+
+    assert pool is self.parameters['parallel_state']
+
+  def test_pool_reused_for_fewer_particles(self):
+
+    n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters)
+    pool = self.parameters['parallel_state']
+
+    particles = {'masses' : self.particles['masses'][:30], 'positions' : self.particles['positions'][:30]}
+
+    expected = n_body_physics.calculate_direct_forces(particles, self.parameters)
+    actual = n_body_physics.calculate_net_force_on_all_particles(particles, self.parameters)
+
+    npt.assert_allclose(expected, actual)
+    assert pool is self.parameters['parallel_state']
+
+  def test_close_unregisters(self):
+
+    n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters)
+    pool = weakref.ref(self.parameters['parallel_state'])
+
+    # A bigger system needs a new pool, and nothing keeps the old one alive.
+    self.particles['masses'] = np.concatenate([self.particles['masses'], [1.]])
+    self.particles['positions'] = np.concatenate([self.particles['positions'], [[5., 5., 5.]]])
+    n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters)
+
+    gc.collect()
+    self.assertIsNone(pool())
+
+  def test_deterministic_across_worker_counts(self):
+
+    self.parameters['deterministic'] = True
+    self.parameters['parallel_chunk_size'] = 7
+
+    results = []
+    for n_workers in [1, 3]:
+      self.parameters['n_workers'] = n_workers
+      results.append(n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters))
+
+    npt.assert_array_equal(results[0], results[1])
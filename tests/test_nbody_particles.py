@@ -0,0 +1,94 @@
+'''Testing for n_body_particles.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_particles
+import n_body_physics
+
+########################################################################
+
+class TestParticleSet(unittest.TestCase):
+  '''Testing for n_body_particles.ParticleSet'''
+
+  def setUp(self):
+
+    self.n_particles = 4
+    self.n_dimensions = 2
+
+    self.parameters = {'G': 6.67e-11,
+                       'dt' : 0.01,
+                       'n_dimensions' : self.n_dimensions,
+                      }
+
+    self.particles = {}
+    self.particles['masses'] = np.random.uniform(1., 3., self.n_particles)
+    self.particles['positions'] = np.random.uniform(0., 3., (self.n_particles, self.n_dimensions))
+    self.particles['velocities'] = np.random.uniform(-3., 3., (self.n_particles, self.n_dimensions))
+
+    self.particle_set = n_body_particles.ParticleSet.from_dict(self.particles)
+
+  def test_dict_access(self):
+
+    for key in ['masses', 'positions', 'velocities']:
+      npt.assert_array_equal(self.particles[key], self.particle_set[key])
+      self.assertEqual(np.float64, self.particle_set[key].dtype)
+
+  def test_same_forces_as_dict(self):
+
+    expected = n_body_physics.calculate_net_force_on_all_particles(self.particles, self.parameters)
+    actual = n_body_physics.calculate_net_force_on_all_particles(self.particle_set, self.parameters)
+
+    npt.assert_allclose(expected, actual)
+
+  def test_same_step_as_dict(self):
+
+    n_body_physics.update_system(self.particles, self.parameters)
+    n_body_physics.update_system(self.particle_set, self.parameters.copy())
+
+    npt.assert_allclose(self.particles['positions'], self.particle_set['positions'])
+    npt.assert_allclose(self.particles['velocities'], self.particle_set['velocities'])
+
+  def test_inverse_masses_follow_masses(self):
+
+    npt.assert_allclose(1./self.particles['masses'], self.particle_set.inverse_masses[:, 0])
+
+    new_masses = 2.*self.particles['masses']
+    self.particle_set['masses'] = new_masses
+
+    npt.assert_allclose(1./new_masses, self.particle_set.inverse_masses[:, 0])
+
+  def test_masses_read_only(self):
+
+    with self.assertRaises(ValueError):
+      self.particle_set['masses'][0] = 1.
+
+  def test_add_grows_geometrically(self):
+
+    for i in range(10):
+      self.particle_set.add(1., np.ones(self.n_dimensions))
+
+    self.assertEqual(self.n_particles + 10, self.particle_set.n_particles)
+    self.assertEqual(16, self.particle_set.capacity)
+    npt.assert_array_equal(self.particles['positions'], self.particle_set['positions'][:self.n_particles])
+    npt.assert_array_equal(np.ones(self.n_dimensions), self.particle_set['positions'][-1])
+
+  def test_remove_keeps_order_and_capacity(self):
+
+    self.particle_set['radii'] = np.arange(self.n_particles)
+    capacity = self.particle_set.capacity
+
+    self.particle_set.remove([0, 2])
+
+    self.assertEqual(capacity, self.particle_set.capacity)
+    npt.assert_array_equal(self.particles['masses'][[1, 3]], self.particle_set['masses'])
+    npt.assert_array_equal(self.particles['positions'][[1, 3]], self.particle_set['positions'])
+    npt.assert_array_equal([1, 3], self.particle_set['radii'])
+    npt.assert_allclose(1./self.particles['masses'][[1, 3]], self.particle_set.inverse_masses[:, 0])
+
+  def test_wrong_shape_rejected(self):
+
+    with self.assertRaises(ValueError):
+      self.particle_set['positions'] = np.zeros((self.n_particles + 1, self.n_dimensions))
@@ -183,6 +183,105 @@ class TestCalculateNetForceAllParticles(unittest.TestCase):
     npt.assert_allclose(expected, actual)
 
 ########################################################################
+
+class TestCalculatePairwiseForces(unittest.TestCase):
+  '''Testing for n_body_physics.calculate_pairwise_forces()'''
+
+  def setUp(self):
+
+    self.n_particles = 7
+    self.n_dimensions = 3
+
+    self.parameters = {'G': 6.67e-11,
+                      }
+
+    self.particles = {}
+    self.particles['masses'] = np.random.uniform(1., 3., self.n_particles)
+    self.particles['positions'] = np.random.uniform(0., 3., (self.n_particles, self.n_dimensions))
+    self.particles['velocities'] = np.random.uniform(-3., 3., (self.n_particles, self.n_dimensions))
+
+    # What function to run
+    self.fn = n_body_physics.calculate_pairwise_forces
+
+    # What arguments to use
+    self.args = (self.particles['masses'], self.particles['positions'], self.parameters['G'])
+
+  def test_consistent_with_loop(self):
+
+    expected = np.array([n_body_physics.calculate_net_force_on_particle(i, self.particles, self.parameters) for i in range(self.n_particles)])
+
+    actual = self.fn(*self.args)
+
+    npt.assert_allclose(expected, actual)
+
+  def test_momentum_conserved(self):
+
+    total_force = self.fn(*self.args).sum(axis=0)
+
+    npt.assert_allclose(np.zeros(self.n_dimensions), total_force, atol=1.e-20)
+
+  def test_accelerations(self):
+
+    expected = self.fn(*self.args)/self.particles['masses'][:, np.newaxis]
+
+    actual = n_body_physics.calculate_accelerations(self.particles, self.parameters)
+
+    npt.assert_allclose(expected, actual)
+
+########################################################################
+
+class TestCalculateTiledForces(unittest.TestCase):
+  '''Testing for n_body_physics.calculate_tiled_forces()'''
+
+  def setUp(self):
+
+    self.n_particles = 11
+    self.n_dimensions = 3
+
+    self.masses = np.random.uniform(1., 3., self.n_particles)
+    self.positions = np.random.uniform(0., 3., (self.n_particles, self.n_dimensions))
+    self.G = 6.67e-11
+
+    # What function to run
+    self.fn = n_body_physics.calculate_tiled_forces
+
+  def test_consistent_with_pairwise(self):
+
+    expected = n_body_physics.calculate_pairwise_forces(self.masses, self.positions, self.G)
+
+    for tile_size in [1, 3, 4, 11, 20]:
+      actual = self.fn(self.masses, self.positions, self.G, tile_size)
+
+      npt.assert_allclose(expected, actual)
+
+  def test_selected_by_memory_budget(self):
+
+    particles = {'masses': self.masses, 'positions': self.positions}
+    parameters = {'G': self.G, 'memory_budget': 1000}
+
+    expected = n_body_physics.calculate_pairwise_forces(self.masses, self.positions, self.G)
+
+    actual = n_body_physics.calculate_net_force_on_all_particles(particles, parameters)
+
+    npt.assert_allclose(expected, actual)
+
+  def test_tile_size_fits_budget(self):
+
+    memory_budget = 10000
+
+    tile_size = n_body_physics.choose_tile_size(1000, self.n_dimensions, memory_budget)
+
+    assert 1 <= tile_size
+    assert tile_size**2*8*(self.n_dimensions + 3) <= memory_budget
+
+  def test_block_forces_skip_self(self):
+
+    pair_forces = n_body_physics.calculate_block_forces(self.masses, self.positions, self.masses, self.positions, self.G)
+
+    assert np.isfinite(pair_forces).all()
+    npt.assert_allclose(np.zeros((self.n_particles, self.n_dimensions)), pair_forces[np.arange(self.n_particles), np.arange(self.n_particles)])
+
+########################################################################
     
 class TestUpdatePosition(unittest.TestCase):
   '''Testing for n_body_physics.update_position()'''
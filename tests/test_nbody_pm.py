@@ -0,0 +1,156 @@
+'''Testing for n_body_pm.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_integrators
+import n_body_physics
+import n_body_pm
+
+########################################################################
+
+class TestParticleMesh(unittest.TestCase):
+  '''Testing for n_body_pm.calculate_pm_forces()'''
+
+  def setUp(self):
+
+    self.parameters = {'G' : 2., 'box_size' : 1., 'pm_grid_size' : 32}
+
+  def pair_forces(self, separation, force_method):
+
+    positions = np.full((2, 3), 0.3)
+    positions[1, 0] += separation
+    particles = {'masses' : np.array([1., 3.]), 'positions' : positions}
+
+    return n_body_pm.calculate_pm_forces(particles, dict(self.parameters, force_method=force_method))
+
+  def test_p3m_newtonian_up_close(self):
+
+    for separation in [0.001, 0.01, 0.05]:
+      forces = self.pair_forces(separation, 'p3m')
+
+      self.assertAlmostEqual(1., forces[0, 0]*separation**2./6., delta=0.01)
+      npt.assert_allclose(np.zeros(3), forces.sum(axis=0), atol=1.e-10*np.abs(forces).max())
+
+  def test_pm_matches_p3m_far_apart(self):
+
+    # Beyond the cutoff the short-range force is zero, and the periodic images are far away.
+    self.parameters['pm_grid_size'] = 64
+
+    self.assertAlmostEqual(1., self.pair_forces(0.1, 'pm')[0, 0]*0.1**2./6., delta=0.02)
+
+    npt.assert_allclose(self.pair_forces(0.1, 'pm'), self.pair_forces(0.1, 'p3m'), rtol=1.e-12)
+
+    # Up close the mesh force alone is smoothed away.
+    self.assertLess(self.pair_forces(0.001, 'pm')[0, 0], 1.e-3*6./0.001**2.)
+
+  def test_periodic(self):
+
+    rng = np.random.default_rng(8)
+    particles = {'masses' : rng.uniform(1., 2., 500), 'positions' : rng.uniform(0., 1., (500, 3))}
+    parameters = dict(self.parameters, force_method='p3m')
+
+    forces = n_body_pm.calculate_pm_forces(particles, parameters)
+    shifted = n_body_pm.calculate_pm_forces(dict(particles, positions=particles['positions'] + [1., -2., 3.]), parameters)
+
+    npt.assert_allclose(forces, shifted, atol=1.e-10*np.abs(forces).max())
+    npt.assert_allclose(np.zeros(3), forces.sum(axis=0), atol=1.e-10*np.abs(forces).max())
+
+    # No self force, and a uniform lattice feels nothing.
+    npt.assert_allclose(np.zeros((2, 3)), self.pair_forces(0., 'p3m'), atol=1.e-10)
+
+    lattice = (np.indices((8, 8, 8)).reshape(3, -1).T + 0.5)/8.
+    forces = n_body_pm.calculate_pm_forces({'masses' : np.ones(512), 'positions' : lattice}, parameters)
+    npt.assert_allclose(np.zeros(lattice.shape), forces, atol=1.e-8)
+
+  def test_reuses_mesh(self):
+
+    particles = {'masses' : np.ones(3), 'positions' : np.random.default_rng(9).uniform(0., 1., (3, 3))}
+    parameters = dict(self.parameters, force_method='pm')
+
+    n_body_pm.calculate_pm_forces(particles, parameters)
+    mesh = parameters['pm_state']
+    density = mesh.density
+
+    n_body_pm.calculate_pm_forces(particles, parameters)
+    self.assertIs(mesh, parameters['pm_state'])
+    self.assertIs(density, mesh.density)
+
+    parameters['pm_grid_size'] = 16
+    n_body_pm.calculate_pm_forces(particles, parameters)
+    self.assertIsNot(mesh, parameters['pm_state'])
+
+  def test_reuses_short_range_pairs(self):
+
+    rng = np.random.default_rng(11)
+    particles = {'masses' : np.ones(300), 'positions' : rng.uniform(0., 1., (300, 3))}
+    parameters = dict(self.parameters, force_method='p3m')
+
+    n_body_pm.calculate_pm_forces(particles, parameters)
+
+    # Less than half of the skin
+    particles['positions'] += 0.2*n_body_pm.DEFAULT_SKIN/32.
+    forces = n_body_pm.calculate_pm_forces(particles, parameters)
+
+    self.assertEqual(1, parameters['pm_state'].neighbours.n_builds)
+    npt.assert_allclose(n_body_pm.calculate_pm_forces(particles, dict(parameters, pm_state=None)), forces, rtol=1.e-12)
+
+  def test_invalid_options(self):
+
+    particles = {'masses' : np.ones(2), 'positions' : np.zeros((2, 2))}
+
+    with self.assertRaises(ValueError):
+      n_body_pm.calculate_pm_forces(particles, {'G' : 1., 'force_method' : 'pm'})
+
+    with self.assertRaises(ValueError):
+      n_body_pm.calculate_pm_forces(particles, dict(self.parameters, force_method='pm'))
+
+    with self.assertRaises(ValueError):
+      n_body_pm.calculate_pm_forces({'masses' : np.ones(2), 'positions' : np.zeros((2, 3))},
+                                    dict(self.parameters, force_method='p3m', pm_cutoff=20.))
+
+########################################################################
+
+class TestPeriodicBox(unittest.TestCase):
+  '''Testing the particle mesh force methods in the simulation'''
+
+  def test_update_system(self):
+
+    rng = np.random.default_rng(10)
+    particles = {'masses' : np.ones(100), 'positions' : rng.uniform(0., 1., (100, 3)), 'velocities' : rng.normal(0., 1., (100, 3))}
+    parameters = {'G' : 1.e-3, 'dt' : 0.1, 'box_size' : 1., 'force_method' : 'p3m', 'pm_grid_size' : 16}
+
+    for i in range(5):
+      n_body_physics.update_system(particles, parameters)
+
+    self.assertTrue(np.all((particles['positions'] >= 0.) & (particles['positions'] < 1.)))
+
+  def test_hermite_rejected(self):
+
+    particles = {'masses' : np.ones(4), 'positions' : np.random.uniform(0., 1., (4, 3)), 'velocities' : np.zeros((4, 3))}
+
+    for force_method in ['direct', 'pm']:
+      parameters = {'G' : 1., 'dt' : 0.1, 'box_size' : 1., 'force_method' : force_method, 'integrator' : 'hermite'}
+      with self.assertRaises(ValueError):
+        n_body_physics.update_system(particles, parameters)
+
+  def test_transform_without_out(self):
+
+    mesh = n_body_pm.ParticleMesh(1., 8, 3, n_body_pm.DEFAULT_SPLIT)
+    masses = np.ones(10)
+    positions = np.random.uniform(0., 1., (10, 3))
+    forces = mesh.calculate_forces(masses, positions, 1.)
+
+    has_out = n_body_pm.FFT_HAS_OUT
+    n_body_pm.FFT_HAS_OUT = False
+    try:
+      npt.assert_allclose(forces, mesh.calculate_forces(masses, positions, 1.))
+    finally:
+      n_body_pm.FFT_HAS_OUT = has_out
+
+  def test_invalidates_cached_accelerations(self):
+
+    for name in ['box_size', 'pm_grid_size', 'pm_split', 'pm_cutoff']:
+      self.assertIn(name, n_body_integrators.FORCE_PARAMETERS)
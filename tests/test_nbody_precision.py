@@ -0,0 +1,95 @@
+'''Testing for n_body_precision.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_integrators
+import n_body_physics
+import n_body_precision
+import n_body_setup
+
+########################################################################
+
+class TestRelativePositions(unittest.TestCase):
+  '''Testing for n_body_precision.RelativePositions'''
+
+  def test_round_trip(self):
+
+    positions = np.random.default_rng(1).normal(0., 1., (1000, 3)) + 1.e6
+
+    relative = n_body_precision.RelativePositions(positions, cell_size=64)
+
+    npt.assert_array_equal(np.arange(1000), np.sort(relative.order))
+    self.assertEqual(np.float32, relative.offsets.dtype)
+    self.assertEqual(16, relative.n_cells)
+
+    # Accurate to float32 precision in the offsets, not in the coordinates
+    npt.assert_allclose(positions, relative.to_positions(), rtol=0., atol=1.e-5)
+
+  def test_single_point(self):
+
+    relative = n_body_precision.RelativePositions(np.ones((3, 2)))
+
+    npt.assert_array_equal(np.ones((3, 2)), relative.to_positions())
+
+########################################################################
+
+class TestMixedPrecisionForces(unittest.TestCase):
+  '''Testing for n_body_precision.calculate_mixed_precision_forces()'''
+
+  def setUp(self):
+
+    self.particles = n_body_setup.sample_plummer_sphere(600, np.random.default_rng(2))
+
+  def test_close_to_float64(self):
+
+    for offset in [0., 1.e6]:
+
+      particles = dict(self.particles, positions=self.particles['positions'] + offset)
+
+      errors = n_body_precision.compare_with_float64(particles, {'G' : 1., 'tile_size' : 100})
+
+      self.assertLess(errors['median'], 1.e-6)
+      self.assertLess(errors['max'], 1.e-4)
+
+  def test_naive_errors_finite(self):
+
+    # Far from the origin, float32 puts some pairs at the same position.
+    particles = dict(self.particles, positions=self.particles['positions'] + 1.e6)
+
+    with np.errstate(divide='raise', invalid='raise'):
+      errors = n_body_precision.compare_with_float64(particles, {'G' : 1., 'use_numba' : False}, naive=True)
+
+    assert np.all(np.isfinite(list(errors.values())))
+    self.assertGreater(errors['max'], 1.e-2)
+
+  def test_softened_forces_and_potentials(self):
+
+    for kernel in ['plummer', 'spline']:
+
+      parameters = {'G' : 3., 'softening' : 0.05, 'softening_kernel' : kernel, 'use_numba' : False}
+
+      expected_potentials = np.zeros(600)
+      expected = n_body_physics.calculate_direct_forces(self.particles, parameters, expected_potentials)
+
+      potentials = np.zeros(600)
+      forces = n_body_physics.calculate_direct_forces(self.particles, dict(parameters, mixed_precision=True, tile_size=100), potentials)
+
+      npt.assert_allclose(expected, forces, rtol=0., atol=1.e-5*np.abs(expected).max())
+      npt.assert_allclose(expected_potentials, potentials, rtol=1.e-5)
+
+  def test_units(self):
+
+    # SI units, where float32 masses and G would overflow and underflow
+    particles = {'masses' : np.array([2.e30, 6.e24]), 'positions' : np.array([[0., 0.], [1.5e11, 0.]])}
+
+    expected = n_body_physics.calculate_direct_forces(particles, {'G' : 6.67e-11, 'use_numba' : False})
+    forces = n_body_physics.calculate_direct_forces(particles, {'G' : 6.67e-11, 'mixed_precision' : True})
+
+    npt.assert_allclose(expected, forces, rtol=1.e-6)
+
+  def test_invalidates_cached_accelerations(self):
+
+    self.assertIn('mixed_precision', n_body_integrators.FORCE_PARAMETERS)
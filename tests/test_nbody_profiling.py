@@ -0,0 +1,116 @@
+'''Testing for n_body_profiling.py
+'''
+
+import os
+import pstats
+import shutil
+import tempfile
+import numpy as np
+import unittest
+
+import n_body_checkpoint
+import n_body_data_handling
+import n_body_physics
+import n_body_profiling
+
+########################################################################
+
+class TestProfiler(unittest.TestCase):
+  '''Testing for n_body_profiling.Profiler'''
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+
+    rng = np.random.default_rng(0)
+
+    self.n_particles = 10
+    self.particles = {
+      'masses' : rng.uniform(1., 2., self.n_particles),
+      'positions' : rng.normal(0., 1., (self.n_particles, 3)),
+      'velocities' : rng.normal(0., 0.1, (self.n_particles, 3)),
+    }
+
+    self.reports = []
+    self.parameters = {'G' : 1., 'dt' : 1.e-3, 'output_dir' : os.path.join(self.directory, 'output')}
+    self.parameters['profiler_state'] = n_body_profiling.Profiler(report_every=5, report=self.reports.append)
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def run_steps(self, n_steps, profiler):
+
+    for i in range(n_steps):
+      profiler.start_step(self.parameters.get('step', 0) + 1)
+      n_body_physics.update_system(self.particles, self.parameters)
+      n_body_data_handling.save_data(self.particles, self.parameters)
+      profiler.end_step(self.parameters['step'])
+
+    n_body_data_handling.close_data(self.parameters)
+
+  def test_off_by_default(self):
+
+    self.assertIs(n_body_profiling.NULL_PROFILER, n_body_profiling.get_profiler({}))
+
+    parameters = {'profile' : True}
+    profiler = n_body_profiling.get_profiler(parameters)
+    self.assertIsInstance(profiler, n_body_profiling.Profiler)
+    self.assertIs(profiler, n_body_profiling.get_profiler(parameters))
+
+  def test_counts(self):
+
+    profiler = self.parameters['profiler_state']
+    self.run_steps(10, profiler)
+
+    # One force evaluation to start the leapfrog, then one per step
+    self.assertEqual(11, profiler.counters['force_evaluations'])
+    self.assertEqual(11*self.n_particles*(self.n_particles - 1)//2, profiler.counters['pair_interactions'])
+    self.assertEqual(11, profiler.phases['forces'].calls)
+    self.assertEqual(20, profiler.phases['kick'].calls)
+    self.assertEqual(10, profiler.phases['drift'].calls)
+
+    snapshot_bytes = 2*self.n_particles*3*8 + 16
+    self.assertEqual(10*snapshot_bytes, profiler.counters['bytes_written'])
+
+    self.assertEqual(2, len(self.reports))
+    self.assertIn('forces', self.reports[-1])
+
+  def test_hermite_pair_count(self):
+
+    profiler = self.parameters['profiler_state']
+
+    n_body_physics.calculate_accelerations_and_jerks(self.particles, self.parameters)
+    self.assertEqual(self.n_particles*(self.n_particles - 1)//2, profiler.counters['pair_interactions'])
+
+    # Pairs 0-1 and 0-2 through 0-9 and 1-2 through 1-9, with 0-1 counted once
+    n_body_physics.calculate_accelerations_and_jerks(self.particles, self.parameters, targets=np.array([0, 1]))
+    self.assertEqual(45 + 17, profiler.counters['pair_interactions'])
+
+  def test_checkpoint_bytes(self):
+
+    self.parameters['checkpoint_every'] = 1
+    self.parameters['checkpoint_file'] = os.path.join(self.directory, 'checkpoint.nbody')
+
+    n_body_checkpoint.maybe_save_checkpoint(self.particles, self.parameters)
+
+    self.assertEqual(os.path.getsize(self.parameters['checkpoint_file']), self.parameters['profiler_state'].counters['bytes_written'])
+
+  def test_trace_window(self):
+
+    trace_file = os.path.join(self.directory, 'profile.prof')
+    profiler = n_body_profiling.Profiler(report_every=0, window=(3, 4), trace_file=trace_file, report=self.reports.append)
+    self.parameters['profiler_state'] = profiler
+
+    self.run_steps(2, profiler)
+    self.assertFalse(os.path.exists(trace_file))
+
+    self.run_steps(3, profiler)
+    self.assertIsNone(profiler.trace)
+
+    functions = [function for filename, line, function in pstats.Stats(trace_file).stats]
+    self.assertIn('update_system', functions)
+
+    self.assertEqual(0, len(self.reports))
+    profiler.close()
+    self.assertEqual(1, len(self.reports))
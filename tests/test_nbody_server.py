@@ -0,0 +1,182 @@
+'''Testing for n_body_server.py
+'''
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+
+import n_body_server
+
+########################################################################
+
+def make_job(**options):
+
+  job = {
+    'G' : 1.,
+    'dt' : 0.01,
+    'max_steps' : 10,
+    'masses' : [1., 1.],
+    'positions' : [[-1., 0.], [1., 0.]],
+    'velocities' : [[0., -0.5], [0., 0.5]],
+  }
+  job.update(options)
+
+  return job
+
+########################################################################
+
+class TestRunJob(unittest.TestCase):
+  '''Testing for n_body_server.run_job()'''
+
+  def test_snapshots(self):
+
+    messages = []
+    summary = n_body_server.run_job(make_job(stream='snapshots', stream_every=4), messages.append)
+
+    self.assertEqual([4, 8], [message['step'] for message in messages])
+    self.assertEqual('snapshot', messages[0]['type'])
+    self.assertEqual((2, 2), np.shape(messages[0]['positions']))
+
+    self.assertEqual(10, summary['steps'])
+    self.assertEqual('max_steps', summary['finish_reason'])
+    self.assertLess(abs(summary['diagnostics']['energy_drift']), 1.e-4)
+
+  def test_diagnostics(self):
+
+    messages = []
+    n_body_server.run_job(make_job(stream='diagnostics', t_end=0.05, max_steps=None), messages.append)
+
+    self.assertEqual(5, len(messages))
+    self.assertEqual('diagnostics', messages[-1]['type'])
+    npt.assert_allclose([0., 0.], messages[-1]['momentum'], atol=1.e-12)
+
+  def test_invalid_jobs(self):
+
+    with self.assertRaises(ValueError):
+      n_body_server.run_job(make_job(max_steps=None), print)
+
+    with self.assertRaises(ValueError):
+      n_body_server.run_job(make_job(stream='everything'), print)
+
+########################################################################
+
+class TestServer(unittest.TestCase):
+  '''Testing n_body_server.Server with n_body_server.run_jobs()'''
+
+  def test_jobs(self):
+
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, 'test.sock')
+
+    jobs = [make_job(max_steps=n) for n in [5, 10, 15]] + [make_job(max_steps=None), make_job(stream='snapshots', stream_every=5)]
+
+    async def serve_and_submit():
+
+      # A queue shorter than the number of jobs, so submitting has to wait for the workers.
+      server = n_body_server.Server(socket_path, n_workers=2, queue_size=1)
+      await server.start()
+
+      try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, n_body_server.run_jobs, jobs, socket_path)
+      finally:
+        await server.close()
+
+    results = asyncio.run(serve_and_submit())
+
+    self.assertEqual([5, 10, 15], [messages[-1]['summary']['steps'] for messages in results[:3]])
+
+    self.assertEqual('error', results[3][-1]['type'])
+    self.assertIn('max_steps', results[3][-1]['message'])
+
+    self.assertEqual(['snapshot', 'snapshot', 'done'], [message['type'] for message in results[4]])
+
+    self.assertFalse(os.path.exists(socket_path))
+    os.rmdir(directory)
+
+  def test_close_with_client_connected(self):
+
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, 'test.sock')
+
+    async def connect_and_close():
+
+      errors = []
+      asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+
+      server = n_body_server.Server(socket_path, n_workers=1)
+      await server.start()
+
+      reader, writer = await asyncio.open_unix_connection(socket_path)
+      writer.write(b'{"type": "status"}\n')
+      status = json.loads(await reader.readline())
+
+      await server.close()
+
+      # The server hangs up.
+      self.assertEqual(b'', await asyncio.wait_for(reader.read(), 10.))
+      writer.close()
+
+      return status, errors
+
+    status, errors = asyncio.run(connect_and_close())
+
+    self.assertEqual('status', status['type'])
+    self.assertEqual([], errors)
+    os.rmdir(directory)
+
+  def test_waits_for_slow_client(self):
+
+    class Connection(object):
+      '''A worker that sends three messages for each job.'''
+
+      n_received = 0
+
+      def send(self, job):
+        pass
+
+      def recv(self):
+        self.n_received += 1
+        return self.n_received == 3, b'{}\n'
+
+    class Worker(object):
+      connection = Connection()
+
+    class Writer(object):
+      '''A client that takes a while to read each message.'''
+
+      def __init__(self):
+        self.events = []
+
+      def is_closing(self):
+        return False
+
+      def write(self, line):
+        self.events.append('write')
+
+      async def drain(self):
+        await asyncio.sleep(0.01)
+        self.events.append('drained {}'.format(Worker.connection.n_received))
+
+    async def dispatch():
+
+      server = n_body_server.Server(n_workers=1)
+      server._queue = asyncio.Queue(1)
+      task = asyncio.ensure_future(server._dispatch(Worker()))
+
+      writer = Writer()
+      await server._queue.put((0, {}, writer))
+      await server._queue.join()
+
+      task.cancel()
+      await asyncio.gather(task, return_exceptions=True)
+
+      return writer.events
+
+    # Nothing more is taken from the worker until the client has read the last message.
+    self.assertEqual(['write', 'drained 1', 'write', 'drained 2', 'write', 'drained 3'], asyncio.run(dispatch()))
@@ -0,0 +1,171 @@
+'''Testing for n_body_setup.py
+'''
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_particles
+import n_body_physics
+import n_body_setup
+
+########################################################################
+
+class TestLoadSettings(unittest.TestCase):
+  '''Testing for n_body_setup.load_config() and parse_config()'''
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'config.py')
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def write_config(self, text):
+
+    with open(self.filename, 'w') as f:
+      f.write(text)
+
+  def test_explicit_particles(self):
+
+    self.write_config('import numpy as np\n'
+                      'G = 1.\n'
+                      'dt = 0.01\n'
+                      'masses = [1., 2.]\n'
+                      'positions = np.array([[0., 0.], [1., 0.]])\n')
+
+    particles, parameters = n_body_setup.load_settings(self.filename)
+
+    self.assertEqual({'G' : 1., 'dt' : 0.01, 'finished' : False}, parameters)
+    npt.assert_array_equal([1., 2.], particles['masses'])
+    npt.assert_array_equal(np.zeros((2, 2)), particles['velocities'])
+
+  def test_generated_particles(self):
+
+    self.write_config("G = 1.\n"
+                      "particle_set = True\n"
+                      "ic_cache_dir = None\n"
+                      "initial_conditions = {'type' : 'uniform_disk', 'n_particles' : 50, 'seed' : 1}\n")
+
+    particles, parameters = n_body_setup.load_settings(self.filename)
+
+    self.assertIsInstance(particles, n_body_particles.ParticleSet)
+    self.assertEqual((50, 2), particles['positions'].shape)
+
+  def test_missing_particles(self):
+
+    self.assertRaises(ValueError, n_body_setup.parse_config, {'G' : 1.})
+
+  def test_missing_file(self):
+
+    self.assertRaises(IOError, n_body_setup.load_config, os.path.join(self.directory, 'nothing.py'))
+
+########################################################################
+
+class TestInitialConditions(unittest.TestCase):
+  '''Testing for the initial condition samplers'''
+
+  def setUp(self):
+
+    self.rng = np.random.default_rng(11)
+
+  def check_centre_of_mass_frame(self, particles):
+
+    masses = particles['masses'][:, np.newaxis]
+
+    npt.assert_allclose(0., (masses*particles['positions']).sum(axis=0), atol=1e-10)
+    npt.assert_allclose(0., (masses*particles['velocities']).sum(axis=0), atol=1e-10)
+
+  def test_plummer_sphere_in_virial_equilibrium(self):
+
+    particles = n_body_setup.sample_plummer_sphere(4000, self.rng, G=2., total_mass=3.)
+
+    kinetic = n_body_physics.calculate_kinetic_energy(particles)
+    potential = n_body_physics.calculate_potential_energy(particles, {'G' : 2.})
+
+    self.assertAlmostEqual(1., -2.*kinetic/potential, delta=0.1)
+    self.assertAlmostEqual(3., particles['masses'].sum())
+    self.check_centre_of_mass_frame(particles)
+
+  def test_uniform_disk_circular_orbits(self):
+
+    particles = n_body_setup.sample_uniform_disk(1000, self.rng, n_dimensions=3, central_mass=10.)
+
+    # Relative to the central particle, which comes first
+    positions = particles['positions'] - particles['positions'][0]
+    velocities = particles['velocities'] - particles['velocities'][0]
+
+    self.assertEqual(1001, len(particles['masses']))
+    npt.assert_array_equal(0., positions[:, 2])
+    npt.assert_allclose(0., (positions*velocities).sum(axis=1), atol=1e-8)
+    self.check_centre_of_mass_frame(particles)
+
+  def test_keplerian_system_orbits(self):
+
+    particles = n_body_setup.sample_keplerian_system(20, self.rng, G=1., semi_major_axes=(1., 5.), max_eccentricity=0.2)
+
+    # Orbits about the star, from the two-body energy
+    masses = particles['masses']
+    positions = particles['positions'][1:] - particles['positions'][0]
+    velocities = particles['velocities'][1:] - particles['velocities'][0]
+    mu = masses[0] + masses[1:]
+
+    energies = 0.5*(velocities**2.).sum(axis=1) - mu/np.linalg.norm(positions, axis=1)
+    semi_major_axes = -mu/(2.*energies)
+
+    self.assertTrue(np.all(semi_major_axes > 1. - 1e-8))
+    self.assertTrue(np.all(semi_major_axes < 5. + 1e-8))
+    self.check_centre_of_mass_frame(particles)
+
+  def test_unknown_type(self):
+
+    self.assertRaises(ValueError, n_body_setup.make_initial_conditions, {'type' : 'cube'}, 1.)
+
+########################################################################
+
+class TestInitialConditionCache(unittest.TestCase):
+  '''Testing for n_body_setup.get_initial_conditions()'''
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+
+    self.spec = {'type' : 'plummer', 'n_particles' : 100, 'seed' : 3}
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def test_reuses_cached(self):
+
+    expected = n_body_setup.get_initial_conditions(self.spec, 1., self.directory)
+    self.assertEqual(1, len(os.listdir(self.directory)))
+
+    actual = n_body_setup.get_initial_conditions(self.spec, 1., self.directory)
+
+    for key in expected:
+      npt.assert_array_equal(expected[key], actual[key])
+
+    # Loaded from the cache, but still writeable
+    actual['positions'] += 1.
+
+  def test_different_config_different_file(self):
+
+    n_body_setup.get_initial_conditions(self.spec, 1., self.directory)
+    n_body_setup.get_initial_conditions(self.spec, 2., self.directory)
+    n_body_setup.get_initial_conditions(dict(self.spec, seed=4), 1., self.directory)
+
+    self.assertEqual(3, len(os.listdir(self.directory)))
+
+  def test_unseeded_not_cached(self):
+
+    del self.spec['seed']
+
+    n_body_setup.get_initial_conditions(self.spec, 1., self.directory)
+
+    self.assertEqual(0, len(os.listdir(self.directory)))
@@ -0,0 +1,141 @@
+'''Testing for n_body_softening.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_integrators
+import n_body_physics
+import n_body_softening
+
+########################################################################
+
+class TestSofteningKernels(unittest.TestCase):
+  '''Testing for the softened 1/r^3, its derivative and 1/r'''
+
+  def setUp(self):
+
+    self.softening = 0.1
+    self.distances = np.linspace(1e-3, 1., 2001)
+
+  def test_newtonian_far_away(self):
+
+    distances_squared = np.array([0.5, 1., 4.])
+
+    npt.assert_allclose(distances_squared**-1.5, n_body_softening.calculate_inverse_cubes(distances_squared, 0.1, 'spline'))
+    npt.assert_allclose(distances_squared**-0.5, n_body_softening.calculate_inverse_distances(distances_squared, 0.1, 'spline'))
+    npt.assert_allclose(-3.*distances_squared**-2.5, n_body_softening.calculate_inverse_cube_derivatives(distances_squared, 0.1, 'spline'))
+
+  def test_potential_at_zero(self):
+
+    for kernel in n_body_softening.SOFTENING_KERNELS:
+      self.assertAlmostEqual(1./self.softening, n_body_softening.calculate_inverse_distances(0., self.softening, kernel))
+
+  def test_unsoftened_zero_distance(self):
+
+    npt.assert_array_equal([0., 1.], n_body_softening.calculate_inverse_cubes([0., 1.]))
+
+  def test_force_is_gradient_of_potential(self):
+
+    for kernel in n_body_softening.SOFTENING_KERNELS:
+
+      potentials = -n_body_softening.calculate_inverse_distances(self.distances**2., self.softening, kernel)
+      forces = -self.distances*n_body_softening.calculate_inverse_cubes(self.distances**2., self.softening, kernel)
+
+      npt.assert_allclose(-np.gradient(potentials, self.distances)[1:-1], forces[1:-1], rtol=1e-4, atol=1e-6)
+
+  def test_derivative(self):
+
+    for kernel in n_body_softening.SOFTENING_KERNELS:
+
+      inverse_cubes = n_body_softening.calculate_inverse_cubes(self.distances**2., self.softening, kernel)
+      derivatives = n_body_softening.calculate_inverse_cube_derivatives(self.distances**2., self.softening, kernel)
+
+      npt.assert_allclose(np.gradient(inverse_cubes, self.distances)[1:-1]/self.distances[1:-1], derivatives[1:-1], rtol=1e-3, atol=1e-3)
+
+  def test_unknown_kernel(self):
+
+    self.assertRaises(ValueError, n_body_softening.get_softening, {'softening_kernel' : 'gaussian'})
+    self.assertRaises(ValueError, n_body_softening.get_softening, {'softening' : -1.})
+
+########################################################################
+
+class TestSoftenedForces(unittest.TestCase):
+  '''Testing that every force path softens in the same way'''
+
+  def setUp(self):
+
+    rng = np.random.default_rng(7)
+
+    self.particles = {}
+    self.particles['masses'] = rng.uniform(1., 2., 40)
+    self.particles['positions'] = rng.normal(0., 0.2, (40, 3))
+    self.particles['velocities'] = rng.normal(0., 1., (40, 3))
+
+  def test_consistent_force_paths(self):
+
+    for kernel in n_body_softening.SOFTENING_KERNELS:
+
+      parameters = {'G' : 1., 'softening' : 0.05, 'softening_kernel' : kernel}
+
+      expected = n_body_physics.calculate_block_forces(self.particles['masses'], self.particles['positions'],
+                                                       self.particles['masses'], self.particles['positions'], 1.,
+                                                       0.05, kernel).sum(axis=1)
+
+      candidates = [
+        dict(parameters, use_numba=False),
+        dict(parameters, use_numba=False, tile_size=7),
+        dict(parameters),
+        dict(parameters, force_method='tree', theta=0.),
+      ]
+      for candidate in candidates:
+        npt.assert_allclose(expected, n_body_physics.calculate_net_force_on_all_particles(self.particles, candidate), rtol=1e-10, atol=1e-10)
+
+      npt.assert_allclose(expected[3], n_body_physics.calculate_net_force_on_particle(3, self.particles, parameters), rtol=1e-10)
+
+      accelerations, jerks = n_body_physics.calculate_accelerations_and_jerks(self.particles, parameters)
+      npt.assert_allclose(expected/self.particles['masses'][:, np.newaxis], accelerations, rtol=1e-10)
+
+  def test_softening_limits_force(self):
+
+    particles = {'masses' : np.ones(2), 'positions' : np.array([[0., 0.], [1e-6, 0.]])}
+
+    forces = n_body_physics.calculate_net_force_on_all_particles(particles, {'G' : 1., 'softening' : 0.1})
+
+    self.assertLess(np.abs(forces).max(), 1e-6/0.1**3.)
+
+  def test_unsoftened_coincident_particles(self):
+
+    particles = {'masses' : np.ones(3), 'positions' : np.array([[0., 0.], [0., 0.], [1., 0.]])}
+
+    expected = np.array([[1., 0.], [1., 0.], [-2., 0.]])
+
+    for parameters in [{'G' : 1., 'use_numba' : False}, {'G' : 1., 'use_numba' : False, 'tile_size' : 2}, {'G' : 1.}]:
+      npt.assert_allclose(expected, n_body_physics.calculate_net_force_on_all_particles(particles, parameters))
+
+  def test_newtonian_radius(self):
+
+    self.assertEqual(0., n_body_softening.calculate_newtonian_radius())
+    self.assertEqual(np.inf, n_body_softening.calculate_newtonian_radius(0.1, 'plummer'))
+
+    radius = n_body_softening.calculate_newtonian_radius(0.1, 'spline')
+    self.assertEqual(radius**-3., n_body_softening.calculate_inverse_cubes([radius**2.], 0.1, 'spline')[0])
+
+  def test_jerks(self):
+
+    parameters = {'G' : 1., 'softening' : 0.05, 'softening_kernel' : 'spline'}
+
+    accelerations, jerks = n_body_physics.calculate_accelerations_and_jerks(self.particles, parameters)
+
+    # Compare with a finite difference along the velocities.
+    h = 1e-6
+    moved = dict(self.particles, positions=self.particles['positions'] + h*self.particles['velocities'])
+    moved_accelerations, moved_jerks = n_body_physics.calculate_accelerations_and_jerks(moved, parameters)
+
+    npt.assert_allclose((moved_accelerations - accelerations)/h, jerks, rtol=1e-3, atol=1e-3*np.abs(jerks).max())
+
+  def test_invalidates_cached_accelerations(self):
+
+    self.assertIn('softening', n_body_integrators.FORCE_PARAMETERS)
+    self.assertIn('softening_kernel', n_body_integrators.FORCE_PARAMETERS)
@@ -0,0 +1,120 @@
+'''Testing for n_body_tree.py
+'''
+
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+import n_body_physics
+import n_body_tree
+
+########################################################################
+
+class TestBuildTree(unittest.TestCase):
+  '''Testing for n_body_tree.build_tree()'''
+
+  def setUp(self):
+
+    self.n_particles = 200
+    self.n_dimensions = 3
+
+    self.masses = np.random.uniform(1., 3., self.n_particles)
+    self.positions = np.random.normal(0., 1., (self.n_particles, self.n_dimensions))
+
+    self.tree = n_body_tree.build_tree(self.masses, self.positions, leaf_size=4)
+
+  def test_root_holds_everything(self):
+
+    npt.assert_allclose(self.masses.sum(), self.tree['masses'][0])
+
+    expected = (self.masses[:, np.newaxis]*self.positions).sum(axis=0)/self.masses.sum()
+    npt.assert_allclose(expected, self.tree['centers_of_mass'][0])
+
+  def test_leaves_hold_every_particle_once(self):
+
+    self.assertEqual(self.n_particles, self.tree['leaf_counts'].sum())
+    npt.assert_array_equal(np.arange(self.n_particles), np.sort(self.tree['order']))
+    assert self.tree['leaf_counts'].max() <= 4
+
+  def test_particles_inside_their_leaf(self):
+
+    leaves = np.repeat(np.arange(self.tree['leaf_counts'].size), self.tree['leaf_counts'])
+    offsets = np.abs(self.positions[self.tree['order']] - self.tree['centers'][leaves])
+
+    assert (offsets <= self.tree['half_widths'][leaves, np.newaxis]).all()
+
+  def test_coincident_particles(self):
+
+    positions = np.zeros((20, 2))
+
+    tree = n_body_tree.build_tree(np.ones(20), positions, leaf_size=4)
+
+    self.assertEqual(20, tree['leaf_counts'].sum())
+
+########################################################################
+
+class TestCalculateTreeForces(unittest.TestCase):
+  '''Testing for n_body_tree.calculate_tree_forces()'''
+
+  def setUp(self):
+
+    self.n_particles = 300
+
+    self.parameters = {'G': 6.67e-11,
+                       'force_method' : 'tree',
+                      }
+
+  def make_particles(self, n_dimensions):
+
+    particles = {}
+    particles['masses'] = np.random.uniform(1., 3., self.n_particles)
+    particles['positions'] = np.random.normal(0., 1., (self.n_particles, n_dimensions))
+
+    return particles
+
+  def test_zero_theta_is_direct(self):
+
+    self.parameters['theta'] = 0.
+
+    for n_dimensions in [2, 3]:
+      particles = self.make_particles(n_dimensions)
+
+      expected = n_body_physics.calculate_direct_forces(particles, self.parameters)
+      actual = n_body_physics.calculate_net_force_on_all_particles(particles, self.parameters)
+
+      npt.assert_allclose(expected, actual)
+
+  def test_error_small(self):
+
+    self.parameters['theta'] = 0.5
+
+    for n_dimensions in [2, 3]:
+      particles = self.make_particles(n_dimensions)
+
+      errors = n_body_physics.estimate_force_error(particles, self.parameters, n_samples=50, seed=1)
+
+      assert errors['median'] < 0.02
+
+  def test_error_grows_with_theta(self):
+
+    particles = self.make_particles(3)
+
+    self.parameters['theta'] = 0.2
+    small = n_body_physics.estimate_force_error(particles, self.parameters, n_samples=50, seed=1)
+
+    self.parameters['theta'] = 1.
+    large = n_body_physics.estimate_force_error(particles, self.parameters, n_samples=50, seed=1)
+
+    assert small['rms'] < large['rms']
+
+  def test_targets_subset(self):
+
+    particles = self.make_particles(3)
+    tree = n_body_tree.build_tree(particles['masses'], particles['positions'])
+
+    targets = np.array([5, 1, 7])
+
+    expected = n_body_tree.evaluate_tree_forces(tree, particles['masses'], particles['positions'], self.parameters['G'])[targets]
+    actual = n_body_tree.evaluate_tree_forces(tree, particles['masses'], particles['positions'], self.parameters['G'], targets=targets)
+
+    npt.assert_allclose(expected, actual)